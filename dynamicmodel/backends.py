@@ -0,0 +1,266 @@
+"""
+Database specific SQL for working with JSON stored in extra_fields.
+
+SQLite needs the JSON1 extension, PostgreSQL 9.5 or newer. On SQLite
+native JSON columns are plain text columns, since SQLite has no JSON type
+and the JSON1 functions work on text.
+"""
+
+import re
+
+from django.db import DatabaseError, transaction
+
+
+# keys are put into the SQL verbatim, so they are restricted to what
+# DynamicSchemaField names can be
+KEY_RE = re.compile(r'^\w+\Z')
+
+# SQL types dynamic values are cast to, by DynamicSchemaField.field_type;
+# other field types are compared as text
+FIELD_TYPE_CASTS = {
+    'IntegerField': 'integer',
+    'BooleanField': 'boolean',
+    'NullBooleanField': 'boolean',
+}
+
+
+def check_key(key):
+    """Returns ``key`` if it can be put into SQL, raises ValueError if not"""
+    if not KEY_RE.match(key):
+        raise ValueError("Invalid dynamic field name: %r" % key)
+    return key
+
+
+class JSONBackend(object):
+    vendor = None
+    native_column_type = None
+    casts = {}
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def quote_name(self, name):
+        return self.connection.ops.quote_name(name)
+
+    def extract_sql(self, column_sql, key, field_type=None, native=False):
+        """SQL expression for the value of a dynamic field, cast to the SQL
+        type matching its field type.
+
+        ``key`` is put into the SQL verbatim (so that the expression can
+        match an expression index), it has to be a valid field name;
+        check_key() raises ValueError if it isn't.
+        """
+        sql = self.extract_text_sql(column_sql, key, native)
+        cast = self.casts.get(FIELD_TYPE_CASTS.get(field_type))
+        if cast:
+            sql = self.cast_sql(sql, cast)
+        return sql
+
+    def check(self):
+        """Raises DatabaseError if the database can't handle JSON"""
+        cursor = self.connection.cursor()
+        cursor.execute(self.check_sql)
+
+    def is_supported(self):
+        """Whether the database can handle JSON, checked once per
+        connection. A failed check is rolled back to a savepoint, so it
+        doesn't break the transaction it runs in."""
+        supported = getattr(self.connection, '_dynamicmodel_json', None)
+        if supported is None:
+            using = self.connection.alias
+            sid = transaction.savepoint(using=using)
+            try:
+                self.check()
+            except DatabaseError:
+                transaction.savepoint_rollback(sid, using=using)
+                supported = False
+            else:
+                transaction.savepoint_commit(sid, using=using)
+                supported = True
+            self.connection._dynamicmodel_json = supported
+        return supported
+
+    def quote_value(self, value):
+        return "'%s'" % unicode(value).replace("'", "''")
+
+    def update_keys_sql(self, column_sql, values, removed_keys=(),
+        native=False):
+        """SQL expression for the document in ``column_sql`` with the keys
+        in ``values``, a list of (key, JSON value SQL) pairs, set and
+        ``removed_keys`` removed, leaving the other keys untouched.
+
+        Values bound as parameters use ``json_param_sql``. Keys are put
+        into the SQL verbatim, like in extract_sql().
+        """
+        raise NotImplementedError
+
+    def to_json_sql(self, sql):
+        """JSON value SQL for a scalar SQL expression, JSON null if the
+        expression is NULL"""
+        raise NotImplementedError
+
+    def has_key_sql(self, column_sql, key, native=False):
+        """SQL condition true for documents that contain the key"""
+        raise NotImplementedError
+
+    def extract_json_sql(self, column_sql, key, native=False):
+        """JSON value SQL for the value of a dynamic field, JSON null if
+        the document doesn't have the key"""
+        raise NotImplementedError
+
+    def convert_column_sql(self, table, column, native=True):
+        """SQL statements converting an existing column between text and
+        the native JSON column type"""
+        raise NotImplementedError
+
+    def create_index_sql(self, name, table, expressions, where=None):
+        sql = "CREATE INDEX IF NOT EXISTS %s ON %s (%s)" % (
+            self.quote_name(name), self.quote_name(table),
+            ", ".join("(%s)" % el for el in expressions))
+        if where:
+            sql += " WHERE %s" % where
+        return sql
+
+    def drop_index_sql(self, name):
+        return "DROP INDEX IF EXISTS %s" % self.quote_name(name)
+
+    def index_names(self, table):
+        """Names of the indexes on a table"""
+        cursor = self.connection.cursor()
+        cursor.execute(self.index_names_sql, [table])
+        return [row[0] for row in cursor.fetchall()]
+
+
+class SQLiteJSONBackend(JSONBackend):
+    vendor = 'sqlite'
+    native_column_type = 'text'
+    # unless built with SQLITE_ENABLE_STAT4, SQLite doesn't use a partial
+    # index when the value in the query is a bound parameter
+    supports_partial_indexes = False
+    check_sql = "SELECT json('{}')"
+    index_names_sql = ("SELECT name FROM sqlite_master WHERE type = 'index' "
+        "AND tbl_name = %s")
+    # json_extract() already returns integers, and 1/0 for booleans
+    casts = {'integer': 'INTEGER'}
+    json_param_sql = "json(%s)"
+
+    def extract_text_sql(self, column_sql, key, native=False):
+        return "json_extract(%s, '$.%s')" % (column_sql, check_key(key))
+
+    def cast_sql(self, sql, cast):
+        return "CAST(%s AS %s)" % (sql, cast)
+
+    def update_keys_sql(self, column_sql, values, removed_keys=(),
+        native=False):
+        sql = "COALESCE(%s, '{}')" % column_sql
+        if removed_keys:
+            sql = "json_remove(%s, %s)" % (sql, ", ".join(
+                "'$.%s'" % check_key(key) for key in removed_keys))
+        if values:
+            sql = "json_set(%s, %s)" % (sql, ", ".join(
+                "'$.%s', %s" % (check_key(key), value_sql)
+                for key, value_sql in values))
+        return sql
+
+    def to_json_sql(self, sql):
+        return sql
+
+    def has_key_sql(self, column_sql, key, native=False):
+        return "json_type(%s, '$.%s') IS NOT NULL" % (column_sql,
+            check_key(key))
+
+    def extract_json_sql(self, column_sql, key, native=False):
+        # json_extract() returns SQL values, which json_set() stores
+        # unchanged for the scalars dynamic fields hold, except booleans,
+        # which come back as 1 and 0
+        return ("CASE json_type(%(column)s, '$.%(key)s') "
+            "WHEN 'true' THEN json('true') WHEN 'false' THEN json('false') "
+            "ELSE %(value)s END" % {'column': column_sql,
+                'key': check_key(key),
+                'value': self.extract_text_sql(column_sql, key, native)})
+
+    def convert_column_sql(self, table, column, native=True):
+        # the column type doesn't change, only the stored documents are
+        # normalized
+        if not native:
+            return []
+        return ["UPDATE %s SET %s = json(%s)" % (self.quote_name(table),
+            self.quote_name(column), self.quote_name(column))]
+
+    def invalid_rows_sql(self, table, column):
+        return "SELECT COUNT(*) FROM %s WHERE json_valid(%s) = 0" % (
+            self.quote_name(table), self.quote_name(column))
+
+
+class PostgreSQLJSONBackend(JSONBackend):
+    vendor = 'postgresql'
+    native_column_type = 'jsonb'
+    supports_partial_indexes = True
+    check_sql = "SELECT '{}'::jsonb"
+    index_names_sql = "SELECT indexname FROM pg_indexes WHERE tablename = %s"
+    casts = {'integer': 'integer', 'boolean': 'boolean'}
+    json_param_sql = "%s::jsonb"
+
+    def quote_value(self, value):
+        # an escape string literal reads the same whatever
+        # standard_conforming_strings is set to
+        return "E'%s'" % unicode(value).replace('\\', '\\\\').replace(
+            "'", "''")
+
+    def jsonb_sql(self, column_sql, native=False):
+        return column_sql if native else "%s::jsonb" % column_sql
+
+    def extract_text_sql(self, column_sql, key, native=False):
+        return "(%s ->> '%s')" % (self.jsonb_sql(column_sql, native),
+            check_key(key))
+
+    def cast_sql(self, sql, cast):
+        return "(%s)::%s" % (sql, cast)
+
+    def update_keys_sql(self, column_sql, values, removed_keys=(),
+        native=False):
+        sql = self.jsonb_sql("COALESCE(%s, '{}')" % column_sql, native)
+        for key in removed_keys:
+            sql = "(%s - '%s')" % (sql, check_key(key))
+        for key, value_sql in values:
+            sql = "jsonb_set(%s, '{%s}', %s)" % (sql, check_key(key),
+                value_sql)
+        return sql if native else "(%s)::text" % sql
+
+    def to_json_sql(self, sql):
+        # jsonb_set() is strict, so a NULL value would make the whole
+        # document NULL instead of setting the key to null
+        return "COALESCE(to_jsonb(%s), 'null'::jsonb)" % sql
+
+    def has_key_sql(self, column_sql, key, native=False):
+        return "(%s ? '%s')" % (self.jsonb_sql(column_sql, native),
+            check_key(key))
+
+    def extract_json_sql(self, column_sql, key, native=False):
+        # a missing key is NULL, see to_json_sql()
+        return "COALESCE(%s -> '%s', 'null'::jsonb)" % (
+            self.jsonb_sql(column_sql, native), check_key(key))
+
+    def convert_column_sql(self, table, column, native=True):
+        column_type = 'jsonb' if native else 'text'
+        return ["ALTER TABLE %s ALTER COLUMN %s TYPE %s USING %s::%s" % (
+            self.quote_name(table), self.quote_name(column), column_type,
+            self.quote_name(column), column_type)]
+
+    def invalid_rows_sql(self, table, column):
+        # invalid documents make the conversion itself fail
+        return None
+
+
+BACKENDS = {
+    'sqlite': SQLiteJSONBackend,
+    'postgresql': PostgreSQLJSONBackend,
+}
+
+
+def get_backend(connection):
+    try:
+        return BACKENDS[connection.vendor](connection)
+    except KeyError:
+        raise DatabaseError("dynamicmodel has no JSON support for '%s' "
+            "databases" % connection.vendor)
@@ -0,0 +1,340 @@
+"""
+Rewriting of stored dynamic values after schema changes.
+
+Changing a schema doesn't touch the rows of the model: a removed field
+stays in every stored extra_fields document until the row is loaded and
+saved again, and values of a field whose type changed keep their old
+type. A Backfill applies a list of operations (RemoveField, RenameField,
+ConvertField) to the stored documents directly, a chunk of rows at a
+time, with each chunk in its own transaction so no lock is held for long.
+Removals and renames are done in SQL; conversions load the affected
+values of a chunk and write back only the ones that changed.
+
+Operations follow the schemas: a field is removed only from rows whose
+schema no longer has it, renamed only in rows whose schema has the new
+name and not the old one, and converted only in rows whose schema field
+has the type converted to. An operation that no schema calls for raises
+ValueError before anything is written.
+
+A checkpoint file records how far a backfill got, so an interrupted run
+continues where it stopped when started again with the same operations.
+"""
+
+import json
+import os
+import time
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from django.db.models import Max
+
+from .backends import get_backend
+from .converters import compile_converter
+
+
+class RemoveField(object):
+    """Drops a key from the stored documents"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return "RemoveField(%r)" % self.name
+
+    def key(self):
+        return self.name
+
+    def applies_to(self, field_types):
+        return self.name not in field_types
+
+    def sql(self, backfill):
+        return backfill.backend.update_keys_sql(backfill.column_sql, [],
+            [self.name], backfill.native), []
+
+
+class RenameField(object):
+    """Moves the value of a key to a new key"""
+
+    def __init__(self, old_name, new_name):
+        self.old_name = old_name
+        self.new_name = new_name
+
+    def __repr__(self):
+        return "RenameField(%r, %r)" % (self.old_name, self.new_name)
+
+    def key(self):
+        return self.old_name
+
+    def applies_to(self, field_types):
+        return self.new_name in field_types and \
+            self.old_name not in field_types
+
+    def sql(self, backfill):
+        backend = backfill.backend
+        value_sql = backend.extract_json_sql(backfill.column_sql,
+            self.old_name, backfill.native)
+        return backend.update_keys_sql(backfill.column_sql,
+            [(self.new_name, value_sql)], [self.old_name],
+            backfill.native), []
+
+
+class ConvertField(object):
+    """Converts the stored values of a key to a schema field type.
+
+    Values that can't be converted are left as they are, unless
+    ``strict`` is set, in which case ValidationError is raised.
+    """
+
+    def __init__(self, name, field_type, extra=None, strict=False):
+        self.name = name
+        self.field_type = field_type
+        self.converter = compile_converter(field_type, extra=extra)
+        self.strict = strict
+
+    def __repr__(self):
+        return "ConvertField(%r, %r)" % (self.name, self.field_type)
+
+    def key(self):
+        return self.name
+
+    def applies_to(self, field_types):
+        return field_types.get(self.name) == self.field_type
+
+    def convert(self, value):
+        try:
+            return self.converter(value)
+        except ValidationError as e:
+            if self.strict:
+                raise ValidationError({self.name: e.messages})
+            return value
+
+
+class Backfill(object):
+    """Applies operations to the stored extra_fields of a model.
+
+    ``type_value`` limits the backfill to the rows of one schema of a
+    model with a schema type descriptor. ``chunk_size`` is the number of
+    rows rewritten in one transaction, ``throttle`` the number of seconds
+    to sleep between chunks. ``progress`` is called after every chunk with
+    the last primary key done, the highest primary key and the number of
+    rows changed in the chunk, each row counted once whatever the number
+    of operations that changed it.
+    """
+
+    def __init__(self, model, operations, type_value=None, chunk_size=1000,
+        throttle=0, checkpoint=None, progress=None, using=None):
+
+        self.model = model
+        self.operations = list(operations)
+        self.type_value = type_value
+        self.chunk_size = chunk_size
+        self.throttle = throttle
+        self.checkpoint = checkpoint
+        self.progress = progress
+        self.using = using or DEFAULT_DB_ALIAS
+
+        self.connection = connections[self.using]
+        self.backend = get_backend(self.connection)
+        qn = self.connection.ops.quote_name
+        extra_field = model._meta.get_field('extra_fields')
+        self.field = extra_field
+        self.native = extra_field.native
+        self.column_sql = qn(extra_field.column)
+        self.table_sql = qn(model._meta.db_table)
+        self.pk_sql = qn(model._meta.pk.column)
+
+        descriptor = model.get_schema_type_descriptor()
+        if type_value is not None and not descriptor:
+            raise ValueError("%s has no schema type descriptor" %
+                model.__name__)
+        self.descriptor = descriptor
+        self.type_sql = qn(model._meta.get_field(descriptor).column) \
+            if descriptor else None
+        self.conditions = None
+
+    def get_signature(self):
+        return u"%s:%s:%r" % (ContentType.objects.get_for_model(
+            self.model).pk, self.type_value, self.operations)
+
+    def load_checkpoint(self):
+        """Returns the primary key the last run stopped after, or None"""
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return None
+        with open(self.checkpoint) as f:
+            state = json.load(f)
+        if state['signature'] != self.get_signature():
+            raise ValueError("Checkpoint %s belongs to a different "
+                "backfill" % self.checkpoint)
+        return state['position']
+
+    def save_checkpoint(self, position):
+        if not self.checkpoint:
+            return
+        tmp_path = self.checkpoint + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'signature': self.get_signature(),
+                'position': position}, f)
+        os.rename(tmp_path, self.checkpoint)
+
+    def get_queryset(self):
+        queryset = self.model._base_manager.using(self.using)
+        if self.type_value is not None:
+            queryset = queryset.filter(**{self.descriptor: self.type_value})
+        return queryset
+
+    def get_type_condition(self, operation, field_types):
+        """Returns a (sql, params) condition limiting an operation to the
+        rows of the schemas it applies to, raises ValueError if there are
+        none"""
+        name = self.model.__name__
+        if self.type_value is not None:
+            if not operation.applies_to(field_types.get(self.type_value, {})):
+                raise ValueError("%r doesn't match the schema of %s with "
+                    "type '%s'" % (operation, name, self.type_value))
+            return "%s = %%s" % self.type_sql, [self.type_value]
+
+        applying = [type_value for type_value in field_types
+            if operation.applies_to(field_types[type_value])]
+        if not applying:
+            raise ValueError("%r doesn't match any schema of %s" % (
+                operation, name))
+        if not self.descriptor:
+            return None, []
+        if operation.applies_to({}):
+            # also rows of type values that have no schema
+            excluded = [type_value for type_value in field_types
+                if type_value not in applying]
+            if not excluded:
+                return None, []
+            return self.type_in_sql(excluded, negate=True)
+        return self.type_in_sql(applying)
+
+    def type_in_sql(self, type_values, negate=False):
+        """Returns a (sql, params) condition matching rows with (or, with
+        ``negate``, without) one of the type values, which can include
+        None"""
+        values = [type_value for type_value in type_values
+            if type_value is not None]
+        placeholders = ", ".join(["%s"] * len(values))
+        if not negate:
+            conditions = ["%s IN (%s)" % (self.type_sql, placeholders)] \
+                if values else []
+            if None in type_values:
+                conditions.append("%s IS NULL" % self.type_sql)
+            return "(%s)" % " OR ".join(conditions), values
+        if None in type_values:
+            conditions = ["%s IS NOT NULL" % self.type_sql]
+            if values:
+                conditions.append("%s NOT IN (%s)" % (self.type_sql,
+                    placeholders))
+            return "(%s)" % " AND ".join(conditions), values
+        # NOT IN is never true for NULL
+        return "(%s NOT IN (%s) OR %s IS NULL)" % (self.type_sql,
+            placeholders, self.type_sql), values
+
+    def prepare(self):
+        """Works out the rows each operation applies to from the schemas"""
+        from .models import DynamicSchema
+
+        field_types = dict((type_value, dict((name, field_type)
+            for name, field_type, required, extra in specs))
+            for type_value, specs in
+                DynamicSchema.objects.get_field_specs(self.model).iteritems())
+        self.conditions = [self.get_type_condition(operation, field_types)
+            for operation in self.operations]
+
+    def chunk_where(self, index, low, high):
+        where = ["%s <= %%s" % self.pk_sql,
+            self.backend.has_key_sql(self.column_sql,
+                self.operations[index].key(), self.native)]
+        params = [high]
+        if low is not None:
+            where.insert(0, "%s > %%s" % self.pk_sql)
+            params.insert(0, low)
+        condition, condition_params = self.conditions[index]
+        if condition:
+            where.append(condition)
+            params.extend(condition_params)
+        return " AND ".join(where), params
+
+    def run_sql(self, cursor, index, low, high):
+        """Applies an operation with a single UPDATE, returns the primary
+        keys of the rows changed"""
+        sql, params = self.operations[index].sql(self)
+        where, where_params = self.chunk_where(index, low, high)
+        # read in the same transaction, so these are the rows updated
+        cursor.execute("SELECT %s FROM %s WHERE %s" % (self.pk_sql,
+            self.table_sql, where), where_params)
+        pks = set(row[0] for row in cursor.fetchall())
+        if pks:
+            cursor.execute("UPDATE %s SET %s = %s WHERE %s" % (
+                self.table_sql, self.column_sql, sql, where),
+                params + where_params)
+        return pks
+
+    def run_convert(self, cursor, index, low, high):
+        """Converts a field's values in Python, returns the primary keys of
+        the rows changed"""
+        operation = self.operations[index]
+        where, params = self.chunk_where(index, low, high)
+        cursor.execute("SELECT %s, %s FROM %s WHERE %s" % (self.pk_sql,
+            self.column_sql, self.table_sql, where), params)
+
+        updates = []
+        for pk, document in cursor.fetchall():
+            if isinstance(document, basestring):
+                document = self.field.loads(document)
+            value = document.get(operation.name)
+            converted = operation.convert(value)
+            if type(converted) is not type(value) or converted != value:
+                updates.append((self.field.dumps(converted), pk))
+
+        if updates:
+            sql = self.backend.update_keys_sql(self.column_sql,
+                [(operation.name, self.backend.json_param_sql)],
+                native=self.native)
+            cursor.executemany("UPDATE %s SET %s = %s WHERE %s = %%s" % (
+                self.table_sql, self.column_sql, sql, self.pk_sql), updates)
+        return set(pk for value, pk in updates)
+
+    def run_chunk(self, low, high):
+        """Applies all operations to the rows with primary keys after
+        ``low`` (from the start if None) up to ``high``, returns the number
+        of rows changed. A row changed by several operations counts once."""
+        changed = set()
+        with transaction.commit_on_success(using=self.using):
+            cursor = self.connection.cursor()
+            for index, operation in enumerate(self.operations):
+                if isinstance(operation, ConvertField):
+                    changed |= self.run_convert(cursor, index, low, high)
+                else:
+                    changed |= self.run_sql(cursor, index, low, high)
+        return len(changed)
+
+    def run(self):
+        """Runs the backfill from the checkpoint, or from the start, and
+        returns the number of rows changed"""
+        self.prepare()
+        last_pk = self.load_checkpoint()
+        max_pk = self.get_queryset().aggregate(max_pk=Max('pk'))['max_pk']
+        queryset = self.get_queryset().order_by('pk').values_list('pk',
+            flat=True)
+        changed = 0
+        while True:
+            chunk_qs = queryset if last_pk is None else \
+                queryset.filter(pk__gt=last_pk)
+            pks = list(chunk_qs[:self.chunk_size])
+            if not pks:
+                break
+            chunk_changed = self.run_chunk(last_pk, pks[-1])
+            changed += chunk_changed
+            last_pk = pks[-1]
+            self.save_checkpoint(last_pk)
+            if self.progress:
+                self.progress(last_pk, max_pk, chunk_changed)
+            if len(pks) < self.chunk_size:
+                break
+            if self.throttle:
+                time.sleep(self.throttle)
+        return changed
@@ -0,0 +1,64 @@
+import threading
+from collections import OrderedDict
+
+
+class LocalSchemaCache(object):
+    """Process-local LRU store for schemas.
+
+    Every entry is tagged with the version stamp it was loaded under, so
+    a lookup only succeeds while that stamp is still the current one in
+    the shared cache.
+
+    ``generation`` is bumped whenever this process changes a schema, so
+    schemas kept elsewhere in the process (e.g. by model instances) can
+    tell they may be stale without asking the shared cache.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.generation = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def touch(self):
+        with self._lock:
+            self.generation += 1
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] != version:
+                return None
+            # move the key to the most recently used end
+            del self._data[key]
+            self._data[key] = entry
+            return entry[1]
+
+    def get_stale(self, key):
+        """Returns the entry for a key whatever version it was loaded
+        under"""
+        with self._lock:
+            entry = self._data.get(key)
+            return entry[1] if entry is not None else None
+
+    def set(self, key, version, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            if key in self._data:
+                del self._data[key]
+            self._data[key] = (version, value)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._data:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
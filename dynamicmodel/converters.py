@@ -0,0 +1,218 @@
+"""
+Conversion of dynamic field values to the Python types of their schema
+field types.
+
+Converters are compiled once per schema (see get_converters()) and then
+applied to plain values, e.g. rows for bulk inserts, or to whole batches
+of loaded rows (see convert_rows()). A converter returns the converted
+value or raises ValidationError. clean_row() validates the concrete and
+dynamic values of a row to insert, for bulk inserts and imports alike.
+"""
+
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.utils.encoding import smart_unicode
+
+
+EMPTY_VALUES = (None, '')
+
+TRUE_VALUES = ('true', '1', 'yes', 'on')
+FALSE_VALUES = ('false', '0', 'no', 'off', '')
+
+
+def to_integer(value):
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, long)):
+        return value
+    try:
+        return int(smart_unicode(value).strip())
+    except (ValueError, TypeError):
+        raise ValidationError(u'Enter a whole number.')
+
+
+def to_text(value):
+    return smart_unicode(value)
+
+
+def to_email(value):
+    value = smart_unicode(value).strip()
+    validate_email(value)
+    return value
+
+
+def to_boolean(value):
+    if isinstance(value, basestring):
+        return value.strip().lower() not in FALSE_VALUES
+    return bool(value)
+
+
+def to_null_boolean(value):
+    if value in (True, False):
+        return bool(value)
+    if isinstance(value, basestring):
+        if value.strip().lower() in TRUE_VALUES:
+            return True
+        if value.strip().lower() in FALSE_VALUES:
+            return False
+    return None
+
+
+def choice_converter(choices):
+    valid = set(smart_unicode(key) for key, label in choices)
+
+    def to_choice(value):
+        value = smart_unicode(value)
+        if value not in valid:
+            raise ValidationError(u'Select a valid choice. %s is not one of '
+                u'the available choices.' % value)
+        return value
+    return to_choice
+
+
+# types of values that are already what a converter would return, so
+# loaded values of these types can be left alone
+CONVERTED_TYPES = {
+    'IntegerField': (int, long),
+    'CharField': (unicode,),
+    'TextField': (unicode,),
+    'EmailField': (unicode,),
+    'Dropdown': (unicode,),
+    'NullBooleanField': (bool,),
+    'BooleanField': (bool,),
+}
+
+CONVERTERS = {
+    'IntegerField': to_integer,
+    'CharField': to_text,
+    'TextField': to_text,
+    'EmailField': to_email,
+    'Dropdown': to_text,
+    'NullBooleanField': to_null_boolean,
+    'BooleanField': to_boolean,
+}
+
+
+def compile_converter(field_type, required=False, extra=None):
+    """Returns the converter for one schema field"""
+    convert = CONVERTERS.get(field_type, lambda value: value)
+    if field_type == 'Dropdown' and extra and extra.get('choices'):
+        convert = choice_converter(extra['choices'])
+
+    def converter(value):
+        if value in EMPTY_VALUES:
+            if required:
+                raise ValidationError(u'This field is required.')
+            return None
+        return convert(value)
+    converter.converted_types = CONVERTED_TYPES.get(field_type, (object,))
+    return converter
+
+
+def get_converters(schema):
+    """Returns a {field name: converter} dict for a schema, compiled once
+    per schema instance"""
+    converters = schema.__dict__.get('_converters')
+    if converters is None:
+        converters = dict((field.name, compile_converter(field.field_type,
+            field.required, field.extra)) for field in schema.fields.all())
+        schema.__dict__['_converters'] = converters
+    return converters
+
+
+def convert_values(converters, values):
+    """Converts a {name: value} dict of dynamic values, returns the
+    converted dict and a {name: [messages]} dict of errors"""
+    converted, errors = {}, {}
+    for name, value in values.iteritems():
+        try:
+            converted[name] = converters[name](value)
+        except ValidationError as e:
+            errors[name] = e.messages
+    return converted, errors
+
+
+def clean_concrete_value(field, value):
+    """Cleans a value for a concrete model field, returns the value to set
+    (None for the field's default) or raises ValidationError.
+
+    Related objects aren't looked up, a missing one makes the insert
+    fail instead.
+    """
+    if value in EMPTY_VALUES and not field.empty_strings_allowed:
+        value = None
+    if value is None:
+        if field.has_default() or field.primary_key:
+            return None
+        if not field.null:
+            raise ValidationError(u'This field cannot be null.')
+        return None
+    value = field.to_python(value)
+    if not field.rel:
+        field.validate(value, None)
+    field.run_validators(value)
+    return value
+
+
+def clean_row(model, converters, row, exclude=()):
+    """Validates a {name: value} dict of the concrete and dynamic values of
+    a row, given the converters of its schema.
+
+    Concrete fields named in ``exclude`` are taken as they are. Returns
+    the concrete values by attname and the converted dynamic values, or
+    raises ValidationError with a {name: [messages]} dict.
+    """
+    concrete, errors = {}, {}
+    for field in model._meta.fields:
+        if field.name == 'extra_fields':
+            continue
+        for name in (field.name, field.attname):
+            if name not in row:
+                continue
+            value = row[name]
+            if field.name not in exclude:
+                try:
+                    value = clean_concrete_value(field, value)
+                except ValidationError as e:
+                    errors[field.name] = e.messages
+                    break
+            if value is not None:
+                concrete[field.attname] = value
+            break
+
+    extra_fields, dynamic_errors = convert_values(converters,
+        dict((name, row.get(name)) for name in converters))
+    errors.update(dynamic_errors)
+    concrete_names = model.get_concrete_field_names()
+    for name in row:
+        if name == 'extra_fields' or (name not in concrete_names and
+            name not in converters):
+            errors[name] = [u'Unknown field.']
+    if errors:
+        raise ValidationError(errors)
+    return concrete, extra_fields
+
+
+def convert_rows(converters, rows, strict=False):
+    """Converts the dynamic values of many rows in place, one field at a
+    time.
+
+    ``rows`` are extra_fields dicts of one schema. Values that can't be
+    converted are left as they are, unless ``strict`` is set, in which
+    case ValidationError is raised. Without ``strict``, values that
+    already have the right type aren't checked again, and missing values
+    aren't checked against ``required``.
+    """
+    for name, converter in converters.iteritems():
+        converted_types = () if strict else converter.converted_types
+        for row in rows:
+            value = row.get(name)
+            if not strict and (value is None or
+                type(value) in converted_types):
+                continue
+            try:
+                row[name] = converter(value)
+            except ValidationError as e:
+                if strict:
+                    raise ValidationError({name: e.messages})
+    return rows
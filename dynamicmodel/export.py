@@ -0,0 +1,154 @@
+"""
+Streaming export of dynamic models to CSV and JSON lines.
+
+The exporters are generators of encoded lines, so they can be written to
+a file or passed to an HttpResponse as is. Rows are read with keyset
+pagination on the primary key, one chunk at a time, so memory use
+doesn't grow with the size of the table, and schemas are looked up once
+per chunk. Which stored key goes to which column is worked out once per
+schema, not per row.
+
+CSV files have a column for every concrete field (except extra_fields)
+and for every dynamic field of any of the model's schemas; dynamic
+columns a row's schema doesn't have are left empty. JSON lines hold the
+concrete fields and the dynamic fields of the row's schema.
+"""
+
+import csv
+from collections import OrderedDict
+
+from django.contrib.contenttypes.models import ContentType
+from django.utils.encoding import smart_str
+
+
+class EchoBuffer(object):
+    """File-like object for csv.writer that hands back what is written"""
+
+    def write(self, value):
+        return value
+
+
+def get_concrete_columns(model):
+    return [field.attname for field in model._meta.fields
+        if field.name != 'extra_fields']
+
+
+def get_dynamic_columns(model, using=None):
+    """Names of the dynamic fields of all schemas of a model, in schema
+    and field order"""
+    from .models import DynamicSchemaField
+
+    names = DynamicSchemaField.objects.using(using).filter(
+        schema__model=ContentType.objects.get_for_model(model))\
+        .order_by('schema__id', 'id').values_list('name', flat=True)
+    return list(OrderedDict.fromkeys(names))
+
+
+def iter_chunks(queryset, chunk_size=1000):
+    """Yields the rows of a queryset in chunks of (schema, concrete values,
+    stored extra_fields) tuples, paginating on the primary key.
+
+    The queryset's ordering is replaced by primary key order.
+    """
+    from .models import DynamicSchema
+
+    model = queryset.model
+    field = model._meta.get_field('extra_fields')
+    columns = get_concrete_columns(model)
+    pk_index = columns.index(model._meta.pk.attname)
+    descriptor = model.get_schema_type_descriptor()
+    type_index = columns.index(model._meta.get_field(descriptor).attname) \
+        if descriptor else None
+
+    queryset = queryset.order_by('pk')
+    last_pk = None
+    while True:
+        chunk_qs = queryset if last_pk is None else \
+            queryset.filter(pk__gt=last_pk)
+        rows = list(chunk_qs.values_list(*(columns + ['extra_fields']))
+            [:chunk_size])
+        if not rows:
+            break
+        last_pk = rows[-1][pk_index]
+
+        schemas = DynamicSchema.objects.get_many_for_model(model,
+            set(row[type_index] if type_index is not None else ''
+                for row in rows))
+        chunk = []
+        for row in rows:
+            document = row[-1]
+            if isinstance(document, basestring):
+                document = field.loads(document)
+            chunk.append((schemas[row[type_index]
+                if type_index is not None else ''], row[:-1], document or {}))
+        yield chunk
+        if len(rows) < chunk_size:
+            break
+
+
+class SchemaLayouts(object):
+    """Computes a value once per schema, recomputing it only when the
+    schema is replaced by a new version"""
+
+    def __init__(self, build):
+        self.build = build
+        self._layouts = {}
+
+    def get(self, schema):
+        entry = self._layouts.get(schema.type_value)
+        if entry is None or entry[0] is not schema:
+            entry = self._layouts[schema.type_value] = (schema,
+                self.build(schema))
+        return entry[1]
+
+
+def format_csv_value(value, dumps):
+    if value is None:
+        return ''
+    if isinstance(value, (list, dict)):
+        return dumps(value)
+    return smart_str(value)
+
+
+def export_csv(queryset, chunk_size=1000):
+    """Yields the header and rows of a queryset as CSV lines"""
+    model = queryset.model
+    dumps = model._meta.get_field('extra_fields').dumps
+    concrete_columns = get_concrete_columns(model)
+    dynamic_columns = get_dynamic_columns(model, queryset.db)
+    writer = csv.writer(EchoBuffer())
+    yield writer.writerow(concrete_columns + dynamic_columns)
+
+    positions = dict((name, i) for i, name in enumerate(dynamic_columns))
+    layouts = SchemaLayouts(lambda schema: [(positions[field.name],
+        field.name) for field in schema.fields.all()
+            if field.name in positions])
+    for chunk in iter_chunks(queryset, chunk_size):
+        for schema, values, document in chunk:
+            dynamic_values = [None] * len(dynamic_columns)
+            for i, name in layouts.get(schema):
+                dynamic_values[i] = document.get(name)
+            yield writer.writerow([format_csv_value(value, dumps)
+                for value in list(values) + dynamic_values])
+
+
+def export_jsonl(queryset, chunk_size=1000):
+    """Yields the rows of a queryset as lines of JSON objects"""
+    model = queryset.model
+    dumps = model._meta.get_field('extra_fields').dumps
+    concrete_columns = get_concrete_columns(model)
+    layouts = SchemaLayouts(lambda schema: concrete_columns +
+        [field.name for field in schema.fields.all()
+            if field.name not in concrete_columns])
+    for chunk in iter_chunks(queryset, chunk_size):
+        for schema, values, document in chunk:
+            layout = layouts.get(schema)
+            row = list(values) + [document.get(name)
+                for name in layout[len(values):]]
+            yield smart_str(dumps(OrderedDict(zip(layout, row)))) + '\n'
+
+
+EXPORTERS = {
+    'csv': export_csv,
+    'jsonl': export_jsonl,
+}
@@ -26,6 +26,8 @@
 # WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 
+from collections import MutableMapping
+
 from django.db import models
 from django.core.serializers.json import DjangoJSONEncoder
 from django.utils import simplejson as json
@@ -34,6 +36,9 @@ from django.utils.translation import ugettext_lazy as _
 from django.forms.fields import Field
 from django.forms.util import ValidationError as FormValidationError
 
+from .backends import get_backend
+from .jsoncodecs import JSONCodec, get_codec
+
 
 class JSONFormField(Field):
     def clean(self, value):
@@ -51,39 +56,149 @@ class JSONFormField(Field):
         return value
 
 
-class JSONFieldBase(object):
+class LazyJSON(MutableMapping):
+    """Mapping that keeps the raw JSON text and decodes it on first use.
+
+    Until it is decoded, the field writes the raw text back to the database
+    unchanged. ``on_load`` is called with the mapping right after decoding.
+    LazyJSON only lives in the instance __dict__; reading the field
+    attribute decodes it and returns the plain dict, see JSONDescriptor.
+    """
+
+    def __init__(self, raw, loads):
+        self.raw = raw
+        self.on_load = None
+        self._loads = loads
+        self._data = None
+
+    @property
+    def loaded(self):
+        return self._data is not None
+
+    def _get_data(self):
+        if self._data is None:
+            self._data = self._loads(self.raw)
+            if self.on_load is not None:
+                on_load, self.on_load = self.on_load, None
+                on_load(self)
+        return self._data
+
+    def __getitem__(self, key):
+        return self._get_data()[key]
+
+    def __setitem__(self, key, value):
+        self._get_data()[key] = value
+
+    def __delitem__(self, key):
+        del self._get_data()[key]
+
+    def __contains__(self, key):
+        return key in self._get_data()
+
+    def __iter__(self):
+        return iter(self._get_data())
+
+    def __len__(self):
+        return len(self._get_data())
+
+    def __repr__(self):
+        return repr(self._get_data())
+
+    def __reduce__(self):
+        # pickled and copied values are always decoded
+        return (dict, (self._get_data(),))
+
+
+class JSONDescriptor(object):
+    """Calls to_python() on assignment, like SubfieldBase does, and hands
+    out decoded values of lazy fields as plain dicts"""
 
-    # Used so to_python() is called
-    __metaclass__ = models.SubfieldBase
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, obj, type=None):
+        if obj is None:
+            raise AttributeError('Can only be accessed via an instance.')
+        value = obj.__dict__[self.field.name]
+        if isinstance(value, LazyJSON):
+            value = value._get_data()
+            obj.__dict__[self.field.name] = value
+        return value
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.field.name] = self.field.to_python(value)
+
+
+class JSONFieldBase(object):
 
     def __init__(self, *args, **kwargs):
+        custom_kwargs = 'dump_kwargs' in kwargs or 'load_kwargs' in kwargs
         self.dump_kwargs = kwargs.pop('dump_kwargs', {'cls': DjangoJSONEncoder})
         self.load_kwargs = kwargs.pop('load_kwargs', {})
+        self.lazy = kwargs.pop('lazy', False)
+        self.native = kwargs.pop('native', False)
+
+        # explicit dump/load kwargs only make sense for the stdlib codec
+        self._codec = kwargs.pop('codec', None)
+        if self._codec is None and custom_kwargs:
+            self._codec = JSONCodec(self.dump_kwargs, self.load_kwargs)
 
         super(JSONFieldBase, self).__init__(*args, **kwargs)
 
+    def contribute_to_class(self, cls, name):
+        super(JSONFieldBase, self).contribute_to_class(cls, name)
+        setattr(cls, self.name, JSONDescriptor(self))
+
+    def db_type(self, connection):
+        if self.native:
+            return get_backend(connection).native_column_type
+        return super(JSONFieldBase, self).db_type(connection)
+
+    @property
+    def codec(self):
+        return self._codec or get_codec()
+
+    def loads(self, value):
+        try:
+            return self.codec.loads(value)
+        except ValueError:
+            raise ValueError("%s field got non-valid JSON" % self.name)
+
+    def dumps(self, value):
+        if isinstance(value, LazyJSON):
+            if not value.loaded:
+                return value.raw
+            value = value._get_data()
+        return self.codec.dumps(value)
+
     def to_python(self, value):
         """Convert string value to JSON"""
         if isinstance(value, basestring):
-            try:
-                return json.loads(value, **self.load_kwargs)
-            except ValueError:
-                raise ValueError("%s field got non-valid JSON" % self.name)
+            if self.lazy:
+                return LazyJSON(value, self.loads)
+            return self.loads(value)
         return value
 
+    def pre_save(self, model_instance, add):
+        # undecoded lazy values are written back as they are
+        value = model_instance.__dict__.get(self.attname)
+        if isinstance(value, LazyJSON):
+            return value
+        return super(JSONFieldBase, self).pre_save(model_instance, add)
+
     def get_db_prep_value(self, value, connection, prepared=False):
         """Convert JSON object to a string"""
 
         if isinstance(value, basestring):
             return value
-        return json.dumps(value, **self.dump_kwargs)
+        return self.dumps(value)
 
     def value_to_string(self, obj):
         value = self._get_val_from_obj(obj)
         return self.get_prep_value(value)
 
     def value_from_object(self, obj):
-        return json.dumps(super(JSONFieldBase, self).value_from_object(obj))
+        return self.dumps(super(JSONFieldBase, self).value_from_object(obj))
 
     def formfield(self, **kwargs):
 
@@ -110,6 +225,8 @@ class JSONCharField(JSONFieldBase, models.CharField):
 
 try:
     from south.modelsinspector import add_introspection_rules
-    add_introspection_rules([], ["^dynamicmodel\.fields\.(JSONField|JSONCharField)"])
+    add_introspection_rules([
+        ((JSONFieldBase,), [], {'native': ['native', {'default': False}]}),
+    ], ["^dynamicmodel\.fields\.(JSONField|JSONCharField)"])
 except ImportError:
     pass
@@ -0,0 +1,272 @@
+"""
+Bulk import of CSV and JSON lines files into dynamic models.
+
+Columns are mapped to concrete fields and to the dynamic fields of the
+row's schema. Rows are validated with clean_row(), like rows of
+bulk_create_dynamic(), with converters compiled once per schema, and
+valid rows are inserted in batches, each in its own transaction. If the
+database refuses a batch, its rows are inserted one at a time. Rows that
+don't validate or can't be inserted are skipped and, if an errors file
+is given, written to it as JSON lines with the record number, the record
+and the error messages.
+
+Parsing and validation can run in a pool of worker processes, while the
+importing process does all the database writes. The workers only get the
+field definitions of the schemas, so they don't touch the database.
+"""
+
+from itertools import islice
+import csv
+import json
+import multiprocessing
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
+from django.db import transaction, DatabaseError, DEFAULT_DB_ALIAS
+from django.utils.encoding import force_unicode
+
+from .converters import compile_converter, clean_row
+
+
+def read_csv(f):
+    """Returns the header and an iterator over the rows of a CSV file"""
+    reader = csv.reader(f)
+    try:
+        header = [name.decode('utf-8') for name in next(reader)]
+    except StopIteration:
+        header = []
+    return header, reader
+
+
+def read_jsonl(f):
+    return None, (line for line in f if line.strip())
+
+
+READERS = {
+    'csv': read_csv,
+    'jsonl': read_jsonl,
+}
+
+
+class RecordValidator(object):
+    """Turns parsed records into field values for one model.
+
+    ``field_specs`` maps type values to lists of (name, field_type,
+    required, extra) tuples of their schema fields. ``mapping`` maps
+    column names to field names; without it columns are named after the
+    fields. Validators are pickled without their compiled converters, so
+    they can be sent to worker processes.
+    """
+
+    def __init__(self, model, field_specs, header=None, mapping=None):
+        self.model = model
+        self.field_specs = field_specs
+        self.header = header
+        self.mapping = mapping
+        self._converters = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_converters'] = {}
+        return state
+
+    def get_converters(self, type_value):
+        converters = self._converters.get(type_value)
+        if converters is None:
+            converters = self._converters[type_value] = dict(
+                (name, compile_converter(field_type, required, extra))
+                for name, field_type, required, extra in
+                    self.field_specs[type_value])
+        return converters
+
+    def parse(self, item):
+        """Returns the record for a CSV row or a JSON line"""
+        if self.header is None:
+            try:
+                record = json.loads(item)
+            except ValueError:
+                raise ValidationError({'__all__': [u'Invalid JSON.']})
+            if not isinstance(record, dict):
+                raise ValidationError({'__all__': [u'Expected an object.']})
+            return record
+        if len(item) != len(self.header):
+            raise ValidationError({'__all__': [u'Expected %d columns, got '
+                u'%d.' % (len(self.header), len(item))]})
+        return dict(zip(self.header, [value.decode('utf-8')
+            for value in item]))
+
+    def validate(self, record):
+        """Returns the (type value, concrete values, dynamic values) of a
+        record, or raises ValidationError"""
+        if self.mapping is not None:
+            record = dict((self.mapping[column], value)
+                for column, value in record.iteritems()
+                if column in self.mapping)
+
+        descriptor = self.model.get_schema_type_descriptor()
+        type_value = ''
+        if descriptor:
+            type_value = record.get(descriptor,
+                self.model._meta.get_field(descriptor).get_default())
+        if type_value not in self.field_specs:
+            raise ValidationError({descriptor or '__all__':
+                [u"No schema for type '%s'." % type_value]})
+        # the type value has been checked against the schemas
+        concrete, extra_fields = clean_row(self.model,
+            self.get_converters(type_value), record, exclude=[descriptor])
+        return type_value, concrete, extra_fields
+
+    def validate_batch(self, batch):
+        """Validates (number, item) pairs, returns (number, item, values,
+        errors) tuples"""
+        results = []
+        for number, item in batch:
+            try:
+                values = self.validate(self.parse(item))
+                results.append((number, item, values, None))
+            except ValidationError as e:
+                results.append((number, item, None, e.message_dict))
+        return results
+
+
+_worker_validator = None
+
+
+def _init_worker(validator):
+    global _worker_validator
+    _worker_validator = validator
+
+
+def _validate_in_worker(batch):
+    return _worker_validator.validate_batch(batch)
+
+
+class Importer(object):
+    """Imports CSV or JSON lines into a dynamic model.
+
+    ``errors`` is a file-like object rejected records are written to.
+    With ``processes`` set, parsing and validation run in a pool of that
+    many worker processes.
+    """
+
+    def __init__(self, model, format='csv', mapping=None, batch_size=500,
+        errors=None, processes=0, using=None):
+
+        if format not in READERS:
+            raise ValueError("Unknown format: %s" % format)
+        self.model = model
+        self.format = format
+        self.mapping = mapping
+        self.batch_size = batch_size
+        self.errors = errors
+        self.processes = processes
+        self.using = using or DEFAULT_DB_ALIAS
+
+    def get_schemas(self):
+        """Returns a {type_value: schema} dict of the model's schemas"""
+        from .models import DynamicSchema
+
+        if not self.model.get_schema_type_descriptor():
+            DynamicSchema.get_for_model(self.model)
+        return dict((schema.type_value or '', schema) for schema in
+            DynamicSchema.objects.using(self.using).filter(
+                model=ContentType.objects.get_for_model(self.model))
+                .prefetch_related('fields'))
+
+    def get_batches(self, items):
+        numbered = enumerate(items, 1)
+        while True:
+            batch = list(islice(numbered, self.batch_size))
+            if not batch:
+                break
+            yield batch
+
+    def write_rejects(self, rejects):
+        if self.errors is None:
+            return
+        for number, item, errors in rejects:
+            if isinstance(item, list):
+                data = [value.decode('utf-8', 'replace') for value in item]
+            else:
+                data = item.decode('utf-8', 'replace').rstrip('\r\n')
+            self.errors.write(json.dumps({'record': number, 'data': data,
+                'errors': dict((name, [force_unicode(message)
+                    for message in messages])
+                    for name, messages in errors.iteritems())}) + '\n')
+
+    def insert(self, schemas, results):
+        """Inserts the valid rows of a validated batch in one transaction,
+        or one row at a time if that fails, returns the number of rows
+        inserted"""
+        rows, rejects = [], []
+        for number, item, values, errors in results:
+            if errors:
+                rejects.append((number, item, errors))
+                continue
+            type_value, concrete, extra_fields = values
+            rows.append((number, item, self.model(_schema=schemas[type_value],
+                extra_fields=extra_fields, **concrete)))
+
+        inserted = len(rows)
+        if rows:
+            try:
+                with transaction.commit_on_success(using=self.using):
+                    self.get_manager().bulk_create(
+                        [obj for number, item, obj in rows])
+            except DatabaseError:
+                inserted = self.insert_rows(rows, rejects)
+        self.write_rejects(sorted(rejects))
+        return inserted
+
+    def insert_rows(self, rows, rejects):
+        """Inserts (number, item, instance) rows one at a time, each in a
+        savepoint, adding the ones the database refuses to ``rejects``.
+        Returns the number of rows inserted."""
+        inserted = 0
+        with transaction.commit_on_success(using=self.using):
+            for number, item, obj in rows:
+                sid = transaction.savepoint(using=self.using)
+                try:
+                    self.get_manager().bulk_create([obj])
+                except DatabaseError as e:
+                    transaction.savepoint_rollback(sid, using=self.using)
+                    rejects.append((number, item,
+                        {'__all__': [force_unicode(e)]}))
+                else:
+                    transaction.savepoint_commit(sid, using=self.using)
+                    inserted += 1
+        return inserted
+
+    def get_manager(self):
+        return self.model._base_manager.db_manager(self.using)
+
+    def run(self, f):
+        """Imports the records of an open file, returns the number of
+        imported and rejected records"""
+        schemas = self.get_schemas()
+        field_specs = dict((type_value, [(field.name, field.field_type,
+            field.required, field.extra) for field in schema.fields.all()])
+            for type_value, schema in schemas.iteritems())
+        header, items = READERS[self.format](f)
+        validator = RecordValidator(self.model, field_specs, header,
+            self.mapping)
+
+        batches = self.get_batches(items)
+        pool = None
+        if self.processes:
+            pool = multiprocessing.Pool(self.processes, _init_worker,
+                (validator,))
+            results = pool.imap(_validate_in_worker, batches)
+        else:
+            results = (validator.validate_batch(batch) for batch in batches)
+
+        imported = rejected = 0
+        try:
+            for batch_results in results:
+                count = self.insert(schemas, batch_results)
+                imported += count
+                rejected += len(batch_results) - count
+        finally:
+            if pool is not None:
+                pool.terminate()
+        return imported, rejected
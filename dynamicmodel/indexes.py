@@ -0,0 +1,93 @@
+"""
+Expression indexes on dynamic fields.
+
+Fields with ``indexed`` set in their ``extra`` get an index on the same
+expression ``dyn__`` lookups compile to. For models with a schema type
+descriptor the index is partial, limited to rows of the field's schema,
+so queries have to filter on the type as well to use it. Where partial
+indexes aren't usable with bound parameters (SQLite), the type column is
+the leading column of the index instead.
+"""
+
+import hashlib
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections
+
+from .backends import get_backend, check_key
+
+
+INDEX_PREFIX = 'dynidx_'
+
+
+def get_index_name(table, field, type_value=None, partial=False):
+    key = u"%s:%s:%s" % (table, field.name, field.field_type)
+    if partial:
+        key += u":%s" % type_value
+    digest = hashlib.md5(key.encode('utf-8')).hexdigest()
+    return "%s%s" % (INDEX_PREFIX, digest[:20])
+
+
+def get_dynamic_indexes(model, using):
+    """Returns a {name: CREATE INDEX statement} dict for all indexed dynamic
+    fields of a model"""
+    from .models import DynamicSchema
+
+    backend = get_backend(connections[using])
+    table = model._meta.db_table
+    extra_field = model._meta.get_field('extra_fields')
+    column_sql = backend.quote_name(extra_field.column)
+    descriptor = model.get_schema_type_descriptor()
+
+    indexes = {}
+    for schema in DynamicSchema.objects.using(using).filter(
+        model=ContentType.objects.get_for_model(model))\
+        .prefetch_related('fields'):
+
+        columns, where = [], None
+        partial = bool(descriptor) and backend.supports_partial_indexes
+        if descriptor:
+            type_column = backend.quote_name(
+                model._meta.get_field(descriptor).column)
+            if not partial:
+                columns.append(type_column)
+            elif schema.type_value is None:
+                where = "%s IS NULL" % type_column
+            else:
+                where = "%s = %s" % (type_column,
+                    backend.quote_value(schema.type_value))
+
+        for field in schema.fields.all():
+            if not (field.extra or {}).get('indexed'):
+                continue
+            try:
+                check_key(field.name)
+            except ValueError:
+                raise ValueError("Can't index dynamic field %r of %s, names "
+                    "can only contain letters, digits and underscores" % (
+                        field.name, schema))
+            name = get_index_name(table, field, schema.type_value, partial)
+            expression = backend.extract_sql(column_sql, field.name,
+                field.field_type, extra_field.native)
+            indexes[name] = backend.create_index_sql(name, table,
+                columns + [expression], where)
+    return indexes
+
+
+def sync_dynamic_indexes(model, using, drop_all=False):
+    """Creates missing dynamic field indexes of a model and drops the ones
+    that are no longer needed (all of them with drop_all). Returns lists of
+    created and dropped index names."""
+    backend = get_backend(connections[using])
+    wanted = {} if drop_all else get_dynamic_indexes(model, using)
+    existing = [name for name in backend.index_names(model._meta.db_table)
+        if name.startswith(INDEX_PREFIX)]
+
+    cursor = connections[using].cursor()
+    dropped = [name for name in existing if name not in wanted]
+    for name in dropped:
+        cursor.execute(backend.drop_index_sql(name))
+    created = sorted(name for name in wanted if name not in existing)
+    for name in created:
+        cursor.execute(wanted[name])
+    return created, dropped
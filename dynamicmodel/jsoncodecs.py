@@ -0,0 +1,168 @@
+"""
+JSON codecs used by JSONField and JSONCharField.
+
+The codec is picked with the ``DYNAMICMODEL_JSON_CODEC`` setting, a dotted
+path to a codec class. Codecs whose library isn't installed fall back to
+the standard ``JSONCodec``. All codecs encode dates, times and decimals
+the same way ``DjangoJSONEncoder`` does, so values written by one codec
+read back identically with any other.
+"""
+
+from collections import OrderedDict
+import datetime
+import decimal
+import inspect
+import warnings
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import simplejson as json
+from django.utils.importlib import import_module
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+DEFAULT_CODEC = 'dynamicmodel.jsoncodecs.JSONCodec'
+
+_django_encoder = DjangoJSONEncoder()
+
+# django.utils.simplejson is the installed simplejson when there is one,
+# and simplejson 2.1+ encodes decimals as numbers unless told not to
+_has_use_decimal = 'use_decimal' in inspect.getargspec(json.dumps).args
+
+
+def encode_default(value):
+    """Encodes values the JSON libraries don't know about, the same way
+    DjangoJSONEncoder does"""
+    return _django_encoder.default(value)
+
+
+class JSONCodec(object):
+    """Codec using django.utils.simplejson and DjangoJSONEncoder"""
+
+    available = True
+
+    def __init__(self, dump_kwargs=None, load_kwargs=None):
+        if dump_kwargs is None:
+            dump_kwargs = {'cls': DjangoJSONEncoder}
+        if _has_use_decimal and 'use_decimal' not in dump_kwargs:
+            dump_kwargs = dict(dump_kwargs, use_decimal=False)
+        self.dump_kwargs = dump_kwargs
+        self.load_kwargs = load_kwargs or {}
+
+    def dumps(self, value):
+        return json.dumps(value, **self.dump_kwargs)
+
+    def loads(self, value):
+        return json.loads(value, **self.load_kwargs)
+
+
+class NotEncodable(Exception):
+    """Raised for values UJSONCodec leaves to the default codec"""
+
+
+# types ujson encodes like the standard library does
+_UJSON_TYPES = frozenset([unicode, str, int, long, bool, type(None)])
+# common types encoded like DjangoJSONEncoder does, without going through
+# encode_default()
+_UJSON_CONVERTERS = {
+    datetime.date: datetime.date.isoformat,
+    decimal.Decimal: str,
+}
+
+
+def prepare_for_ujson(value):
+    """Returns value with dates, times and decimals encoded by
+    encode_default(), which ujson has no hook for, copying only the
+    containers that change. Raises NotEncodable for floats, which ujson
+    rounds, and ordered dicts, whose order it drops."""
+    value_type = type(value)
+    if value_type in _UJSON_TYPES:
+        return value
+    if isinstance(value, dict):
+        if isinstance(value, OrderedDict):
+            raise NotEncodable
+        prepared = None
+        for key, item in value.iteritems():
+            item_type = type(item)
+            if item_type not in _UJSON_TYPES:
+                if prepared is None:
+                    prepared = dict(value)
+                convert = _UJSON_CONVERTERS.get(item_type, prepare_for_ujson)
+                prepared[key] = convert(item)
+        return value if prepared is None else prepared
+    if isinstance(value, (list, tuple)):
+        prepared = None
+        for i, item in enumerate(value):
+            if type(item) not in _UJSON_TYPES:
+                if prepared is None:
+                    prepared = list(value)
+                prepared[i] = prepare_for_ujson(item)
+        return value if prepared is None else prepared
+    if isinstance(value, float):
+        raise NotEncodable
+    if value_type in _UJSON_CONVERTERS:
+        return _UJSON_CONVERTERS[value_type](value)
+    if isinstance(value, (basestring, int, long)):
+        return value
+    return encode_default(value)
+
+
+class UJSONCodec(object):
+    """Codec using ujson, which encodes and decodes faster than JSONCodec.
+
+    Documents ujson can't encode or decode exactly, those with floats,
+    ordered dicts or integers beyond 64 bits, go through JSONCodec.
+    """
+
+    available = ujson is not None
+
+    def __init__(self):
+        self.fallback = JSONCodec()
+
+    def dumps(self, value):
+        try:
+            return ujson.dumps(prepare_for_ujson(value),
+                escape_forward_slashes=False)
+        except (NotEncodable, OverflowError):
+            return self.fallback.dumps(value)
+
+    def loads(self, value):
+        try:
+            return ujson.loads(value, precise_float=True)
+        except (ValueError, OverflowError):
+            # integers too big for ujson, or invalid JSON, which the
+            # default codec reports
+            return self.fallback.loads(value)
+
+
+_codecs = {}
+
+
+def load_codec(path):
+    """Returns a codec instance for a dotted path to a codec class, falling
+    back to JSONCodec if the codec's library isn't available"""
+    module_name, _, class_name = path.rpartition('.')
+    try:
+        codec_class = getattr(import_module(module_name), class_name)
+    except (ImportError, AttributeError, ValueError):
+        raise ImproperlyConfigured("Can't import JSON codec '%s'" % path)
+
+    if not getattr(codec_class, 'available', True):
+        warnings.warn("JSON codec '%s' is not available, falling back to "
+            "'%s'" % (path, DEFAULT_CODEC))
+        return JSONCodec()
+    return codec_class()
+
+
+def get_codec():
+    """Returns the codec configured by DYNAMICMODEL_JSON_CODEC"""
+    path = getattr(settings, 'DYNAMICMODEL_JSON_CODEC', DEFAULT_CODEC)
+    codec = _codecs.get(path)
+    if codec is None:
+        codec = _codecs[path] = load_codec(path)
+    return codec
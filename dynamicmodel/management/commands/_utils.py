@@ -0,0 +1,26 @@
+from django.core.management.base import CommandError
+from django.db import models
+
+from dynamicmodel.models import DynamicModel
+
+
+def get_dynamic_model(label):
+    """Returns the dynamic model for an 'app_label.ModelName' label"""
+    try:
+        app_label, model_name = label.split('.')
+    except ValueError:
+        raise CommandError("Model should be given as app_label.ModelName, "
+            "got '%s'" % label)
+    model = models.get_model(app_label, model_name)
+    if model is None or not issubclass(model, DynamicModel):
+        raise CommandError("'%s' is not a dynamic model" % label)
+    return model
+
+
+def get_dynamic_models(labels):
+    """Returns the dynamic models for the given labels, or all installed
+    dynamic models if there are none"""
+    if labels:
+        return [get_dynamic_model(label) for label in labels]
+    return [model for model in models.get_models()
+        if issubclass(model, DynamicModel)]
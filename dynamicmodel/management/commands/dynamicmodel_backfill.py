@@ -0,0 +1,88 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from dynamicmodel.backfill import (Backfill, RemoveField, RenameField,
+    ConvertField)
+from dynamicmodel.converters import CONVERTERS
+
+from ._utils import get_dynamic_model
+
+
+def split_pair(value, option):
+    try:
+        first, second = value.split(':')
+    except ValueError:
+        raise CommandError("%s should be given as a:b, got '%s'" % (
+            option, value))
+    return first, second
+
+
+class Command(BaseCommand):
+    args = 'app_label.ModelName'
+    help = ("Rewrites the stored dynamic values of a model after schema "
+        "changes: removes, renames or converts fields in chunks of rows, "
+        "in the rows whose schema calls for it.")
+    option_list = BaseCommand.option_list + (
+        make_option('--remove', action='append', dest='remove',
+            default=[], help='Field to remove. Can be repeated.'),
+        make_option('--rename', action='append', dest='rename',
+            default=[], help='Field to rename, as old:new. Can be '
+                'repeated.'),
+        make_option('--convert', action='append', dest='convert',
+            default=[], help='Field to convert, as name:FieldType. Can be '
+                'repeated.'),
+        make_option('--type', action='store', dest='type_value',
+            default=None, help='Only rewrite rows of the schema with this '
+                'type value.'),
+        make_option('--chunk-size', action='store', dest='chunk_size',
+            type='int', default=1000, help='Number of rows rewritten in '
+                'one transaction.'),
+        make_option('--sleep', action='store', dest='throttle',
+            type='float', default=0, help='Seconds to sleep between '
+                'chunks.'),
+        make_option('--checkpoint', action='store', dest='checkpoint',
+            default=None, help='File to record progress in, so an '
+                'interrupted run can be resumed.'),
+        make_option('--database', action='store', dest='database',
+            default=DEFAULT_DB_ALIAS, help='Nominates a database. '
+                'Defaults to the "default" database.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give exactly one app_label.ModelName")
+        model = get_dynamic_model(args[0])
+        verbosity = int(options['verbosity'])
+
+        operations = [RemoveField(name) for name in options['remove']]
+        operations.extend(RenameField(*split_pair(value, '--rename'))
+            for value in options['rename'])
+        for value in options['convert']:
+            name, field_type = split_pair(value, '--convert')
+            if field_type not in CONVERTERS:
+                raise CommandError("Unknown field type: %s" % field_type)
+            operations.append(ConvertField(name, field_type))
+        if not operations:
+            raise CommandError("Nothing to do, give --remove, --rename or "
+                "--convert")
+
+        def progress(position, max_pk, changed):
+            if verbosity >= 2:
+                self.stdout.write("%s: up to pk %s of %s, %d rows changed\n"
+                    % (model._meta.db_table, position, max_pk, changed))
+
+        try:
+            backfill = Backfill(model, operations,
+                type_value=options['type_value'],
+                chunk_size=options['chunk_size'],
+                throttle=options['throttle'],
+                checkpoint=options['checkpoint'], progress=progress,
+                using=options['database'])
+            changed = backfill.run()
+        except ValueError as e:
+            raise CommandError(str(e))
+        if verbosity >= 1:
+            self.stdout.write("%s: %d rows changed\n" % (
+                model._meta.db_table, changed))
@@ -0,0 +1,55 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from dynamicmodel.export import EXPORTERS
+
+from ._utils import get_dynamic_model
+
+
+class Command(BaseCommand):
+    args = 'app_label.ModelName'
+    help = ("Exports the rows of a dynamic model with the dynamic fields "
+        "as separate columns, as CSV or JSON lines.")
+    option_list = BaseCommand.option_list + (
+        make_option('--format', action='store', dest='format',
+            default='csv', help='Output format: %s. Defaults to csv.' %
+                ', '.join(sorted(EXPORTERS))),
+        make_option('--output', action='store', dest='output',
+            default=None, help='File to write to. Defaults to standard '
+                'output.'),
+        make_option('--type', action='store', dest='type_value',
+            default=None, help='Only export rows of the schema with this '
+                'type value.'),
+        make_option('--chunk-size', action='store', dest='chunk_size',
+            type='int', default=1000, help='Number of rows read per '
+                'query.'),
+        make_option('--database', action='store', dest='database',
+            default=DEFAULT_DB_ALIAS, help='Nominates a database. '
+                'Defaults to the "default" database.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give exactly one app_label.ModelName")
+        model = get_dynamic_model(args[0])
+        if options['format'] not in EXPORTERS:
+            raise CommandError("Unknown format: %s" % options['format'])
+
+        queryset = model._default_manager.using(options['database'])
+        if options['type_value'] is not None:
+            descriptor = model.get_schema_type_descriptor()
+            if not descriptor:
+                raise CommandError("%s has no schema type descriptor" %
+                    model.__name__)
+            queryset = queryset.filter(**{descriptor: options['type_value']})
+
+        lines = EXPORTERS[options['format']](queryset,
+            chunk_size=options['chunk_size'])
+        if options['output']:
+            with open(options['output'], 'wb') as f:
+                f.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line)
@@ -0,0 +1,67 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from dynamicmodel.importer import Importer, READERS
+
+from ._utils import get_dynamic_model
+
+
+class Command(BaseCommand):
+    args = 'app_label.ModelName file'
+    help = ("Imports a CSV or JSON lines file into a dynamic model, "
+        "validating the dynamic fields against the schemas.")
+    option_list = BaseCommand.option_list + (
+        make_option('--format', action='store', dest='format',
+            default='csv', help='Input format: %s. Defaults to csv.' %
+                ', '.join(sorted(READERS))),
+        make_option('--map', action='append', dest='mapping', default=[],
+            help='Column to import, as column:field_name. Can be repeated; '
+                'without it all columns are imported under their own '
+                'names.'),
+        make_option('--errors', action='store', dest='errors',
+            default=None, help='File to write rejected records to.'),
+        make_option('--batch-size', action='store', dest='batch_size',
+            type='int', default=500, help='Number of records inserted in '
+                'one transaction.'),
+        make_option('--processes', action='store', dest='processes',
+            type='int', default=0, help='Number of worker processes for '
+                'parsing and validation. Defaults to none.'),
+        make_option('--database', action='store', dest='database',
+            default=DEFAULT_DB_ALIAS, help='Nominates a database. '
+                'Defaults to the "default" database.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError("Give an app_label.ModelName and a file")
+        model = get_dynamic_model(args[0])
+        if options['format'] not in READERS:
+            raise CommandError("Unknown format: %s" % options['format'])
+
+        mapping = None
+        if options['mapping']:
+            mapping = {}
+            for value in options['mapping']:
+                try:
+                    column, name = value.split(':')
+                except ValueError:
+                    raise CommandError("--map should be given as "
+                        "column:field_name, got '%s'" % value)
+                mapping[column] = name
+
+        errors = open(options['errors'], 'w') if options['errors'] else None
+        try:
+            with open(args[1], 'rb') as f:
+                imported, rejected = Importer(model,
+                    format=options['format'], mapping=mapping,
+                    batch_size=options['batch_size'], errors=errors,
+                    processes=options['processes'],
+                    using=options['database']).run(f)
+        finally:
+            if errors is not None:
+                errors.close()
+        if int(options['verbosity']) >= 1:
+            self.stdout.write("%s: %d records imported, %d rejected\n" % (
+                model._meta.db_table, imported, rejected))
@@ -0,0 +1,37 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction, DEFAULT_DB_ALIAS
+
+from dynamicmodel.indexes import sync_dynamic_indexes
+
+from ._utils import get_dynamic_models
+
+
+class Command(BaseCommand):
+    args = '[app_label.ModelName ...]'
+    help = ("Creates expression indexes for dynamic fields that have "
+        "'indexed' set in their extra, and drops indexes of fields that "
+        "no longer have it.")
+    option_list = BaseCommand.option_list + (
+        make_option('--drop', action='store_true', dest='drop',
+            default=False, help='Drop all dynamic field indexes.'),
+        make_option('--database', action='store', dest='database',
+            default=DEFAULT_DB_ALIAS, help='Nominates a database. '
+                'Defaults to the "default" database.'),
+    )
+
+    def handle(self, *args, **options):
+        using = options['database']
+        verbosity = int(options['verbosity'])
+
+        with transaction.commit_on_success(using=using):
+            for model in get_dynamic_models(args):
+                try:
+                    created, dropped = sync_dynamic_indexes(model, using,
+                        drop_all=options['drop'])
+                except ValueError as e:
+                    raise CommandError(str(e))
+                if verbosity >= 1:
+                    self.stdout.write("%s: created %d, dropped %d indexes\n"
+                        % (model._meta.db_table, len(created), len(dropped)))
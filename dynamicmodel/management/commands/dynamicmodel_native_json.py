@@ -0,0 +1,52 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+
+from dynamicmodel.backends import get_backend
+
+from ._utils import get_dynamic_models
+
+
+class Command(BaseCommand):
+    args = '[app_label.ModelName ...]'
+    help = ("Converts the extra_fields column of dynamic models (all of "
+        "them by default) to the database's native JSON type. Set "
+        "DYNAMICMODEL_NATIVE_JSON = True once the conversion is done.")
+    option_list = BaseCommand.option_list + (
+        make_option('--reverse', action='store_true', dest='reverse',
+            default=False, help='Convert the columns back to text.'),
+        make_option('--database', action='store', dest='database',
+            default=DEFAULT_DB_ALIAS, help='Nominates a database to convert. '
+                'Defaults to the "default" database.'),
+    )
+
+    def handle(self, *args, **options):
+        using = options['database']
+        native = not options['reverse']
+        verbosity = int(options['verbosity'])
+
+        backend = get_backend(connections[using])
+        backend.check()
+
+        with transaction.commit_on_success(using=using):
+            cursor = connections[using].cursor()
+            for model in get_dynamic_models(args):
+                table = model._meta.db_table
+                column = model._meta.get_field('extra_fields').column
+
+                invalid_rows_sql = backend.invalid_rows_sql(table, column)
+                if native and invalid_rows_sql:
+                    cursor.execute(invalid_rows_sql)
+                    invalid = cursor.fetchone()[0]
+                    if invalid:
+                        raise CommandError("%s has %d rows with invalid JSON "
+                            "in %s" % (table, invalid, column))
+
+                for sql in backend.convert_column_sql(table, column, native):
+                    cursor.execute(sql)
+
+                if verbosity >= 1:
+                    self.stdout.write("Converted %s.%s to %s\n" % (table,
+                        column, backend.native_column_type if native
+                        else 'text'))
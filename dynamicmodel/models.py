@@ -1,10 +1,479 @@
-from django.db import models
+from django.db import models, connections, router, transaction, \
+    DatabaseError, IntegrityError
+from django.db.models import signals, Q
+from django.db.models.query import ValuesQuerySet, ValuesListQuerySet
+from django.db.models.sql import DeleteQuery
 from django import forms
 from django.contrib.contenttypes.models import ContentType
 from django.core.validators import RegexValidator
-from .fields import JSONField
-from django.core.exceptions import ValidationError
+from .fields import JSONField, LazyJSON
+from django.core.exceptions import ValidationError, FieldError
 from django.core.cache import cache
+from django.conf import settings
+from collections import OrderedDict
+from itertools import islice
+import copy
+import operator
+import time
+
+from .backends import get_backend, KEY_RE
+from .cache import LocalSchemaCache
+from .converters import get_converters, convert_rows, compile_converter, \
+    clean_row
+from .query import DynamicLookupCompiler, DynamicAggregate, DynamicF, \
+    DynamicAggregateQuery, is_dynamic_lookup, is_dynamic_ordering, \
+    is_dynamic_ordering_alias, get_dynamic_ordering_aliases
+
+
+local_schema_cache = LocalSchemaCache(
+    getattr(settings, 'DYNAMICMODEL_LOCAL_CACHE_SIZE', 1000))
+
+# how long (in seconds) a process may rebuild a cached schema before others
+# stop waiting for it
+SCHEMA_LOCK_TIMEOUT = getattr(settings, 'DYNAMICMODEL_SCHEMA_LOCK_TIMEOUT', 5)
+SCHEMA_LOCK_POLL_INTERVAL = 0.05
+
+
+def initial_schema_version():
+    """Starting value of a schema version counter. Time based, so that a
+    counter evicted from the cache doesn't start over at a version some
+    worker still has cached."""
+    return int(time.time() * 1000)
+
+
+class DynamicModelQuerySet(models.query.QuerySet):
+    # the field types of the model's dynamic fields, looked up once per
+    # chain of clones
+    _dynamic_field_types = None
+
+    def _clone(self, klass=None, setup=False, **kwargs):
+        kwargs.setdefault('_dynamic_field_types', self._dynamic_field_types)
+        return super(DynamicModelQuerySet, self)._clone(klass, setup,
+            **kwargs)
+
+    def _pop_dynamic_lookups(self, kwargs):
+        return dict((key, kwargs.pop(key)) for key in kwargs.keys()
+            if is_dynamic_lookup(key))
+
+    def get_dynamic_field_types(self):
+        if self._dynamic_field_types is None:
+            self._dynamic_field_types = \
+                DynamicSchema.objects.get_field_types(self.model)
+        return self._dynamic_field_types
+
+    def get_dynamic_compiler(self):
+        return DynamicLookupCompiler(self.model, connections[self.db],
+            self.get_dynamic_field_types())
+
+    def filter(self, *args, **kwargs):
+        """Adds support for 'dyn__<name>__<lookup>' lookups on dynamic
+        fields, translated to SQL on the JSON in extra_fields"""
+        dynamic_lookups = self._pop_dynamic_lookups(kwargs)
+        if not dynamic_lookups:
+            return super(DynamicModelQuerySet, self).filter(*args, **kwargs)
+        # before cloning, so the clones get the field types
+        where, params = self.get_dynamic_compiler().where(dynamic_lookups)
+        return super(DynamicModelQuerySet, self).filter(*args, **kwargs)\
+            .extra(where=where, params=params)
+
+    def exclude(self, *args, **kwargs):
+        if not any(is_dynamic_lookup(key) for key in kwargs):
+            return super(DynamicModelQuerySet, self).exclude(*args, **kwargs)
+        # negate the lookups as a whole, like exclude() does
+        matching = DynamicModelQuerySet(self.model, using=self.db)
+        matching._dynamic_field_types = self.get_dynamic_field_types()
+        matching = matching.filter(*args, **kwargs).values('pk')
+        return super(DynamicModelQuerySet, self).exclude(pk__in=matching)
+
+    def iterator(self):
+        # the values selected for a dynamic ordering aren't model attributes
+        aliases = get_dynamic_ordering_aliases(self.query.extra_select)
+        objs = super(DynamicModelQuerySet, self).iterator()
+        coerce = self.model.coerce_on_load
+        if coerce:
+            objs = self._coerce_instances(objs, strict=coerce == 'strict')
+        for obj in objs:
+            for alias in aliases:
+                del obj.__dict__[alias]
+            yield obj
+
+    def _coerce_instances(self, objs, strict=False, chunk_size=100):
+        """Converts the dynamic values of loaded instances to their field
+        types, a chunk of instances at a time, with schemas looked up once
+        per chunk and values converted in one pass per schema, see
+        ``convert_rows()``. Instances with deferred dynamic values or type
+        values are left as they are."""
+        model = self.model
+        descriptor = model.get_schema_type_descriptor()
+        attnames = ['extra_fields']
+        if descriptor:
+            attnames.append(model._meta.get_field(descriptor).attname)
+
+        while True:
+            chunk = list(islice(objs, chunk_size))
+            if not chunk:
+                break
+            loaded = [obj for obj in chunk if all(attname in obj.__dict__
+                for attname in attnames)]
+            schemas = DynamicSchema.objects.get_many_for_model(model,
+                set(getattr(obj, descriptor) if descriptor else ''
+                    for obj in loaded))
+
+            by_type_value = {}
+            for obj in loaded:
+                type_value = getattr(obj, descriptor) if descriptor else ''
+                # pinned like iterator_dynamic() does
+                obj.__dict__['_schema'] = schemas[type_value]
+                by_type_value.setdefault(type_value, []).append(obj)
+            for type_value, type_objs in by_type_value.iteritems():
+                convert_rows(get_converters(schemas[type_value]),
+                    [obj.extra_fields for obj in type_objs], strict)
+                for obj in type_objs:
+                    # the converted values are the loaded ones
+                    obj._take_extra_fields_snapshot()
+            for obj in chunk:
+                yield obj
+
+    def values(self, *fields):
+        return self._clone(klass=DynamicValuesQuerySet, setup=True,
+            _fields=fields)
+
+    def values_list(self, *fields, **kwargs):
+        flat = kwargs.pop('flat', False)
+        if kwargs:
+            raise TypeError('Unexpected keyword arguments to values_list: %s'
+                % (kwargs.keys(),))
+        if flat and len(fields) > 1:
+            raise TypeError("'flat' is not valid when values_list is called "
+                "with more than one field.")
+        return self._clone(klass=DynamicValuesListQuerySet, setup=True,
+            flat=flat, _fields=fields)
+
+    def order_by(self, *field_names):
+        """Adds support for ordering by dynamic fields, given as
+        ``DynamicF('age')`` or ``DynamicF('age').desc()``, with values cast
+        according to the schema field type. The values sorted by are
+        selected under aliases that aren't set on the instances or
+        returned by values() and values_list()."""
+        clone = self._clone()
+        if any(is_dynamic_ordering_alias(field_name)
+            for field_name in clone.query.extra_order_by):
+            # replace an earlier dynamic ordering, like order_by() does
+            clone.query.extra_order_by = ()
+        if not any(is_dynamic_ordering(field_name)
+            for field_name in field_names):
+            return super(DynamicModelQuerySet, clone).order_by(*field_names)
+        select, order_by = clone.get_dynamic_compiler().ordering(field_names)
+        clone = super(DynamicModelQuerySet, clone).order_by().extra(
+            select=select, order_by=order_by)
+        if clone.query.extra_select_mask is not None:
+            # values() only selects the extra columns it was given
+            clone.query.set_extra_mask(
+                list(clone.query.extra_select_mask) + select.keys())
+        return clone
+
+    def aggregate(self, *args, **kwargs):
+        """Adds support for aggregates over dynamic fields, e.g.
+        ``aggregate(DynamicSum('age'))``"""
+        for arg in args:
+            kwargs[arg.default_alias] = arg
+        dynamic = dict((alias, kwargs.pop(alias)) for alias in kwargs.keys()
+            if isinstance(kwargs[alias], DynamicAggregate))
+        if not dynamic:
+            return super(DynamicModelQuerySet, self).aggregate(**kwargs)
+
+        compiler = self.get_dynamic_compiler()
+        if self.query.group_by is not None:
+            # aggregating an annotated queryset goes through a subquery,
+            # the dynamic fields are read from its extra_fields column
+            column = self.model._meta.get_field('extra_fields').column
+            if isinstance(self, ValuesQuerySet) or column not in [col[1]
+                for col in self.query.select if isinstance(col, tuple)]:
+                raise FieldError("Dynamic aggregates can't be computed over "
+                    "annotated values() or querysets without extra_fields")
+            compiler.use_subquery_column()
+        clone = self._clone()
+        clone.query = clone.query.clone(klass=DynamicAggregateQuery)
+        for alias, aggregate in dynamic.items():
+            clone.query.aggregates[alias] = aggregate.get_sql_aggregate(
+                compiler)
+        return super(DynamicModelQuerySet, clone).aggregate(**kwargs)
+
+    def update_dynamic(self, **values):
+        """Sets dynamic fields on all matched rows with a single UPDATE.
+
+        Values can be plain values, ``DynamicF('other_dynamic_field')`` or
+        ``F('concrete_field')``. Other dynamic fields in the stored
+        documents are left as they are. Only rows whose schema has all the
+        named dynamic fields are updated, FieldError is raised if no schema
+        has them. Plain values are converted with the field's converter of
+        each of those schemas, an invalid one raises ValidationError.
+        Returns the number of rows updated.
+        """
+        if not values:
+            return 0
+        model = self.model
+        names = set(values)
+        names.update(value.name for value in values.itervalues()
+            if isinstance(value, DynamicF))
+        field_specs = dict((type_value, dict((spec[0], spec)
+            for spec in specs)) for type_value, specs in
+                DynamicSchema.objects.get_field_specs(model).iteritems())
+        type_values = [type_value for type_value, specs in
+            field_specs.iteritems() if names <= set(specs)]
+        if not type_values:
+            raise FieldError("No schema of %s has all of the dynamic fields "
+                "%s" % (model.__name__, ', '.join(sorted(names))))
+
+        field_types = {}
+        for type_value in type_values:
+            for name, field_type, required, extra in \
+                field_specs[type_value].itervalues():
+                if field_types.get(name, field_type) != field_type:
+                    field_type = None
+                field_types[name] = field_type
+
+        converted, errors = {}, {}
+        for name, value in values.iteritems():
+            if isinstance(value, (DynamicF, models.F)):
+                converted[name] = value
+                continue
+            for type_value in type_values:
+                spec = field_specs[type_value][name]
+                try:
+                    converted[name] = compile_converter(*spec[1:])(value)
+                except ValidationError as e:
+                    errors[name] = e.messages
+        if errors:
+            raise ValidationError(errors)
+
+        queryset = self
+        descriptor = model.get_schema_type_descriptor()
+        if descriptor:
+            condition = Q(**{descriptor + '__in': [type_value
+                for type_value in type_values if type_value is not None]})
+            if None in type_values:
+                condition |= Q(**{descriptor + '__isnull': True})
+            queryset = self.filter(condition)
+        compiler = DynamicLookupCompiler(model, connections[self.db],
+            field_types)
+        return queryset.update(extra_fields=compiler.update_value(converted))
+
+    def bulk_create_dynamic(self, rows, batch_size=500):
+        """Validates plain dicts against the schemas and inserts them,
+        ``batch_size`` rows at a time. How many rows go into one INSERT is
+        left to ``bulk_create()``, which keeps within the database's limits.
+
+        Each row maps concrete and dynamic field names to values. Schemas
+        are resolved once per type value, and dynamic values are converted
+        to their field types with converters compiled once per schema. A
+        row with an unknown field or an invalid value raises
+        ValidationError and nothing gets inserted. Like ``bulk_create()``,
+        this doesn't call ``save()`` or send signals. Returns the number of
+        inserted rows.
+        """
+        self._for_write = True
+        model = self.model
+        descriptor = model.get_schema_type_descriptor()
+        default_type = ''
+        if descriptor:
+            default_type = model._meta.get_field(descriptor).get_default()
+
+        schemas = {}
+        count = 0
+        rows = iter(rows)
+        with transaction.commit_on_success(using=self.db):
+            while True:
+                chunk = list(islice(rows, batch_size))
+                if not chunk:
+                    break
+
+                objs = []
+                for index, row in enumerate(chunk, count):
+                    type_value = row.get(descriptor, default_type) \
+                        if descriptor else ''
+                    if type_value not in schemas:
+                        schemas[type_value] = DynamicSchema.get_for_model(
+                            model, type_value)
+                    objs.append(self._build_dynamic_instance(row,
+                        schemas[type_value], index))
+
+                self.bulk_create(objs)
+                count += len(objs)
+        return count
+
+    def _build_dynamic_instance(self, row, schema, index):
+        # the type value has been checked by looking up its schema
+        try:
+            concrete, extra_fields = clean_row(self.model,
+                get_converters(schema), row,
+                exclude=[self.model.get_schema_type_descriptor()])
+        except ValidationError as e:
+            raise ValidationError(dict((name, [u'Row %d: %s' % (index, msg)
+                for msg in messages])
+                for name, messages in e.message_dict.items()))
+        return self.model(_schema=schema, extra_fields=extra_fields,
+            **concrete)
+
+    def iterator_dynamic(self, chunk_size=100, coerce=None, strict=None):
+        """Iterate over the results, resolving schemas once per chunk.
+
+        Rows are read in chunks of ``chunk_size`` and the schemas of the
+        type values in a chunk are looked up together. The resolved schema is
+        pinned to the instances, so they don't look it up again for their
+        lifetime. Like ``iterator()``, results are streamed from the cursor
+        and not cached on the queryset.
+
+        With ``coerce``, the dynamic values of each chunk are converted to
+        the types of their schema fields in one pass per schema, see
+        ``convert_rows()``. Values that can't be converted are kept as they
+        are, or raise ValidationError if ``strict`` is set too. Both default
+        to the model's ``coerce_on_load``.
+        """
+        if coerce is None:
+            coerce = bool(self.model.coerce_on_load)
+        if strict is None:
+            strict = self.model.coerce_on_load == 'strict'
+        qs = self._clone()
+        qs.query.select_related = False
+        if qs.query.get_loaded_field_names():
+            raise ValueError(
+                "iterator_dynamic() doesn't support deferred fields")
+
+        model = self.model
+        db = self.db
+        extra_select = qs.query.extra_select.keys()
+        ordering_aliases = get_dynamic_ordering_aliases(extra_select)
+        aggregate_select = qs.query.aggregate_select.keys()
+        index_start = len(extra_select)
+        aggregate_start = index_start + len(model._meta.fields)
+
+        type_index = None
+        if model.get_schema_type_descriptor():
+            type_index = index_start + model._meta.fields.index(
+                model._meta.get_field(model.get_schema_type_descriptor()))
+
+        extra_fields_index = model._meta.fields.index(
+            model._meta.get_field('extra_fields'))
+
+        rows = qs.query.get_compiler(using=db).results_iter()
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+
+            schemas = DynamicSchema.objects.get_many_for_model(model,
+                set(row[type_index] if type_index is not None else ''
+                    for row in chunk))
+            if coerce:
+                chunk = self._coerce_chunk(chunk, schemas, type_index,
+                    index_start + extra_fields_index, strict)
+
+            for row in chunk:
+                type_value = row[type_index] if type_index is not None else ''
+                obj = model(*row[index_start:aggregate_start],
+                    _schema=schemas[type_value])
+                obj._state.db = db
+                obj._state.adding = False
+                for i, name in enumerate(extra_select):
+                    if name not in ordering_aliases:
+                        setattr(obj, name, row[i])
+                for i, name in enumerate(aggregate_select):
+                    setattr(obj, name, row[aggregate_start + i])
+                yield obj
+
+    def _coerce_chunk(self, chunk, schemas, type_index, extra_fields_index,
+        strict):
+        """Decodes the extra_fields of a chunk of rows and converts the
+        values of every schema in one batch"""
+        field = self.model._meta.get_field('extra_fields')
+        chunk = [list(row) for row in chunk]
+        by_type_value = {}
+        for row in chunk:
+            extra_fields = row[extra_fields_index]
+            if isinstance(extra_fields, basestring):
+                extra_fields = row[extra_fields_index] = field.loads(
+                    extra_fields)
+            if isinstance(extra_fields, dict):
+                type_value = row[type_index] if type_index is not None else ''
+                by_type_value.setdefault(type_value, []).append(extra_fields)
+
+        for type_value, rows in by_type_value.items():
+            convert_rows(get_converters(schemas[type_value]), rows, strict)
+        return chunk
+
+
+class DynamicOrderingValuesMixin(object):
+    """Keeps the values a dynamic ordering sorts by in the SELECT of
+    values() and values_list(), without returning them"""
+
+    def _setup_query(self):
+        super(DynamicOrderingValuesMixin, self)._setup_query()
+        aliases = get_dynamic_ordering_aliases(self.query.extra)
+        if aliases and self.extra_names is not None:
+            self.query.set_extra_mask(self.extra_names + aliases)
+
+    def _as_sql(self, connection):
+        clone = self._clone()
+        if clone.query.low_mark == 0 and clone.query.high_mark is None:
+            # the ordering is dropped from unsliced subqueries
+            clone.query.clear_ordering(True)
+            clone.query.set_extra_mask(clone.extra_names or [])
+        return super(DynamicOrderingValuesMixin, clone)._as_sql(connection)
+
+
+class DynamicValuesQuerySet(DynamicOrderingValuesMixin, ValuesQuerySet,
+    DynamicModelQuerySet):
+
+    def iterator(self):
+        aliases = get_dynamic_ordering_aliases(self.query.extra_select)
+        for row in super(DynamicValuesQuerySet, self).iterator():
+            for alias in aliases:
+                del row[alias]
+            yield row
+
+
+class DynamicValuesListQuerySet(DynamicOrderingValuesMixin,
+    ValuesListQuerySet, DynamicModelQuerySet):
+
+    def iterator(self):
+        extra_names = self.query.extra_select.keys()
+        aliases = get_dynamic_ordering_aliases(extra_names)
+        if not aliases:
+            for row in super(DynamicValuesListQuerySet, self).iterator():
+                yield row
+            return
+
+        aggregate_names = self.query.aggregate_select.keys()
+        names = extra_names + self.field_names + aggregate_names
+        if self._fields:
+            fields = list(self._fields) + [name for name in aggregate_names
+                if name not in self._fields]
+        else:
+            fields = [name for name in names if name not in aliases]
+        flat = self.flat and len(self._fields) == 1
+        for row in self.query.get_compiler(self.db).results_iter():
+            data = dict(zip(names, row))
+            if flat:
+                yield data[fields[0]]
+            else:
+                yield tuple([data[name] for name in fields])
+
+
+class DynamicModelManager(models.Manager):
+    def get_query_set(self):
+        return DynamicModelQuerySet(self.model, using=self._db)
+
+    def iterator_dynamic(self, chunk_size=100, coerce=None, strict=None):
+        return self.get_query_set().iterator_dynamic(chunk_size=chunk_size,
+            coerce=coerce, strict=strict)
+
+    def update_dynamic(self, **values):
+        return self.get_query_set().update_dynamic(**values)
+
+    def bulk_create_dynamic(self, rows, batch_size=500):
+        return self.get_query_set().bulk_create_dynamic(rows,
+            batch_size=batch_size)
 
 
 class DynamicModel(models.Model):
@@ -12,16 +481,84 @@ class DynamicModel(models.Model):
     class Meta:
         abstract = True
 
-    extra_fields = JSONField(editable=False, default="{}")
+    objects = DynamicModelManager()
+
+    extra_fields = JSONField(editable=False, default="{}",
+        lazy=getattr(settings, 'DYNAMICMODEL_LAZY_EXTRA_FIELDS', False),
+        native=getattr(settings, 'DYNAMICMODEL_NATIVE_JSON', False))
+
+    # With virtual sync, loaded extra_fields are left as stored instead of
+    # being synced with the schema: dynamic fields missing from the stored
+    # document read as None, keys that aren't in the schema are hidden, and
+    # the document is synced only when it is written as a whole.
+    virtual_sync = getattr(settings, 'DYNAMICMODEL_VIRTUAL_SYNC', False)
+
+    # With coerce_on_load, querysets convert the dynamic values of the
+    # instances they load to the types of their schema fields, a chunk of
+    # rows at a time. Values that can't be converted are kept as they are,
+    # or raise ValidationError if it is 'strict'.
+    coerce_on_load = getattr(settings, 'DYNAMICMODEL_COERCE_ON_LOAD', False)
 
     def __init__(self, *args, **kwargs):
-        self._schema = None
+        # a schema pinned by a bulk loader, see iterator_dynamic(), or the
+        # one get_schema() resolves
+        self._schema = kwargs.pop('_schema', None)
+        self.__dict__['_schema_generation'] = local_schema_cache.generation
         super(DynamicModel, self).__init__(*args, **kwargs)
-        self.get_schema()
-        self._sync_with_schema()
+        extra_fields = self.__dict__.get('extra_fields')
+        if isinstance(extra_fields, LazyJSON) and not extra_fields.loaded:
+            # postpone syncing until the payload actually gets decoded
+            extra_fields.on_load = lambda value: self._on_extra_fields_load()
+        elif not self.virtual_sync:
+            self._sync_with_schema()
+        self._reset_dirty_state()
+
+    def __reduce__(self):
+        # a pickled instance resolves its schema again when unpickled, and
+        # a lazy document is decoded, since its load hook can't be pickled
+        reduced = super(DynamicModel, self).__reduce__()
+        state = dict(reduced[2])
+        state.pop('_schema', None)
+        state.pop('_schema_generation', None)
+        if isinstance(state.get('extra_fields'), LazyJSON):
+            state['extra_fields'] = self.extra_fields
+        return reduced[:2] + (state,)
+
+    def _on_extra_fields_load(self):
+        if not self.virtual_sync:
+            self._sync_with_schema()
+        self._take_extra_fields_snapshot()
+
+    def _take_extra_fields_snapshot(self):
+        """Remembers the dynamic values as loaded, so changes made in place
+        (e.g. to a list value) can be detected on save"""
+        extra_fields = self.__dict__.get('extra_fields')
+        if extra_fields is None or (isinstance(extra_fields, LazyJSON) and
+            not extra_fields.loaded):
+            snapshot = None
+        else:
+            snapshot = dict((key, copy.deepcopy(value)
+                if isinstance(value, (list, dict)) else value)
+                for key, value in extra_fields.items())
+        self.__dict__['_extra_fields_snapshot'] = snapshot
+
+    def _reset_dirty_state(self):
+        self.__dict__['_dirty_fields'] = set()
+        self._take_extra_fields_snapshot()
+
+    @classmethod
+    def get_concrete_field_names(cls):
+        """Names and attnames of the model's concrete fields, computed once
+        per model class"""
+        names = cls.__dict__.get('_concrete_field_names')
+        if names is None:
+            names = frozenset([f.name for f in cls._meta.fields] +
+                [f.attname for f in cls._meta.fields])
+            cls._concrete_field_names = names
+        return names
 
     def _sync_with_schema(self):
-        schema_extra_fields = self.get_extra_fields_names()
+        schema_extra_fields = self.get_schema().get_extra_field_names()
         clear_field = [field_name for field_name in self.extra_fields
             if field_name not in schema_extra_fields]
         new_field = [field_name for field_name in schema_extra_fields
@@ -32,7 +569,18 @@ class DynamicModel(models.Model):
         for el in new_field:
             self.extra_fields[el] = None
 
+    def _sync_for_write(self):
+        """Syncs extra_fields with the schema before the whole document is
+        written, if syncing was skipped on load"""
+        extra_fields = self.__dict__.get('extra_fields')
+        if self.virtual_sync and extra_fields is not None and not (
+            isinstance(extra_fields, LazyJSON) and not extra_fields.loaded):
+            self._sync_with_schema()
+
     def get_extra_field_value(self, key):
+        if self.virtual_sync and \
+            key not in self.get_schema().get_extra_field_names():
+            return None
         if key in self.extra_fields:
             return self.extra_fields[key]
         else:
@@ -46,14 +594,23 @@ class DynamicModel(models.Model):
                     field.name)
 
     def get_extra_fields_names(self):
-        return [name for name, verbose_name, field_type, required, extra,
-            value in self.get_extra_fields()]
+        return [field.name for field in self.get_schema().fields.all()]
 
     def get_schema(self):
+        """The instance's schema, resolved once per instance and again
+        only when the schema type value changes or this process changes a
+        schema"""
         type_value = ''
         if self.get_schema_type_descriptor():
             type_value = getattr(self, self.get_schema_type_descriptor())
-        return DynamicSchema.get_for_model(self, type_value)
+        schema = self.__dict__.get('_schema')
+        generation = local_schema_cache.generation
+        if schema is None or schema.type_value != type_value or \
+            self.__dict__.get('_schema_generation') != generation:
+            schema = DynamicSchema.get_for_model(self, type_value)
+            self.__dict__['_schema'] = schema
+            self.__dict__['_schema_generation'] = generation
+        return schema
 
     @staticmethod
     def get_schema_type_descriptor():
@@ -64,21 +621,212 @@ class DynamicModel(models.Model):
         return []
 
     def __getattr__(self, attr_name):
-        if attr_name in self.extra_fields:
-            return self.extra_fields[attr_name]
-        else:
-            return getattr(super(DynamicModel, self), attr_name)
+        extra_fields = self.__dict__.get('extra_fields')
+        if self.virtual_sync and extra_fields is not None and \
+            attr_name not in self.get_concrete_field_names():
+            # the schema decides which names exist, not the stored keys
+            if attr_name in self.get_schema().get_extra_field_names():
+                return extra_fields.get(attr_name)
+        elif isinstance(extra_fields, LazyJSON) and not extra_fields.loaded:
+            # only decode the payload for names that are dynamic fields
+            if attr_name not in self.get_concrete_field_names() and \
+                attr_name in self.get_schema().get_extra_field_names():
+                return extra_fields[attr_name]
+        elif extra_fields is not None and attr_name in extra_fields:
+            return extra_fields[attr_name]
+        return getattr(super(DynamicModel, self), attr_name)
 
     def __setattr__(self, attr_name, value):
-        if hasattr(self, 'extra_fields') and \
-            attr_name not in [el.name for el in self._meta.fields] and \
-            attr_name not in ['_schema'] and \
-            attr_name in self.get_extra_fields_names():
+        if attr_name != '_schema' and \
+            'extra_fields' in self.__dict__ and \
+            attr_name not in self.get_concrete_field_names() and \
+            attr_name in self.get_schema().get_extra_field_names():
 
             self.extra_fields[attr_name] = value
+        elif '_dirty_fields' in self.__dict__ and \
+            attr_name in self.get_concrete_field_names() and \
+            (attr_name not in self.__dict__ or
+                self.__dict__[attr_name] != value):
+
+            self._dirty_fields.add(attr_name)
 
         super(DynamicModel, self).__setattr__(attr_name, value)
 
+    def get_dirty_fields(self):
+        """Names of the concrete and dynamic fields changed since the
+        instance was loaded or last saved.
+
+        Concrete fields are tracked on assignment, dynamic fields are
+        compared with the values they were loaded with.
+        """
+        dirty = set(self._dirty_fields)
+        snapshot = self._extra_fields_snapshot
+        extra_fields = self.__dict__.get('extra_fields')
+        if snapshot is None or extra_fields is None or (
+            isinstance(extra_fields, LazyJSON) and not extra_fields.loaded):
+            return dirty
+        missing = object()
+        for key in set(snapshot) | set(extra_fields):
+            if snapshot.get(key, missing) != extra_fields.get(key, missing):
+                dirty.add(key)
+        return dirty
+
+    def _get_dynamic_keys(self, names):
+        """The dynamic field names among ``names``, or None if extra_fields
+        has been replaced as a whole"""
+        if 'extra_fields' in names or 'extra_fields' in self._dirty_fields:
+            return None
+        return set(names) - self.get_concrete_field_names()
+
+    def _get_fields_to_update(self, names, strict=True):
+        """Maps field names, attnames and dynamic field names to the model
+        fields storing them"""
+        dynamic_names = self.get_schema().get_extra_field_names()
+        extra_fields = self._meta.get_field('extra_fields')
+        fields, unknown = [], []
+        for name in names:
+            for field in self._meta.fields:
+                if name in (field.name, field.attname):
+                    break
+            else:
+                if strict and name not in dynamic_names:
+                    unknown.append(name)
+                    continue
+                field = extra_fields
+            if field not in fields:
+                fields.append(field)
+        if unknown:
+            raise ValueError("The following fields do not exist in this "
+                "model or are m2m fields: %s" % ', '.join(sorted(unknown)))
+        return fields
+
+    def _get_partial_update_backend(self, fields, dynamic_keys, using):
+        """The JSON backend to update single keys of extra_fields with, or
+        None if the whole document has to be written, also when the
+        database can't handle JSON"""
+        if dynamic_keys is None or \
+            not getattr(settings, 'DYNAMICMODEL_PARTIAL_UPDATES', True) or \
+            self._meta.get_field('extra_fields') not in fields or \
+            not set(fields) <= set(self._meta.local_fields) or \
+            not dynamic_keys <= self.get_schema().get_extra_field_names():
+            return None
+        try:
+            backend = get_backend(connections[using])
+        except DatabaseError:
+            return None
+        return backend if backend.is_supported() else None
+
+    def _do_partial_update(self, backend, fields, dynamic_keys, using):
+        """Updates the row with one statement which changes only the given
+        keys of the stored extra_fields document"""
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        extra_fields = self._meta.get_field('extra_fields')
+        assignments, params = [], []
+        for field in fields:
+            if field is extra_fields:
+                keys = sorted(key for key in dynamic_keys
+                    if key in self.extra_fields)
+                removed_keys = sorted(key for key in dynamic_keys
+                    if key not in self.extra_fields)
+                sql = backend.update_keys_sql(qn(field.column),
+                    [(key, backend.json_param_sql) for key in keys],
+                    removed_keys, field.native)
+                params.extend(field.dumps(self.extra_fields[key])
+                    for key in keys)
+            else:
+                sql = '%s'
+                params.append(field.get_db_prep_save(
+                    field.pre_save(self, False), connection=connection))
+            assignments.append("%s = %s" % (qn(field.column), sql))
+        params.append(self._meta.pk.get_db_prep_value(self.pk,
+            connection=connection))
+
+        cursor = connection.cursor()
+        cursor.execute("UPDATE %s SET %s WHERE %s = %%s" % (
+            qn(self._meta.db_table), ", ".join(assignments),
+            qn(self._meta.pk.column)), params)
+        transaction.commit_unless_managed(using=using)
+        return cursor.rowcount
+
+    def _do_update(self, fields, using, dynamic_keys=None):
+        """Writes only the given fields of an existing row, returns False if
+        the row doesn't exist.
+
+        With ``dynamic_keys`` given, only those keys of extra_fields are
+        written, leaving the rest of the stored document as it is.
+        """
+        cls = self.__class__
+        update_fields = frozenset(field.name for field in fields)
+        signals.pre_save.send(sender=cls, instance=self, raw=False,
+            using=using, update_fields=update_fields)
+        backend = self._get_partial_update_backend(fields, dynamic_keys,
+            using)
+        if backend is not None:
+            updated = self._do_partial_update(backend, fields, dynamic_keys,
+                using)
+        else:
+            if self._meta.get_field('extra_fields') in fields:
+                self._sync_for_write()
+            values = dict((field.name, field.pre_save(self, False))
+                for field in fields)
+            updated = cls._base_manager.using(using).filter(
+                pk=self.pk).update(**values)
+        if not updated:
+            return False
+        self._state.db = using
+        self._state.adding = False
+        signals.post_save.send(sender=cls, instance=self, created=False,
+            raw=False, using=using, update_fields=update_fields)
+        return True
+
+    def save(self, force_insert=False, force_update=False, using=None,
+        update_fields=None):
+        """Saves the instance, writing only the fields that have changed.
+
+        Existing rows are updated with just the dirty columns (dynamic
+        fields all live in ``extra_fields``), and not at all if nothing
+        changed. ``update_fields`` names the fields to write explicitly and
+        may include dynamic field names.
+        """
+        if force_insert and (force_update or update_fields is not None):
+            raise ValueError("Cannot force both insert and updating in "
+                "model saving.")
+        using = using or router.db_for_write(self.__class__, instance=self)
+
+        if update_fields is not None:
+            if self.pk is None:
+                raise ValueError("Cannot save with update_fields when the "
+                    "instance has no primary key.")
+            update_fields = list(update_fields)
+            if update_fields:
+                fields = self._get_fields_to_update(update_fields)
+                if not self._do_update(fields, using,
+                    self._get_dynamic_keys(update_fields)):
+                    raise DatabaseError("Save with update_fields did not "
+                        "affect any rows.")
+        elif force_insert or self._state.adding or self.pk is None:
+            self._sync_for_write()
+            super(DynamicModel, self).save(force_insert=force_insert,
+                force_update=force_update, using=using)
+        else:
+            dirty = self.get_dirty_fields()
+            if dirty:
+                fields = self._get_fields_to_update(dirty, strict=False)
+                fields.extend(field for field in self._meta.fields
+                    if getattr(field, 'auto_now', False) and
+                        field not in fields)
+                if self._meta.pk in fields or not self._do_update(fields,
+                    using, self._get_dynamic_keys(dirty)):
+                    self._sync_for_write()
+                    super(DynamicModel, self).save(force_update=force_update,
+                        using=using)
+            elif force_update and not self.__class__._base_manager.using(
+                using).filter(pk=self.pk).exists():
+                raise DatabaseError("Forced update did not affect any rows.")
+
+        self._reset_dirty_state()
+
 
 class DynamicForm(forms.ModelForm):
     field_mapping = [
@@ -99,33 +847,52 @@ class DynamicForm(forms.ModelForm):
                 "DynamicForm.Meta.model must be inherited from DynamicModel")
 
         if self.instance and hasattr(self.instance, 'get_extra_fields'):
-            for name, verbose_name, field_type, req, extra, value in \
-                self.instance.get_extra_fields():
+            for name, field in self.get_dynamic_form_fields(
+                self.instance.get_schema()):
+
+                # like the fields in base_fields, copied for every form
+                field = copy.deepcopy(field)
+                field.initial = self.instance.get_extra_field_value(name)
+                self.fields[name] = field
+
+    @classmethod
+    def get_dynamic_form_fields(cls, schema):
+        """(name, form field) pairs for the dynamic fields of a schema,
+        built once per form class and cached schema version"""
+        compiled = schema.__dict__.setdefault('_form_fields', {})
+        fields = compiled.get(cls)
+        if fields is None:
+            fields = [(field.name, cls.build_dynamic_form_field(field))
+                for field in schema.fields.all()]
+            compiled[cls] = fields
+        return fields
 
-                field_mapping_case = dict(self.field_mapping)[field_type]
+    @classmethod
+    def build_dynamic_form_field(cls, schema_field):
+        field_mapping_case = dict(cls.field_mapping)[schema_field.field_type]
 
-                widget = field_mapping_case.get('widget')
+        widget = field_mapping_case.get('widget')
 
-                if extra and extra.get('choices'):
-                    widget = widget(choices=extra.get('choices'))
+        extra = schema_field.extra
+        if extra and extra.get('choices'):
+            widget = widget(choices=extra.get('choices'))
 
-                field_kwargs = {
-                    'required': req,
-                    'widget': widget,
-                    'initial': self.instance.get_extra_field_value(name),
-                    'label': verbose_name.capitalize() if verbose_name else
-                        " ".join(name.split("_")).capitalize(),
-                }
+        verbose_name = schema_field.verbose_name
+        field_kwargs = {
+            'required': schema_field.required,
+            'widget': widget,
+            'label': verbose_name.capitalize() if verbose_name else
+                " ".join(schema_field.name.split("_")).capitalize(),
+        }
 
-                self.fields[name] = field_mapping_case['field'](**field_kwargs)
+        return field_mapping_case['field'](**field_kwargs)
 
     def save(self, force_insert=False, force_update=False, commit=True):
         m = super(DynamicForm, self).save(commit=False)
 
         extra_fields = {}
 
-        extra_fields_names = [name for name, verbose_name, field_type, req,
-            extra, value in self.instance.get_extra_fields()]
+        extra_fields_names = self.instance.get_schema().get_extra_field_names()
 
         for cleaned_key in self.cleaned_data.keys():
             if cleaned_key in extra_fields_names:
@@ -147,9 +914,7 @@ class DynamicSchemaQuerySet(models.query.QuerySet):
                 cases.append(tpl)
         super(DynamicSchemaQuerySet, self).delete(*args, **kwargs)
         for el in cases:
-            cache_key = DynamicSchema.get_cache_key_static(
-                el[0].model_class(), el[1])
-            cache.set(cache_key, None)
+            DynamicSchema.clear_cache_static(el[0].model_class(), el[1])
         return self
 
 
@@ -159,11 +924,192 @@ class DynamicSchemaManager(models.Manager):
 
     def get_for_model(self, model_class, type_value=''):
         cache_key = DynamicSchema.get_cache_key_static(model_class, type_value)
-        cache_value = cache.get(cache_key)
-        if cache_value is not None:
-            return cache_value
-        else:
-            return DynamicSchema.renew_cache_static(model_class, type_value)
+        version_key = DynamicSchema.get_version_key_static(model_class,
+            type_value)
+
+        # the version is tiny, so checking it on every call is much cheaper
+        # than fetching and rebuilding the whole schema
+        version = cache.get(version_key)
+        if version is not None:
+            local_value = local_schema_cache.get(cache_key, version)
+            if local_value is not None:
+                return local_value
+
+        snapshot = cache.get(cache_key)
+        if version is not None and snapshot is not None and \
+            snapshot[0] == version:
+            return self._load_snapshot(cache_key, snapshot)
+
+        # the cached schema is missing or stale, only one process at a time
+        # rebuilds it
+        lock_key = DynamicSchema.get_lock_key_static(model_class, type_value)
+        if cache.add(lock_key, True, SCHEMA_LOCK_TIMEOUT):
+            try:
+                return DynamicSchema.rebuild_cache_static(model_class,
+                    type_value)
+            finally:
+                cache.delete(lock_key)
+
+        # the others keep serving the previous schema meanwhile
+        stale = local_schema_cache.get_stale(cache_key)
+        if stale is not None:
+            return stale
+        if snapshot is not None:
+            return DynamicSchema.from_snapshot(snapshot)
+        return self._wait_for_rebuild(model_class, type_value)
+
+    def get_many_for_model(self, model_class, type_values):
+        """Returns a {type_value: schema} dict, see get_many()"""
+        schemas = self.get_many([(model_class, type_value)
+            for type_value in type_values])
+        return dict((type_value, schemas[(model_class, type_value)])
+            for type_value in type_values)
+
+    def get_many(self, keys):
+        """Looks up the schemas for (model_class, type_value) pairs at
+        once, returns a {(model_class, type_value): schema} dict.
+
+        The versions are fetched with a single cache.get_many(), and the
+        snapshots of the schemas missing from the local cache with
+        another one. Schemas that aren't cached are loaded with one query
+        for all of them.
+        """
+        keys = list(OrderedDict.fromkeys(keys))
+        cache_keys = dict((key, DynamicSchema.get_cache_key_static(*key))
+            for key in keys)
+        version_keys = dict((key, DynamicSchema.get_version_key_static(*key))
+            for key in keys)
+
+        versions = cache.get_many(version_keys.values())
+        schemas, missing = {}, []
+        for key in keys:
+            version = versions.get(version_keys[key])
+            local_value = None
+            if version is not None:
+                local_value = local_schema_cache.get(cache_keys[key], version)
+            if local_value is not None:
+                schemas[key] = local_value
+            else:
+                missing.append(key)
+        if not missing:
+            return schemas
+
+        snapshots = cache.get_many([cache_keys[key] for key in missing])
+        stale = []
+        for key in missing:
+            version = versions.get(version_keys[key])
+            snapshot = snapshots.get(cache_keys[key])
+            if version is not None and snapshot is not None and \
+                snapshot[0] == version:
+                schemas[key] = self._load_snapshot(cache_keys[key], snapshot)
+            else:
+                stale.append(key)
+
+        # like in get_for_model(), schemas being rebuilt by another process
+        # are served stale
+        lock_keys = dict((key, DynamicSchema.get_lock_key_static(*key))
+            for key in stale)
+        locked = [key for key in stale
+            if cache.add(lock_keys[key], True, SCHEMA_LOCK_TIMEOUT)]
+        if locked:
+            try:
+                schemas.update(DynamicSchema.rebuild_many_cache_static(locked))
+            finally:
+                cache.delete_many([lock_keys[key] for key in locked])
+        for key in stale:
+            if key not in schemas:
+                schemas[key] = self.get_for_model(*key)
+        return schemas
+
+    def _load_snapshot(self, cache_key, snapshot):
+        schema = DynamicSchema.from_snapshot(snapshot)
+        local_schema_cache.set(cache_key, snapshot[0], schema)
+        return schema
+
+    def _wait_for_rebuild(self, model_class, type_value):
+        """Waits for the schema being rebuilt by another process, or
+        rebuilds it if that takes longer than the lock timeout"""
+        cache_key = DynamicSchema.get_cache_key_static(model_class, type_value)
+        version_key = DynamicSchema.get_version_key_static(model_class,
+            type_value)
+        lock_key = DynamicSchema.get_lock_key_static(model_class, type_value)
+
+        deadline = time.time() + SCHEMA_LOCK_TIMEOUT
+        while time.time() < deadline:
+            time.sleep(SCHEMA_LOCK_POLL_INTERVAL)
+            snapshot = cache.get(cache_key)
+            if snapshot is not None and snapshot[0] == cache.get(version_key):
+                return self._load_snapshot(cache_key, snapshot)
+            if cache.get(lock_key) is None:
+                # the other process gave up
+                break
+        return DynamicSchema.rebuild_cache_static(model_class, type_value)
+
+    def get_field_specs(self, model_class):
+        """Maps the type values of model_class's schemas to lists of
+        (name, field_type, required, extra) tuples of their fields, taken
+        from the cached schemas"""
+        return dict((type_value, [(field.name, field.field_type,
+            field.required, field.extra) for field in schema.fields.all()])
+            for type_value, schema in
+                self.get_all_for_model(model_class).iteritems())
+
+    def get_type_values(self, model_class):
+        """Type values of the existing schemas of model_class, cached under
+        a version that is bumped whenever one of them is saved or
+        deleted"""
+        cache_key = DynamicSchema.get_type_values_key_static(model_class)
+        version_key = "%s-VERSION" % cache_key
+        cached = cache.get_many([cache_key, version_key])
+        version = cached.get(version_key)
+        entry = cached.get(cache_key)
+        if version is not None and entry is not None and entry[0] == version:
+            return entry[1]
+
+        # like in rebuild_many_cache_static(), the version is read before
+        # loading
+        if version is None:
+            cache.add(version_key, initial_schema_version())
+            version = cache.get(version_key)
+        type_values = tuple(self.filter(
+            model=ContentType.objects.get_for_model(model_class))
+            .order_by('id').values_list('type_value', flat=True))
+        if version is not None:
+            cache.set(cache_key, (version, type_values))
+        return type_values
+
+    def get_all_for_model(self, model_class):
+        """Returns a {type_value: schema} dict of the existing schemas of
+        model_class, looked up with get_many()"""
+        return self.get_many_for_model(model_class,
+            self.get_type_values(model_class))
+
+    def get_field_types(self, model_class):
+        """Maps names of the dynamic fields of model_class, in all of its
+        schemas, to their field types. Names used with different types in
+        different schemas map to None.
+
+        The map is built from the cached schemas and kept in the local
+        cache until one of them changes.
+        """
+        schemas = self.get_all_for_model(model_class)
+        stamps = tuple(sorted((type_value, schema._snapshot_version)
+            for type_value, schema in schemas.iteritems()))
+        cache_key = "%s-FIELD-TYPES" % \
+            DynamicSchema.get_type_values_key_static(model_class)
+        field_types = local_schema_cache.get(cache_key, stamps)
+        if field_types is not None:
+            return field_types
+
+        field_types = {}
+        for schema in schemas.itervalues():
+            for field in schema.fields.all():
+                field_type = field.field_type
+                if field_types.get(field.name, field_type) != field_type:
+                    field_type = None
+                field_types[field.name] = field_type
+        local_schema_cache.set(cache_key, stamps, field_types)
+        return field_types
 
 
 class DynamicSchema(models.Model):
@@ -179,16 +1125,66 @@ class DynamicSchema(models.Model):
         return "%s%s" % (self.model,
             " (%s)" % self.type_value if self.type_value else '')
 
+    def __reduce__(self):
+        # the converters get_converters() compiles for the schema are
+        # closures, which can't be pickled; they are compiled again
+        reduced = super(DynamicSchema, self).__reduce__()
+        state = dict(reduced[2])
+        state.pop('_converters', None)
+        return reduced[:2] + (state,)
+
+    def get_extra_field_names(self):
+        """Set of dynamic field names, built once per cached schema"""
+        names = self.__dict__.get('_extra_field_names')
+        if names is None:
+            names = frozenset(field.name for field in self.fields.all())
+            self._extra_field_names = names
+        return names
+
+    def get_concrete_field_names(self):
+        return self.model.model_class().get_concrete_field_names()
+
     def add_field(self, name, type):
         return self.fields.create(schema=self, name=name, field_type=type)
 
     def remove_field(self, name):
         return self.fields.filter(name=name).delete()
 
+    def edit(self):
+        """Returns a SchemaEditor, which applies the changes made through it
+        at once when used as a context manager:
+
+            with schema.edit() as editor:
+                editor.add_field('age', 'IntegerField')
+                editor.remove_field('nickname')
+        """
+        return SchemaEditor(self)
+
+    def add_fields(self, fields):
+        """Adds fields given as (name, type) tuples or dicts of field
+        attributes, with one cache renewal"""
+        editor = self.edit()
+        for field in fields:
+            if isinstance(field, dict):
+                editor.add_field(**field)
+            else:
+                editor.add_field(*field)
+        return editor.apply()
+
+    def remove_fields(self, names):
+        editor = self.edit()
+        for name in names:
+            editor.remove_field(name)
+        return editor.apply()
+
     @classmethod
     def get_for_model(cls, model_class, type_value=''):
         return cls.objects.get_for_model(model_class, type_value)
 
+    @classmethod
+    def get_many_for_model(cls, model_class, type_values):
+        return cls.objects.get_many_for_model(model_class, type_values)
+
     @classmethod
     def get_cache_key_static(cls, model_class, type_value):
         return "%s-%s-%s-%s" % ('DYNAMICMODEL_SCHEMA_CACHE_KEY',
@@ -200,23 +1196,179 @@ class DynamicSchema(models.Model):
             self.type_value)
 
     @classmethod
-    def renew_cache_static(cls, model_class, type_value):
-        cache_key = cls.get_cache_key_static(model_class, type_value)
+    def get_version_key_static(cls, model_class, type_value):
+        return "%s-VERSION" % cls.get_cache_key_static(model_class,
+            type_value)
+
+    @classmethod
+    def get_type_values_key_static(cls, model_class):
+        return "%s-%s-%s" % ('DYNAMICMODEL_SCHEMA_TYPES_CACHE_KEY',
+            model_class._meta.app_label, model_class._meta.module_name)
+
+    @classmethod
+    def invalidate_type_values_static(cls, model_class):
+        version_key = "%s-VERSION" % cls.get_type_values_key_static(
+            model_class)
+        try:
+            cache.incr(version_key)
+        except ValueError:
+            cache.add(version_key, initial_schema_version())
 
-        if not cls.objects.filter(type_value=type_value,
-            model=ContentType.objects.get_for_model(model_class)).exists():
+    @classmethod
+    def get_lock_key_static(cls, model_class, type_value):
+        return "%s-LOCK" % cls.get_cache_key_static(model_class, type_value)
+
+    @classmethod
+    def get_version_static(cls, model_class, type_value):
+        """Current version of the cached schema, initialized if missing"""
+        version_key = cls.get_version_key_static(model_class, type_value)
+        version = cache.get(version_key)
+        if version is None:
+            cache.add(version_key, initial_schema_version())
+            version = cache.get(version_key)
+        return version
+
+    @classmethod
+    def invalidate_cache_static(cls, model_class, type_value):
+        """Makes cached copies of the schema stale by bumping its version,
+        they are rebuilt when next requested"""
+        version_key = cls.get_version_key_static(model_class, type_value)
+        local_schema_cache.touch()
+        try:
+            cache.incr(version_key)
+        except ValueError:
+            cache.add(version_key, initial_schema_version())
 
-            cls.objects.create(type_value=type_value,
-                model=ContentType.objects.get_for_model(model_class))
+    @classmethod
+    def clear_cache_static(cls, model_class, type_value):
+        cache_key = cls.get_cache_key_static(model_class, type_value)
+        cache.delete(cache_key)
+        cls.invalidate_cache_static(model_class, type_value)
+        cls.invalidate_type_values_static(model_class)
+        local_schema_cache.delete(cache_key)
 
-        schema = cls.objects.prefetch_related('fields')\
-            .get(
-                type_value=type_value,
-                model=ContentType.objects.get_for_model(model_class))
+    def clear_cache(self):
+        return self.clear_cache_static(self.model.model_class(),
+            self.type_value)
 
-        cache.set(cache_key, schema)
+    def get_snapshot(self, version):
+        """Compact form of the schema and its fields stored in the cache,
+        tagged with the version it was built for"""
+        return (version, self.id, self.model_id, self.type_value,
+            tuple((field.id, field.name, field.verbose_name,
+                field.field_type, field.required, field.extra)
+                for field in self.fields.all()))
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """Rebuilds a schema with prefetched fields from a snapshot"""
+        version, schema_id, model_id, type_value, fields = snapshot
+        schema = cls(id=schema_id, model_id=model_id, type_value=type_value)
+        schema._state.adding = False
+        schema._snapshot_version = version
+        schema._model_cache = ContentType.objects.get_for_id(model_id)
+
+        field_list = []
+        for field_id, name, verbose_name, field_type, required, extra in \
+            fields:
+            field = DynamicSchemaField(id=field_id, schema_id=schema_id,
+                name=name, verbose_name=verbose_name, field_type=field_type,
+                required=required, extra=extra)
+            field._state.adding = False
+            field._schema_cache = schema
+            field_list.append(field)
+
+        # the same structure prefetch_related() leaves behind
+        queryset = schema.fields.all()
+        queryset._result_cache = field_list
+        queryset._prefetch_done = True
+        schema._prefetched_objects_cache = {'fields': queryset}
         return schema
 
+    @classmethod
+    def rebuild_cache_static(cls, model_class, type_value):
+        """Loads the schema from the database and caches it under the
+        current version"""
+        key = (model_class, type_value)
+        return cls.rebuild_many_cache_static([key])[key]
+
+    @classmethod
+    def rebuild_many_cache_static(cls, keys):
+        """Loads the schemas for (model_class, type_value) pairs from the
+        database, creating the missing ones, and caches them under their
+        current versions.
+
+        Schemas and their fields are read with a single joined query.
+        """
+        # ContentTypeManager keeps the content types of models it has seen
+        # in memory, so this doesn't query the database after the first time
+        content_type_ids = dict((model_class,
+            ContentType.objects.get_for_model(model_class).id)
+            for model_class, type_value in keys)
+        # the versions are read before loading, so a change made meanwhile
+        # bumps them past the ones the snapshots are tagged with
+        versions = dict((key, cls.get_version_static(*key)) for key in keys)
+
+        lookup = reduce(operator.or_, [Q(model=content_type_ids[model_class],
+            type_value=type_value) for model_class, type_value in keys])
+        rows = cls.objects.filter(lookup).order_by('id', 'fields__id')\
+            .values_list('id', 'model', 'type_value', 'fields__id',
+                'fields__name', 'fields__verbose_name', 'fields__field_type',
+                'fields__required', 'fields__extra')
+        extra_field = DynamicSchemaField._meta.get_field('extra')
+        loaded = {}
+        for row in rows:
+            schema_id, model_id, type_value, field_id = row[:4]
+            fields = loaded.setdefault((model_id, type_value),
+                (schema_id, []))[1]
+            if field_id is not None:
+                fields.append(row[3:8] + (extra_field.to_python(row[8]),))
+
+        schemas, snapshots = {}, {}
+        for key in keys:
+            model_class, type_value = key
+            content_type_id = content_type_ids[model_class]
+            schema_id, fields = loaded.get((content_type_id, type_value),
+                (None, ()))
+            if schema_id is None:
+                schema_id = cls.create_schema_static(content_type_id,
+                    type_value)
+
+            snapshot = (versions[key], schema_id, content_type_id, type_value,
+                tuple(fields))
+            schemas[key] = schema = cls.from_snapshot(snapshot)
+            if versions[key] is not None:
+                cache_key = cls.get_cache_key_static(model_class, type_value)
+                snapshots[cache_key] = snapshot
+                local_schema_cache.set(cache_key, versions[key], schema)
+
+        cache.set_many(snapshots)
+        return schemas
+
+    @classmethod
+    def create_schema_static(cls, content_type_id, type_value):
+        """Creates a schema row, returns its id. If another process has
+        just created the same schema, returns the id of that one."""
+        using = router.db_for_write(cls)
+        sid = transaction.savepoint(using=using)
+        try:
+            schema = cls(model_id=content_type_id, type_value=type_value)
+            # a plain save, there's nothing cached to renew yet
+            models.Model.save(schema, force_insert=True, using=using)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid, using=using)
+            return cls.objects.using(using).get(model=content_type_id,
+                type_value=type_value).id
+        transaction.savepoint_commit(sid, using=using)
+        cls.invalidate_type_values_static(
+            ContentType.objects.get_for_id(content_type_id).model_class())
+        return schema.id
+
+    @classmethod
+    def renew_cache_static(cls, model_class, type_value):
+        cls.invalidate_cache_static(model_class, type_value)
+        return cls.rebuild_cache_static(model_class, type_value)
+
     def renew_cache(self):
         return self.renew_cache_static(self.model.model_class(),
             self.type_value)
@@ -224,21 +1376,120 @@ class DynamicSchema(models.Model):
     # overrides
     def save(self, *args, **kwargs):
         super(DynamicSchema, self).save(*args, **kwargs)
+        self.invalidate_type_values_static(self.model.model_class())
         self.renew_cache()
 
     def delete(self, *args, **kwargs):
         super(DynamicSchema, self).delete(*args, **kwargs)
-        cache.set(self.get_cache_key(), None)
+        self.clear_cache()
         return self
 
 
+class SchemaEditor(object):
+    """Collects field additions and removals for a schema and applies them
+    in one transaction, renewing the cached schema once.
+
+    New fields are validated in memory and inserted with bulk_create(), so
+    they don't go through DynamicSchemaField.save() and its queries.
+    Removals are applied before additions, so a field can be replaced with
+    a different type.
+    """
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.added = []
+        self.removed = []
+
+    def add_field(self, name, type=None, verbose_name=None, required=False,
+        extra=None, field_type=None):
+        self.added.append(DynamicSchemaField(schema_id=self.schema.id,
+            name=name, field_type=field_type or type,
+            verbose_name=verbose_name, required=required, extra=extra or {}))
+
+    def remove_field(self, name):
+        self.removed.append(name)
+
+    def clean(self, existing):
+        errors = {}
+        names = set(existing) - set(self.removed)
+        for field in self.added:
+            try:
+                field.clean_fields(exclude=['schema', 'extra'])
+            except ValidationError as e:
+                for messages in e.message_dict.values():
+                    errors.setdefault(field.name, []).extend(messages)
+            if field.name in names:
+                errors.setdefault(field.name, []).append(
+                    'Field with name "%s" already exists.' % field.name)
+            names.add(field.name)
+        for name in self.removed:
+            if name not in existing:
+                errors.setdefault(name, []).append(
+                    'Field with name "%s" doesn\'t exist.' % name)
+        if errors:
+            raise ValidationError(errors)
+
+    def apply(self):
+        """Applies the changes, returns the renewed schema"""
+        using = router.db_for_write(DynamicSchemaField)
+        fields = DynamicSchemaField._base_manager.using(using).filter(
+            schema=self.schema.id)
+        self.clean(set(fields.values_list('name', flat=True)))
+
+        with transaction.commit_on_success(using=using):
+            if self.removed:
+                # the base manager's delete() doesn't renew the cache
+                fields.filter(name__in=self.removed).delete()
+            if self.added:
+                DynamicSchemaField.objects.using(using).bulk_create(
+                    self.added)
+        self.added, self.removed = [], []
+        return DynamicSchema.renew_cache_static(ContentType.objects.get_for_id(
+            self.schema.model_id).model_class(), self.schema.type_value)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.apply()
+
+
 class DynamicSchemaFieldQuerySet(models.query.QuerySet):
     def delete(self):
-        cache_el = None
-        for el in self:
-            cache_el = el.delete(renew=False)
-        if cache_el:
-            cache_el.renew_cache()
+        """Deletes the fields with one DELETE statement per chunk of
+        primary keys and renews the cache of every affected schema once.
+
+        No delete signals are sent for the fields. Returns the number of
+        deleted fields and a {model label: count} dict, like newer Django
+        versions do.
+        """
+        assert self.query.can_filter(), \
+            "Cannot use 'limit' or 'offset' with delete."
+        self._for_write = True
+        using = self.db
+        rows = list(self.values_list('pk', 'schema__model',
+            'schema__type_value'))
+        if not rows:
+            return 0, {}
+
+        # in chunks, like Django's own deletion, to keep within the
+        # database's limit on query parameters
+        DeleteQuery(self.model).delete_batch(
+            [pk for pk, model_id, type_value in rows], using)
+        transaction.commit_unless_managed(using=using)
+        self._result_cache = None
+
+        for model_id, type_value in set((model_id, type_value)
+            for pk, model_id, type_value in rows):
+            DynamicSchema.renew_cache_static(
+                ContentType.objects.get_for_id(model_id).model_class(),
+                type_value)
+
+        label = "%s.%s" % (self.model._meta.app_label,
+            self.model._meta.object_name)
+        return len(rows), {label: len(rows)}
+    delete.alters_data = True
 
 
 class DynamicSchemaFieldManager(models.Manager):
@@ -263,7 +1514,7 @@ class DynamicSchemaField(models.Model):
     objects = DynamicSchemaFieldManager()
 
     schema = models.ForeignKey(DynamicSchema, related_name='fields')
-    name = models.CharField(max_length=100, validators=[RegexValidator(r'^[\w]+$',
+    name = models.CharField(max_length=100, validators=[RegexValidator(KEY_RE,
         message="Name should contain only alphanumeric characters and underscores.")])
     verbose_name = models.CharField(max_length=100, null=True, blank=True)
     field_type = models.CharField(max_length=100, choices=FIELD_TYPES)
@@ -296,6 +1547,11 @@ class DynamicSchemaField(models.Model):
         if self.field_type not in dict(self.FIELD_TYPES).keys():
             raise ValidationError("Wrong field_type")
 
+        # names end up in SQL, so save() checks them too, not only forms
+        if not KEY_RE.match(self.name or ''):
+            raise ValidationError("Name should contain only alphanumeric "
+                "characters and underscores.")
+
         if not self.id:
             if DynamicSchemaField.objects.filter(schema=self.schema,
                 name=self.name).exists():
@@ -0,0 +1,356 @@
+"""
+Translation of lookups on dynamic fields into SQL.
+
+Dynamic fields are looked up with the ``dyn`` prefix, e.g.
+``MyModel.objects.filter(dyn__age__gt=21)``. The value can be a plain
+value, ``DynamicF('other_dynamic_field')`` or ``F('concrete_field')``.
+
+Querysets can also be ordered by dynamic fields, e.g.
+``order_by(DynamicF('age').desc())``, and aggregated over them, e.g.
+``aggregate(DynamicSum('age'))``.
+"""
+
+from collections import OrderedDict
+
+from django.core.exceptions import FieldError
+from django.db.models import F
+from django.db.models.sql import Query
+from django.db.models.sql.aggregates import Aggregate as SQLAggregate
+from django.db.models.sql.constants import LOOKUP_SEP
+
+from .backends import get_backend
+
+
+DYNAMIC_LOOKUP_PREFIX = 'dyn'
+
+LOOKUP_TYPES = ['exact', 'iexact', 'contains', 'icontains', 'gt', 'gte',
+    'lt', 'lte', 'in', 'startswith', 'istartswith', 'endswith', 'iendswith',
+    'range', 'isnull']
+
+# lookups that can compare against another column
+REFERENCE_LOOKUP_TYPES = ['exact', 'gt', 'gte', 'lt', 'lte']
+
+# prefix of the extra select aliases dynamic fields are ordered by
+ORDER_ALIAS_PREFIX = 'dyn_order_'
+
+NUMERIC_FIELD_TYPES = ['IntegerField']
+BOOLEAN_FIELD_TYPES = ['BooleanField', 'NullBooleanField']
+
+
+class DynamicF(object):
+    """Reference to a dynamic field, the dynamic counterpart of F()"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return "DynamicF(%r)" % self.name
+
+    def asc(self):
+        return DynamicOrdering(self.name)
+
+    def desc(self):
+        return DynamicOrdering(self.name, descending=True)
+
+
+class DynamicOrdering(object):
+    """Ordering by a dynamic field, see DynamicF.asc() and desc()"""
+
+    def __init__(self, name, descending=False):
+        self.name = name
+        self.descending = descending
+
+    def __repr__(self):
+        return "DynamicF(%r).%s()" % (self.name,
+            'desc' if self.descending else 'asc')
+
+
+class DynamicAggregate(object):
+    """Aggregate over a dynamic field, used like the aggregates in
+    django.db.models"""
+
+    name = None
+    sql_function = None
+    # the field types the aggregate works on, None for all of them
+    field_types = None
+    excluded_field_types = ()
+
+    def __init__(self, lookup, **extra):
+        self.lookup = lookup
+        self.extra = extra
+
+    @property
+    def default_alias(self):
+        return '%s__%s' % (self.lookup, self.name.lower())
+
+    def get_sql_aggregate(self, compiler, is_summary=True):
+        field_type = compiler.get_field_type(self.lookup)
+        if field_type in self.excluded_field_types or (
+            self.field_types is not None and
+                field_type not in self.field_types):
+            raise FieldError("Cannot compute %s('%s') of a %s" % (self.name,
+                self.lookup, field_type))
+        return DynamicSQLAggregate(self, compiler.extract_sql(self.lookup),
+            field_type, is_summary=is_summary, **self.extra)
+
+    def resolve(self, value, field_type):
+        """Converts the value returned by the database"""
+        if value is not None and field_type in NUMERIC_FIELD_TYPES:
+            return int(value)
+        return value
+
+
+class DynamicSum(DynamicAggregate):
+    name = 'Sum'
+    sql_function = 'SUM'
+    field_types = NUMERIC_FIELD_TYPES
+
+
+class DynamicAvg(DynamicAggregate):
+    name = 'Avg'
+    sql_function = 'AVG'
+    field_types = NUMERIC_FIELD_TYPES
+
+    def resolve(self, value, field_type):
+        return float(value) if value is not None else None
+
+
+class DynamicMin(DynamicAggregate):
+    name = 'Min'
+    sql_function = 'MIN'
+    excluded_field_types = BOOLEAN_FIELD_TYPES
+
+
+class DynamicMax(DynamicMin):
+    name = 'Max'
+    sql_function = 'MAX'
+
+
+class DynamicCount(DynamicAggregate):
+    """Number of rows that have a value for the dynamic field"""
+
+    name = 'Count'
+    sql_function = 'COUNT'
+
+    def __init__(self, lookup, distinct=False, **extra):
+        super(DynamicCount, self).__init__(lookup,
+            distinct='DISTINCT ' if distinct else '', **extra)
+
+    def resolve(self, value, field_type):
+        return int(value) if value is not None else 0
+
+
+class DynamicSQLAggregate(SQLAggregate):
+    """SQL of an aggregate over a dynamic field"""
+
+    def __init__(self, aggregate, value_sql, field_type, is_summary=True,
+        **extra):
+        self.aggregate = aggregate
+        self.sql_function = aggregate.sql_function
+        self.field_type = field_type
+        if 'distinct' in extra:
+            self.sql_template = '%(function)s(%(distinct)s%(field)s)'
+        super(DynamicSQLAggregate, self).__init__(value_sql,
+            is_summary=is_summary, **extra)
+
+    def resolve(self, value):
+        return self.aggregate.resolve(value, self.field_type)
+
+
+class DynamicAggregateQuery(Query):
+    """Query that leaves the conversion of the results of dynamic
+    aggregates to the aggregates"""
+
+    def resolve_aggregate(self, value, aggregate, connection):
+        if isinstance(aggregate, DynamicSQLAggregate):
+            return aggregate.resolve(value)
+        return super(DynamicAggregateQuery, self).resolve_aggregate(value,
+            aggregate, connection)
+
+
+class SQLValue(object):
+    """Literal SQL used as a value in QuerySet.update()"""
+
+    def __init__(self, sql, params):
+        self.sql = sql
+        self.params = params
+
+    def prepare_database_save(self, field):
+        return self
+
+    def as_sql(self, qn, connection):
+        return self.sql, self.params
+
+
+def is_dynamic_lookup(key):
+    return key.startswith(DYNAMIC_LOOKUP_PREFIX + LOOKUP_SEP)
+
+
+def is_dynamic_ordering(value):
+    return isinstance(value, (DynamicF, DynamicOrdering))
+
+
+def is_dynamic_ordering_alias(value):
+    return value.lstrip('-').startswith(ORDER_ALIAS_PREFIX)
+
+
+def get_dynamic_ordering_aliases(names):
+    """Returns the extra select names added for ordering by dynamic
+    fields"""
+    return [name for name in names if name.startswith(ORDER_ALIAS_PREFIX)]
+
+
+def split_dynamic_lookup(key):
+    """Returns field name and lookup type for a 'dyn__name__lookup' key"""
+    parts = key.split(LOOKUP_SEP)[1:]
+    if len(parts) > 1 and parts[-1] in LOOKUP_TYPES:
+        return LOOKUP_SEP.join(parts[:-1]), parts[-1]
+    return LOOKUP_SEP.join(parts), 'exact'
+
+
+def coerce_lookup_value(field_type, value):
+    """Converts a lookup value to the Python type the database compares
+    the dynamic field as"""
+    if value is None:
+        return None
+    if field_type == 'IntegerField':
+        return int(value)
+    if field_type in ('BooleanField', 'NullBooleanField'):
+        return bool(value)
+    return value
+
+
+class DynamicLookupCompiler(object):
+    """Builds SQL for dynamic field expressions of one model"""
+
+    def __init__(self, model, connection, field_types):
+        self.model = model
+        self.connection = connection
+        self.backend = get_backend(connection)
+        self.field_types = field_types
+
+        qn = connection.ops.quote_name
+        field = model._meta.get_field('extra_fields')
+        self.native = field.native
+        self.column_sql = "%s.%s" % (qn(model._meta.db_table),
+            qn(field.column))
+
+    def use_subquery_column(self):
+        """Refers to extra_fields by column name only, for aggregates
+        computed over a subquery of the rows"""
+        self.column_sql = self.connection.ops.quote_name(
+            self.model._meta.get_field('extra_fields').column)
+
+    def check_field(self, name):
+        if name not in self.field_types:
+            raise FieldError("Cannot resolve dynamic field '%s' of %s" % (
+                name, self.model.__name__))
+
+    def get_field_type(self, name):
+        self.check_field(name)
+        field_type = self.field_types[name]
+        if field_type is None:
+            raise FieldError("Dynamic field '%s' of %s has different types "
+                "in different schemas" % (name, self.model.__name__))
+        return field_type
+
+    def extract_sql(self, name):
+        return self.backend.extract_sql(self.column_sql, name,
+            self.get_field_type(name), self.native)
+
+    def reference_sql(self, value):
+        if isinstance(value, DynamicF):
+            return self.extract_sql(value.name)
+        qn = self.connection.ops.quote_name
+        column = self.model._meta.get_field(value.name).column
+        return "%s.%s" % (qn(self.model._meta.db_table), qn(column))
+
+    def lookup_sql(self, key, value):
+        """Returns a (sql, params) tuple for one 'dyn__...' lookup"""
+        name, lookup_type = split_dynamic_lookup(key)
+        field_type = self.get_field_type(name)
+        lhs = self.extract_sql(name)
+        ops = self.connection.ops
+
+        if isinstance(value, (DynamicF, F)):
+            if lookup_type not in REFERENCE_LOOKUP_TYPES:
+                raise FieldError("Lookup '%s' doesn't support field "
+                    "references" % lookup_type)
+            return "%s %s" % (lhs, self.connection.operators[lookup_type] %
+                self.reference_sql(value)), []
+
+        if lookup_type == 'isnull' or (lookup_type == 'exact' and
+            value is None):
+            negate = lookup_type == 'isnull' and not value
+            return "%s IS %sNULL" % (lhs, 'NOT ' if negate else ''), []
+
+        if lookup_type == 'in':
+            values = [coerce_lookup_value(field_type, el) for el in value]
+            if not values:
+                return "1 = 0", []
+            return "%s IN (%s)" % (lhs, ', '.join(['%s'] * len(values))), \
+                values
+
+        if lookup_type == 'range':
+            return "%s BETWEEN %%s AND %%s" % lhs, [
+                coerce_lookup_value(field_type, el) for el in value]
+
+        if lookup_type in ('contains', 'icontains'):
+            value = "%%%s%%" % ops.prep_for_like_query(value)
+        elif lookup_type in ('startswith', 'istartswith'):
+            value = "%s%%" % ops.prep_for_like_query(value)
+        elif lookup_type in ('endswith', 'iendswith'):
+            value = "%%%s" % ops.prep_for_like_query(value)
+        elif lookup_type == 'iexact':
+            value = ops.prep_for_iexact_query(value)
+        else:
+            value = coerce_lookup_value(field_type, value)
+
+        return "%s %s" % (ops.lookup_cast(lookup_type) % lhs,
+            self.connection.operators[lookup_type] % '%s'), [value]
+
+    def where(self, lookups):
+        """Returns (where, params) lists for QuerySet.extra()"""
+        where, params = [], []
+        for key, value in sorted(lookups.items()):
+            sql, lookup_params = self.lookup_sql(key, value)
+            where.append(sql)
+            params.extend(lookup_params)
+        return where, params
+
+    def ordering(self, field_names):
+        """Returns (select, order_by) for QuerySet.extra() that order by
+        the given concrete and dynamic fields"""
+        select, order_by = OrderedDict(), []
+        for field_name in field_names:
+            if not is_dynamic_ordering(field_name):
+                order_by.append(field_name)
+                continue
+            alias = ORDER_ALIAS_PREFIX + field_name.name
+            select[alias] = self.extract_sql(field_name.name)
+            order_by.append('-' + alias if getattr(field_name, 'descending',
+                False) else alias)
+        return select, order_by
+
+    def update_value(self, values):
+        """Returns a value for updating extra_fields with QuerySet.update(),
+        setting the dynamic fields in ``values`` and keeping the others.
+        Plain values are stored as given, they have to be converted to the
+        field types already."""
+        field = self.model._meta.get_field('extra_fields')
+        sql_values, params = [], []
+        for name, value in sorted(values.items()):
+            self.get_field_type(name)
+            if isinstance(value, DynamicF):
+                self.check_field(value.name)
+                value_sql = self.backend.extract_json_sql(self.column_sql,
+                    value.name, self.native)
+            elif isinstance(value, F):
+                value_sql = self.backend.to_json_sql(
+                    self.reference_sql(value))
+            else:
+                value_sql = self.backend.json_param_sql
+                params.append(field.dumps(value))
+            sql_values.append((name, value_sql))
+        return SQLValue(self.backend.update_keys_sql(self.column_sql,
+            sql_values, native=self.native), params)
@@ -0,0 +1,135 @@
+"""
+Microbenchmarks for the hot paths of dynamicmodel.
+
+Run with ``python manage.py benchmark [name ...]``; a fresh test database
+is created for the run, so the command is safe to use on the test project.
+"""
+
+from optparse import make_option
+import datetime
+import decimal
+import json
+import time
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from dynamicmodel.models import DynamicSchema
+from dynamicmodel.jsoncodecs import JSONCodec, UJSONCodec
+from testapp.tests import TestModel
+
+
+def timed(func, repeat):
+    start = time.time()
+    for i in xrange(repeat):
+        func()
+    return (time.time() - start) / repeat
+
+
+def reset_schema(model_class, num_fields, field_type='CharField'):
+    schema = DynamicSchema.get_for_model(model_class)
+    schema.fields.all().delete()
+    schema = DynamicSchema.get_for_model(model_class)
+    for i in range(num_fields):
+        schema.add_field('field_%d' % i, field_type)
+    return DynamicSchema.get_for_model(model_class)
+
+
+def bench_instantiation(command, options):
+    """Cost of building a model instance from a DB row as the number of
+    dynamic fields grows"""
+    for num_fields in (0, 10, 50, 100):
+        reset_schema(TestModel, num_fields)
+        extra_fields = json.dumps(dict(('field_%d' % i, 'value')
+            for i in range(num_fields)))
+        row = (1, extra_fields, '', 'about')
+        per_call = timed(lambda: TestModel(*row), options['repeat'])
+        command.stdout.write("instantiation  %4d dynamic fields  %8.1f us\n" %
+            (num_fields, per_call * 1e6))
+
+
+def make_payload(num_keys):
+    """extra_fields payload with a realistic mix of value types"""
+    values = [
+        u'John Doe', 42, True, None, u'john.doe@example.com',
+        u'A somewhat longer free form text value, as entered in a textarea.',
+        datetime.date(2012, 10, 18), decimal.Decimal('1234.50'),
+    ]
+    return dict(('field_%d' % i, values[i % len(values)])
+        for i in range(num_keys))
+
+
+def bench_codecs(command, options):
+    """Encode/decode throughput of the JSON codecs on extra_fields-like
+    payloads"""
+    codecs = [('json', JSONCodec)]
+    if UJSONCodec.available:
+        codecs.append(('ujson', UJSONCodec))
+    else:
+        command.stdout.write("codecs  ujson is not installed, skipping\n")
+
+    for num_keys in (10, 100, 1000):
+        payload = make_payload(num_keys)
+        text = JSONCodec().dumps(payload)
+        repeat = max(1, options['repeat'] * 10 / num_keys)
+        for name, codec_class in codecs:
+            codec = codec_class()
+            encode = timed(lambda: codec.dumps(payload), repeat)
+            decode = timed(lambda: codec.loads(text), repeat)
+            command.stdout.write("codecs  %-10s %4d keys  encode %8.1f us  "
+                "decode %8.1f us\n" % (name, num_keys, encode * 1e6,
+                    decode * 1e6))
+
+
+def bench_bulk_create(command, options):
+    """Insert throughput of save() per instance compared to
+    bulk_create_dynamic() for rows with dynamic fields"""
+    num_rows = options['repeat']
+    for num_fields in (10, 50):
+        reset_schema(TestModel, num_fields, 'IntegerField')
+        rows = [dict(('field_%d' % i, str(i)) for i in range(num_fields))
+            for j in range(num_rows)]
+
+        def save_each():
+            for row in rows:
+                model = TestModel()
+                for name, value in row.items():
+                    setattr(model, name, int(value))
+                model.save()
+
+        for name, func in [('save', save_each),
+            ('bulk_create_dynamic',
+                lambda: TestModel.objects.bulk_create_dynamic(rows))]:
+            TestModel.objects.all().delete()
+            elapsed = timed(func, 1)
+            command.stdout.write("bulk_create  %4d dynamic fields  %-19s "
+                "%8.0f rows/s\n" % (num_fields, name, num_rows / elapsed))
+
+
+BENCHMARKS = {
+    'bulk_create': bench_bulk_create,
+    'codecs': bench_codecs,
+    'instantiation': bench_instantiation,
+}
+
+
+class Command(BaseCommand):
+    args = '[benchmark ...]'
+    help = 'Runs dynamicmodel microbenchmarks (%s).' % ', '.join(
+        sorted(BENCHMARKS))
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat', action='store', dest='repeat', type='int',
+            default=1000, help='Number of iterations per measurement.'),
+    )
+
+    def handle(self, *args, **options):
+        names = args or sorted(BENCHMARKS)
+        for name in names:
+            if name not in BENCHMARKS:
+                raise CommandError("Unknown benchmark: %s" % name)
+
+        connection.creation.create_test_db(verbosity=0)
+        cache.clear()
+        for name in names:
+            BENCHMARKS[name](self, options)
@@ -2,13 +2,119 @@
 Tests for DynamicModel, DynamicModelWithSchema and DynamicForm
 """
 
-from django.test import TestCase
+from StringIO import StringIO
+from collections import OrderedDict
+import datetime
+import decimal
+import json
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+import time
+import warnings
+
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
+from django.utils.unittest import skipUnless
 from dynamicmodel.models import DynamicModel, DynamicForm, DynamicSchema, \
-    DynamicSchemaField
-from django.db import models
-from django.core.exceptions import ValidationError
+    DynamicSchemaField, local_schema_cache
+from dynamicmodel.cache import LocalSchemaCache
+from dynamicmodel import models as dynamicmodel_models
+from dynamicmodel.fields import JSONField, LazyJSON
+from dynamicmodel.query import DynamicF, DynamicSum, DynamicAvg, \
+    DynamicMin, DynamicMax, DynamicCount
+from dynamicmodel.indexes import INDEX_PREFIX, get_index_name, \
+    sync_dynamic_indexes
+from dynamicmodel.backends import get_backend, PostgreSQLJSONBackend, \
+    SQLiteJSONBackend
+from dynamicmodel.jsoncodecs import JSONCodec, UJSONCodec, get_codec
+from dynamicmodel.converters import compile_converter, convert_rows, \
+    get_converters
+from dynamicmodel.export import export_csv, export_jsonl
+from dynamicmodel.importer import Importer
+from dynamicmodel.backfill import Backfill, RemoveField, RenameField, \
+    ConvertField
+from django.db import models, connection, connections, DatabaseError
+from django.core.management import call_command, load_command_class
+from django.core.management.base import CommandError
+from django.core.exceptions import ValidationError, ImproperlyConfigured, \
+    FieldError
 
 from django.core.cache import cache
+from django.core.cache.backends.filebased import FileBasedCache
+
+
+class CountCacheCalls(object):
+    """Records the names of cache methods called by dynamicmodel"""
+
+    def __enter__(self):
+        calls = self.calls = []
+
+        class CountingCache(object):
+            def __getattr__(self, name):
+                calls.append(name)
+                return getattr(cache, name)
+
+        dynamicmodel_models.cache = CountingCache()
+        return calls
+
+    def __exit__(self, *exc_info):
+        dynamicmodel_models.cache = cache
+
+
+class SharedFileCache(FileBasedCache):
+    """File based cache with an atomic add(), like memcached's, for
+    sharing a cache between processes"""
+
+    def add(self, key, value, timeout=None, version=None):
+        lock_path = os.path.join(self._dir, 'add.lock')
+        while True:
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL)
+                break
+            except OSError:
+                time.sleep(0.001)
+        try:
+            return super(SharedFileCache, self).add(key, value, timeout,
+                version)
+        finally:
+            os.close(fd)
+            os.remove(lock_path)
+
+
+def get_schema_field_names(start, results):
+    start.wait()
+    schema = DynamicSchema.get_for_model(TestModel)
+    results.put(sorted(field.name for field in schema.fields.all()))
+
+
+class RecordingCodec(JSONCodec):
+    calls = []
+
+    def dumps(self, value):
+        self.calls.append('dumps')
+        return super(RecordingCodec, self).dumps(value)
+
+    def loads(self, value):
+        self.calls.append('loads')
+        return super(RecordingCodec, self).loads(value)
+
+
+class UnavailableCodec(JSONCodec):
+    available = False
+
+
+def run_command(name, *args, **options):
+    """Runs a dynamicmodel management command, letting CommandError
+    propagate instead of exiting"""
+    command = load_command_class('dynamicmodel', name)
+    defaults = dict((option.dest, option.default)
+        for option in command.option_list)
+    defaults.update(options)
+    command.stdout = command.stderr = StringIO()
+    return command.handle(*args, **defaults)
 
 
 class TestModel(DynamicModel):
@@ -32,6 +138,11 @@ class TestForm(DynamicForm):
         model = TestModel
 
 
+class NullableModel(DynamicModel):
+
+    note = models.CharField(max_length=100, null=True)
+
+
 class M2MModel(models.Model):
 
     testmodels = models.ManyToManyField(TestModel)
@@ -181,6 +292,14 @@ class DynamicModelTest(TestCase):
 
         self.assertRaises(ValidationError, dsf.save)
 
+    def test_invalid_name(self):
+
+        schema = TestModel().get_schema()
+        for name in ["nick'name", "nickname\n", "nick name", ""]:
+            self.assertRaises(ValidationError, DynamicSchemaField(
+                schema=schema, name=name, field_type='CharField').save)
+        self.assertFalse(schema.fields.exists())
+
     def test_delete_schema_field(self):
 
         model = TestModel()
@@ -204,6 +323,50 @@ class DynamicModelTest(TestCase):
         # attr 'field_two' still exists
         self.assertTrue(hasattr(fresh_model, 'field_two'))
 
+    def test_schema_editor(self):
+        schema = DynamicSchema.get_for_model(TestModel)
+        schema.add_field('old', 'CharField')
+        schema = DynamicSchema.get_for_model(TestModel)
+
+        # existing names, the inserts and one rebuild of the schema
+        with self.assertNumQueries(3):
+            schema = schema.add_fields([('field_%d' % i, 'CharField')
+                for i in range(80)] + [{'name': 'age', 'type': 'IntegerField',
+                    'required': True}])
+        self.assertEqual(len(schema.get_extra_field_names()), 82)
+
+        with schema.edit() as editor:
+            editor.remove_field('old')
+            editor.remove_field('age')
+            editor.add_field('age', 'CharField', extra={'a': 1})
+        schema = DynamicSchema.get_for_model(TestModel)
+        self.assertNotIn('old', schema.get_extra_field_names())
+        self.assertEqual([(f.field_type, f.required, f.extra)
+            for f in schema.fields.all() if f.name == 'age'],
+            [('CharField', False, {'a': 1})])
+
+    def test_schema_editor_validation(self):
+        schema = DynamicSchema.get_for_model(TestModel)
+        schema.add_field('old', 'CharField')
+        try:
+            schema.add_fields([('old', 'CharField'), ('new', 'Wrong'),
+                ('bad name', 'CharField'), ('new', 'CharField')])
+        except ValidationError as e:
+            self.assertEqual(sorted(e.message_dict), ['bad name', 'new',
+                'old'])
+        else:
+            self.fail("add_fields() didn't raise ValidationError")
+        self.assertRaises(ValidationError, schema.remove_fields, ['missing'])
+        self.assertEqual(DynamicSchema.get_for_model(TestModel)
+            .get_extra_field_names(), frozenset(['old']))
+
+        with self.assertRaises(KeyError):
+            with schema.edit() as editor:
+                editor.remove_field('old')
+                raise KeyError
+        self.assertEqual(DynamicSchemaField.objects.filter(
+            schema=schema).count(), 1)
+
     def test_manually_create_schema_typeless(self):
         schema = DynamicSchema.get_for_model(TypelessModel)
         schema.add_field(name='field', type='CharField')
@@ -320,6 +483,41 @@ class DynamicModelCachingTest(TestCase):
             self.assertEqual(
                 DynamicSchema.get_for_model(TestModel).fields.count(), 0)
 
+    def test_delete_schema_fields_renews_each_schema_once(self):
+        for type_value in ('email', 'contact'):
+            schema = DynamicSchema.get_for_model(TestModel, type_value)
+            schema.add_field('one', 'CharField')
+            schema.add_field('two', 'CharField')
+        DynamicSchema.get_for_model(TestModel).add_field('one', 'CharField')
+
+        # one select, one delete and a rebuild query per schema
+        with self.assertNumQueries(4):
+            result = DynamicSchemaField.objects.filter(
+                schema__type_value__in=['email', 'contact'],
+                name__in=['one', 'two']).exclude(schema__type_value='contact',
+                name='two').delete()
+        self.assertEqual(result, (3, {'dynamicmodel.DynamicSchemaField': 3}))
+
+        with self.assertNumQueries(0):
+            self.assertEqual(DynamicSchema.get_for_model(TestModel, 'email')
+                .get_extra_field_names(), frozenset())
+            self.assertEqual(DynamicSchema.get_for_model(TestModel,
+                'contact').get_extra_field_names(), frozenset(['two']))
+            self.assertEqual(DynamicSchema.get_for_model(TestModel)
+                .get_extra_field_names(), frozenset(['one']))
+        self.assertEqual(DynamicSchemaField.objects.filter(
+            name='missing').delete(), (0, {}))
+
+    def test_delete_many_schema_fields(self):
+        DynamicSchema.get_for_model(TestModel).add_fields(
+            [('field_%d' % i, 'CharField') for i in range(1200)])
+        # a select, a delete per 100 fields and the rebuild query
+        with self.assertNumQueries(14):
+            self.assertEqual(DynamicSchemaField.objects.all().delete(),
+                (1200, {'dynamicmodel.DynamicSchemaField': 1200}))
+        self.assertEqual(DynamicSchema.get_for_model(TestModel)
+            .get_extra_field_names(), frozenset())
+
     def test_delete_schema_qs_clears_cache(self):
         DynamicSchema.get_for_model(TestModel)
         self.assertIsNotNone(
@@ -356,6 +554,1477 @@ class DynamicModelCachingTest(TestCase):
         self.assertIsNone(
             cache.get(DynamicSchema.get_cache_key_static(TestModel, '')))
 
+    def test_local_cache_returns_same_schema(self):
+        schema = DynamicSchema.get_for_model(TestModel)
+        self.assertIs(DynamicSchema.get_for_model(TestModel), schema)
+
+    def test_local_cache_picks_up_renewal_from_other_worker(self):
+        schema = DynamicSchema.get_for_model(TestModel)
+        # simulate another worker publishing a new schema version
+        # straight into the shared cache
+        DynamicSchemaField(schema=schema, name='field',
+            field_type='CharField').save_base()
+        renewed = DynamicSchema.objects.prefetch_related('fields').get(
+            id=schema.id)
+        cache.set(schema.get_cache_key(), renewed.get_snapshot(1))
+        cache.set(DynamicSchema.get_version_key_static(TestModel, ''), 1)
+
+        fresh = DynamicSchema.get_for_model(TestModel)
+        self.assertIsNot(fresh, schema)
+        self.assertEqual([f.name for f in fresh.fields.all()], ['field'])
+        self.assertIs(DynamicSchema.get_for_model(TestModel), fresh)
+
+    def test_local_cache_cleared_by_schema_delete(self):
+        schema = DynamicSchema.get_for_model(TestModel)
+        version = DynamicSchema.get_version_static(TestModel, '')
+        schema.delete()
+        self.assertGreater(
+            DynamicSchema.get_version_static(TestModel, ''), version)
+        self.assertNotEqual(DynamicSchema.get_for_model(TestModel).id,
+            schema.id)
+
+    def test_cached_snapshot(self):
+        schema = DynamicSchema.get_for_model(TestModel)
+        schema.add_field('field', 'CharField')
+        version = DynamicSchema.get_version_static(TestModel, '')
+        snapshot = cache.get(schema.get_cache_key())
+        self.assertEqual(snapshot[0], version)
+        self.assertEqual(snapshot[4][0][1:4], ('field', None, 'CharField'))
+
+        local_schema_cache.clear()
+        with self.assertNumQueries(0):
+            schema = DynamicSchema.get_for_model(TestModel)
+            self.assertEqual([(f.name, f.schema) for f in schema.fields.all()],
+                [('field', schema)])
+            self.assertEqual(schema.model.model_class(), TestModel)
+
+    def test_rebuild_queries(self):
+        DynamicSchemaField.objects.create(
+            schema=DynamicSchema.get_for_model(TestModel), name='field',
+            field_type='CharField', required=True, extra={'a': 1})
+        cache.clear()
+        local_schema_cache.clear()
+        with self.assertNumQueries(1):
+            schema = DynamicSchema.get_for_model(TestModel)
+        field = schema.fields.all()[0]
+        self.assertEqual((field.name, field.required, field.extra),
+            ('field', True, {'a': 1}))
+
+        with self.assertNumQueries(2):
+            # the new schema is inserted
+            DynamicSchema.get_for_model(TestModel, 'new')
+        with self.assertNumQueries(0):
+            DynamicSchema.get_for_model(TestModel, 'new')
+
+    def test_create_schema_tolerates_existing(self):
+        schema = DynamicSchema.get_for_model(TestModel)
+        self.assertEqual(DynamicSchema.create_schema_static(
+            schema.model_id, ''), schema.id)
+        self.assertEqual(DynamicSchema.objects.count(), 1)
+
+    def test_stale_snapshot_rebuilt(self):
+        schema = DynamicSchema.get_for_model(TestModel)
+        version = DynamicSchema.get_version_static(TestModel, '')
+        DynamicSchemaField(schema=schema, name='field',
+            field_type='CharField').save_base()
+        DynamicSchema.invalidate_cache_static(TestModel, '')
+        self.assertEqual(DynamicSchema.get_version_static(TestModel, ''),
+            version + 1)
+
+        fresh = DynamicSchema.get_for_model(TestModel)
+        self.assertEqual([f.name for f in fresh.fields.all()], ['field'])
+        self.assertEqual(cache.get(schema.get_cache_key())[0], version + 1)
+
+    def test_instantiation_resolves_schema_once(self):
+        schema = DynamicSchema.get_for_model(TestModel)
+        for i in range(20):
+            schema.add_field('field_%d' % i, 'CharField')
+        TestModel()
+
+        with CountCacheCalls() as calls:
+            model = TestModel(about='about', type='')
+            self.assertEqual(calls, ['get'])
+            for i in range(10):
+                model.field_0 = 'value %d' % i
+                model.field_1
+            self.assertEqual(calls, ['get'])
+        self.assertEqual(model.extra_fields['field_0'], 'value 9')
+
+    def test_schema_field_names(self):
+        schema = DynamicSchema.get_for_model(TestModel)
+        schema.add_field('field', 'CharField')
+        schema = DynamicSchema.get_for_model(TestModel)
+
+        self.assertEqual(schema.get_extra_field_names(),
+            frozenset(['field']))
+        self.assertTrue(set(['id', 'type', 'about', 'extra_fields']) <=
+            schema.get_concrete_field_names())
+
+    def test_local_cache_evicts_least_recently_used(self):
+        local_cache = LocalSchemaCache(2)
+        local_cache.set('a', 1, 'A')
+        local_cache.set('b', 1, 'B')
+        local_cache.get('a', 1)
+        local_cache.set('c', 1, 'C')
+
+        self.assertEqual(len(local_cache), 2)
+        self.assertEqual(local_cache.get('a', 1), 'A')
+        self.assertIsNone(local_cache.get('b', 1))
+        self.assertIsNone(local_cache.get('c', 2))
+
+
+class SchemaRebuildLockTest(TestCase):
+    num_processes = 6
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        dynamicmodel_models.cache = SharedFileCache(self.cache_dir, {})
+        local_schema_cache.clear()
+        schema = DynamicSchema.get_for_model(TestModel)
+        schema.add_field('a', 'CharField')
+        DynamicSchemaField(schema=schema, name='b',
+            field_type='CharField').save_base()
+
+        self.rebuilds = multiprocessing.Value('i', 0)
+        rebuilds = self.rebuilds
+        rebuild = DynamicSchema.rebuild_cache_static.im_func
+
+        def slow_rebuild(cls, model_class, type_value):
+            with rebuilds.get_lock():
+                rebuilds.value += 1
+            time.sleep(0.2)
+            return rebuild(cls, model_class, type_value)
+        DynamicSchema.rebuild_cache_static = classmethod(slow_rebuild)
+        self.original_rebuild = rebuild
+
+    def tearDown(self):
+        DynamicSchema.rebuild_cache_static = classmethod(
+            self.original_rebuild)
+        dynamicmodel_models.cache = cache
+        local_schema_cache.clear()
+        shutil.rmtree(self.cache_dir)
+
+    def get_field_names_concurrently(self):
+        local_schema_cache.clear()
+        start = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=get_schema_field_names,
+            args=(start, results)) for i in range(self.num_processes)]
+        for process in processes:
+            process.start()
+        start.set()
+        names = [results.get(timeout=10) for process in processes]
+        for process in processes:
+            process.join()
+        return names
+
+    def test_stale_schema_served_during_rebuild(self):
+        DynamicSchema.invalidate_cache_static(TestModel, '')
+        names = self.get_field_names_concurrently()
+        self.assertEqual(self.rebuilds.value, 1)
+        self.assertIn(['a', 'b'], names)
+        self.assertEqual(set(map(tuple, names)) - set([('a',), ('a', 'b')]),
+            set())
+
+    def test_others_wait_for_rebuild(self):
+        DynamicSchema.clear_cache_static(TestModel, '')
+        names = self.get_field_names_concurrently()
+        self.assertEqual(self.rebuilds.value, 1)
+        self.assertEqual(names, [['a', 'b']] * self.num_processes)
+
+
+class DynamicModelIterationTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        DynamicSchema.get_for_model(TestModel, 'email').add_field('email',
+            'EmailField')
+        DynamicSchema.get_for_model(TestModel, 'contact').add_field('phone',
+            'CharField')
+        for i in range(4):
+            model = TestModel.objects.create(about='email %d' % i,
+                type='email')
+            model.email = 'john%d@example.com' % i
+            model.save()
+            model = TestModel.objects.create(about='contact %d' % i,
+                type='contact')
+            model.phone = '555-%d' % i
+            model.save()
+
+    def test_iterator_dynamic_matches_iteration(self):
+        expected = [(el.id, el.type, el.about, el.extra_fields)
+            for el in TestModel.objects.order_by('id')]
+        self.assertEqual(expected, [(el.id, el.type, el.about, el.extra_fields)
+            for el in TestModel.objects.order_by('id').iterator_dynamic()])
+
+    def test_iterator_dynamic_resolves_schema_once_per_chunk(self):
+        qs = TestModel.objects.order_by('id')
+        with CountCacheCalls() as calls:
+            models = list(qs.iterator_dynamic(chunk_size=4))
+            # two chunks with two type values each
+            self.assertEqual(calls, ['get_many', 'get_many'])
+            [el.email if el.type == 'email' else el.phone for el in models]
+            self.assertEqual(len(calls), 2)
+        self.assertFalse(models[0]._state.adding)
+
+    def test_iterator_dynamic_coerce(self):
+        DynamicSchema.get_for_model(TestModel, 'email').add_fields([
+            ('age', 'IntegerField'), ('active', 'NullBooleanField')])
+        TestModel.objects.filter(about='email 0').update(
+            extra_fields={'email': 'john0@example.com', 'age': '30',
+                'active': 'true'})
+        TestModel.objects.filter(about='email 1').update(
+            extra_fields={'email': 'john1@example.com', 'age': 'thirty'})
+        qs = TestModel.objects.filter(type='email').order_by('id')
+
+        self.assertEqual([el.age for el in qs.iterator_dynamic()],
+            ['30', 'thirty', None, None])
+        models = list(qs.iterator_dynamic(coerce=True))
+        self.assertEqual([(el.age, el.active) for el in models],
+            [(30, True), ('thirty', None), (None, None), (None, None)])
+        self.assertEqual(models[0].get_dirty_fields(), set())
+        self.assertRaises(ValidationError, list,
+            qs.iterator_dynamic(coerce=True, strict=True))
+
+    def test_coerce_on_load(self):
+        DynamicSchema.get_for_model(TestModel, 'email').add_field('age',
+            'IntegerField')
+        TestModel.objects.filter(about='email 0').update(
+            extra_fields={'email': 'john0@example.com', 'age': '30'})
+        TestModel.objects.filter(about='email 1').update(
+            extra_fields={'email': 'john1@example.com', 'age': 'thirty'})
+        qs = TestModel.objects.filter(type='email').order_by('id')
+
+        TestModel.coerce_on_load = True
+        try:
+            with CountCacheCalls() as calls:
+                models = list(qs.all())
+            # coercion looks the schemas up once for the chunk
+            self.assertEqual(calls.count('get_many'), 1)
+            self.assertEqual([el.age for el in models],
+                [30, 'thirty', None, None])
+            self.assertEqual(models[0].get_dirty_fields(), set())
+            self.assertEqual(qs.get(about='email 0').age, 30)
+            self.assertEqual([el.age for el in qs.iterator_dynamic()],
+                [30, 'thirty', None, None])
+
+            TestModel.coerce_on_load = 'strict'
+            self.assertRaises(ValidationError, list, qs.all())
+            self.assertEqual(qs.filter(about='email 0')[0].age, 30)
+        finally:
+            TestModel.coerce_on_load = False
+        self.assertEqual(qs[0].age, '30')
+
+    def test_pickle_instances(self):
+        qs = TestModel.objects.filter(type='email').order_by('id')
+        for model in [qs[0], list(qs.iterator_dynamic(coerce=True))[0]]:
+            unpickled = pickle.loads(pickle.dumps(model))
+            self.assertNotIn('_schema', unpickled.__dict__)
+            self.assertEqual((unpickled.about, unpickled.email),
+                ('email 0', 'john0@example.com'))
+            self.assertEqual(unpickled.get_schema().pk, model.get_schema().pk)
+            self.assertEqual(unpickled.get_dirty_fields(), set())
+
+        # an undecoded lazy document holds a load hook
+        field = TestModel._meta.get_field('extra_fields')
+        model = qs[0]
+        lazy = LazyJSON(field.dumps({'email': 'lazy@example.com'}),
+            field.loads)
+        lazy.on_load = lambda value: model._on_extra_fields_load()
+        model.__dict__['extra_fields'] = lazy
+        unpickled = pickle.loads(pickle.dumps(model))
+        self.assertEqual(unpickled.extra_fields, {'email': 'lazy@example.com'})
+
+    def test_convert_rows(self):
+        DynamicSchemaField.objects.create(
+            schema=DynamicSchema.get_for_model(TestModel, 'email'),
+            name='age', field_type='IntegerField', required=True)
+        schema = DynamicSchema.get_for_model(TestModel, 'email')
+        rows = [{'email': 'a@example.com', 'age': 1},
+            {'email': 5, 'age': '2'}, {'email': None, 'age': 'x'}]
+        convert_rows(get_converters(schema), rows)
+        # the invalid email and age are kept
+        self.assertEqual(rows, [{'email': 'a@example.com', 'age': 1},
+            {'email': 5, 'age': 2}, {'email': None, 'age': 'x'}])
+
+        try:
+            convert_rows(get_converters(schema), [{'email': 'a@example.com'}],
+                strict=True)
+        except ValidationError as e:
+            self.assertEqual(e.message_dict.keys(), ['age'])
+        else:
+            self.fail("convert_rows() didn't raise ValidationError")
+
+    def test_pickle_schema_with_converters(self):
+        schema = DynamicSchema.get_for_model(TestModel, 'email')
+        converters = get_converters(schema)
+        schema = pickle.loads(pickle.dumps(schema))
+        self.assertNotIn('_converters', schema.__dict__)
+        self.assertEqual(sorted(get_converters(schema)), sorted(converters))
+
+    def test_get_many_for_model(self):
+        DynamicSchema.get_for_model(TestModel, 'other')
+        type_values = ['email', 'contact', 'other']
+
+        with CountCacheCalls() as calls:
+            with self.assertNumQueries(0):
+                schemas = DynamicSchema.get_many_for_model(TestModel,
+                    type_values)
+        self.assertEqual(calls, ['get_many'])
+        self.assertEqual(dict((key, [f.name for f in value.fields.all()])
+            for key, value in schemas.items()),
+            {'email': ['email'], 'contact': ['phone'], 'other': []})
+
+        local_schema_cache.clear()
+        with CountCacheCalls() as calls:
+            with self.assertNumQueries(0):
+                DynamicSchema.get_many_for_model(TestModel, type_values)
+        self.assertEqual(calls, ['get_many', 'get_many'])
+
+        cache.clear()
+        with self.assertNumQueries(1):
+            schemas = DynamicSchema.get_many_for_model(TestModel,
+                type_values)
+        self.assertEqual([f.name for f in schemas['email'].fields.all()],
+            ['email'])
+        with self.assertNumQueries(0):
+            DynamicSchema.get_many_for_model(TestModel, type_values)
+
+    def test_get_many_across_models(self):
+        keys = [(TestModel, 'email'), (TypelessModel, ''), (TestModel, 'new')]
+        schemas = DynamicSchema.objects.get_many(keys)
+        self.assertEqual(sorted(schemas), sorted(keys))
+        self.assertEqual(schemas[(TypelessModel, '')].model.model_class(),
+            TypelessModel)
+        self.assertEqual(schemas[(TestModel, 'new')].id,
+            DynamicSchema.objects.get(type_value='new').id)
+        self.assertIs(DynamicSchema.get_for_model(TestModel, 'new'),
+            schemas[(TestModel, 'new')])
+
+    def test_iterator_dynamic_keeps_extra_select(self):
+        model = next(TestModel.objects.extra(select={'double_id': 'id * 2'})
+            .iterator_dynamic())
+        self.assertEqual(model.double_id, model.id * 2)
+
+    def test_iterator_dynamic_rejects_deferred_fields(self):
+        self.assertRaises(ValueError, list,
+            TestModel.objects.only('about').iterator_dynamic())
+
+
+class DirtyTrackingTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        schema = DynamicSchema.get_for_model(TestModel)
+        schema.add_field('age', 'IntegerField')
+        schema.add_field('tags', 'CharField')
+        model = TestModel(about='about')
+        model.age = 21
+        model.tags = ['a']
+        model.save()
+        self.model = TestModel.objects.get(id=model.id)
+        # the JSON support check runs once per connection
+        get_backend(connection).is_supported()
+
+    def get_update_sql(self, func):
+        start = len(connection.queries)
+        func()
+        queries = [q['sql'] for q in connection.queries[start:]]
+        self.assertEqual(len(queries), 1)
+        self.assertTrue(queries[0].startswith('UPDATE'))
+        return queries[0]
+
+    def test_unchanged_instance_not_saved(self):
+        self.assertEqual(self.model.get_dirty_fields(), set())
+        with self.assertNumQueries(0):
+            self.model.save()
+
+    def test_dirty_fields(self):
+        self.model.about = 'about'
+        self.assertEqual(self.model.get_dirty_fields(), set())
+        self.model.about = 'changed'
+        self.model.age = 30
+        self.model.tags.append('b')
+        self.assertEqual(self.model.get_dirty_fields(),
+            set(['about', 'age', 'tags']))
+
+    def test_only_dirty_columns_written(self):
+        connection.use_debug_cursor = True
+        try:
+            self.model.age = 30
+            sql = self.get_update_sql(self.model.save)
+            self.assertIn('"extra_fields"', sql)
+            self.assertNotIn('"about"', sql)
+
+            self.model.about = 'changed'
+            sql = self.get_update_sql(self.model.save)
+            self.assertIn('"about"', sql)
+            self.assertNotIn('"extra_fields"', sql)
+        finally:
+            connection.use_debug_cursor = False
+
+        model = TestModel.objects.get(id=self.model.id)
+        self.assertEqual((model.about, model.age), ('changed', 30))
+        self.assertEqual(model.get_dirty_fields(), set())
+
+    def test_update_fields_with_dynamic_names(self):
+        self.model.about = 'changed'
+        self.model.age = 30
+        with self.assertNumQueries(1):
+            self.model.save(update_fields=['age'])
+        model = TestModel.objects.get(id=self.model.id)
+        self.assertEqual((model.about, model.age), ('about', 30))
+        self.assertRaises(ValueError, self.model.save,
+            update_fields=['missing'])
+
+    def test_deleted_row(self):
+        TestModel.objects.filter(id=self.model.id).delete()
+        self.model.age = 30
+        self.assertRaises(DatabaseError, self.model.save,
+            update_fields=['age'])
+        self.model.save()
+        self.assertEqual(TestModel.objects.get(id=self.model.id).age, 30)
+
+    def test_partial_update_of_dynamic_keys(self):
+        connection.use_debug_cursor = True
+        try:
+            self.model.age = 30
+            sql = self.get_update_sql(self.model.save)
+            self.assertIn('json_set', sql)
+            self.assertNotIn('"tags"', sql)
+
+            self.model.extra_fields = {'age': 31, 'tags': None}
+            sql = self.get_update_sql(self.model.save)
+            self.assertNotIn('json_set', sql)
+
+            with override_settings(DYNAMICMODEL_PARTIAL_UPDATES=False):
+                self.model.age = 32
+                sql = self.get_update_sql(self.model.save)
+                self.assertNotIn('json_set', sql)
+        finally:
+            connection.use_debug_cursor = False
+
+    def test_partial_update_without_json_support(self):
+        class UnsupportedBackend(SQLiteJSONBackend):
+            check_sql = "SELECT no_such_json_function('{}')"
+
+        del connections['default']._dynamicmodel_json
+        try:
+            self.assertFalse(UnsupportedBackend(connection).is_supported())
+            with self.assertNumQueries(0):
+                self.assertFalse(UnsupportedBackend(connection).is_supported())
+            connection.use_debug_cursor = True
+            self.model.age = 30
+            sql = self.get_update_sql(self.model.save)
+            self.assertNotIn('json_set', sql)
+        finally:
+            connection.use_debug_cursor = False
+            del connections['default']._dynamicmodel_json
+        self.assertEqual(TestModel.objects.get(id=self.model.id).age, 30)
+        self.assertTrue(get_backend(connection).is_supported())
+
+    def test_concurrent_edits_of_different_keys(self):
+        other = TestModel.objects.get(id=self.model.id)
+        self.model.age = 30
+        other.tags = ['b', {'nested': True}]
+        self.model.save()
+        other.save()
+
+        model = TestModel.objects.get(id=self.model.id)
+        self.assertEqual(model.age, 30)
+        self.assertEqual(model.tags, ['b', {'nested': True}])
+
+    def test_partial_update_removes_keys(self):
+        del self.model.extra_fields['tags']
+        self.model.save()
+        stored = TestModel.objects.filter(id=self.model.id).values_list(
+            'extra_fields', flat=True)[0]
+        self.assertEqual(json.loads(stored), {'age': 21})
+
+    def test_signals_receive_update_fields(self):
+        received = []
+
+        def receiver(sender, instance, **kwargs):
+            received.append(kwargs.get('update_fields'))
+        models.signals.post_save.connect(receiver, sender=TestModel)
+        try:
+            self.model.age = 30
+            self.model.save()
+        finally:
+            models.signals.post_save.disconnect(receiver, sender=TestModel)
+        self.assertEqual(received, [frozenset(['extra_fields'])])
+
+
+class VirtualSyncTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        TestModel.virtual_sync = True
+        schema = DynamicSchema.get_for_model(TestModel)
+        schema.add_field('age', 'IntegerField')
+        schema.add_field('nickname', 'CharField')
+        TestModel.objects.bulk_create_dynamic([{'age': 21}])
+        TestModel.objects.update(extra_fields='{"age": 21, "old": "x"}')
+        self.model = TestModel.objects.get()
+
+    def tearDown(self):
+        TestModel.virtual_sync = False
+
+    def get_stored(self):
+        cursor = connection.cursor()
+        cursor.execute("SELECT extra_fields FROM testapp_testmodel")
+        return json.loads(cursor.fetchone()[0])
+
+    def test_load_leaves_stored_document(self):
+        self.assertEqual(dict(self.model.extra_fields),
+            {'age': 21, 'old': 'x'})
+        self.assertEqual(self.model.age, 21)
+        self.assertEqual(self.model.nickname, None)
+        self.assertRaises(AttributeError, getattr, self.model, 'old')
+        self.assertEqual(self.model.get_extra_field_value('old'), None)
+        self.assertEqual(dict((el[0], el[-1]) for el in
+            self.model.get_extra_fields()), {'age': 21, 'nickname': None})
+        self.assertEqual(self.model.get_dirty_fields(), set())
+        with self.assertNumQueries(0):
+            self.model.save()
+
+    def test_reads_resolve_schema_once(self):
+        model = TestModel.objects.get()
+        with CountCacheCalls() as calls:
+            for i in range(10):
+                self.assertEqual((model.age, model.nickname), (21, None))
+                self.assertRaises(AttributeError, getattr, model, 'old')
+                model.get_extra_field_value('old')
+            self.assertEqual(calls, ['get'])
+
+    def test_synced_when_written(self):
+        self.model.nickname = 'Johnny'
+        self.model.save()
+        self.assertEqual(self.get_stored(),
+            {'age': 21, 'old': 'x', 'nickname': 'Johnny'})
+
+        self.model.save(update_fields=['extra_fields'])
+        self.assertEqual(self.get_stored(),
+            {'age': 21, 'nickname': 'Johnny'})
+
+        model = TestModel(extra_fields={'old': 'x'})
+        model.save()
+        self.assertEqual(TestModel.objects.get(id=model.id).extra_fields,
+            {'age': None, 'nickname': None})
+
+
+class BulkCreateDynamicTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        schema = DynamicSchema.get_for_model(TestModel, 'email')
+        DynamicSchemaField.objects.create(schema=schema, name='email',
+            field_type='EmailField', required=True)
+        schema.add_field('age', 'IntegerField')
+        DynamicSchema.get_for_model(TestModel, 'contact').add_field('phone',
+            'CharField')
+        DynamicSchema.get_for_model(TestModel, 'email')
+        DynamicSchema.get_for_model(TestModel, 'contact')
+
+    def test_bulk_create_dynamic(self):
+        rows = [
+            {'type': 'email', 'about': 'one', 'email': 'one@example.com',
+                'age': '21'},
+            {'type': 'contact', 'about': 'two', 'phone': 555},
+            {'type': 'email', 'about': 'three', 'email': 'three@example.com'},
+        ]
+        with self.assertNumQueries(2):
+            self.assertEqual(TestModel.objects.bulk_create_dynamic(rows,
+                batch_size=2), 3)
+
+        models = TestModel.objects.order_by('id')
+        self.assertEqual([(el.about, el.extra_fields) for el in models], [
+            ('one', {'email': 'one@example.com', 'age': 21}),
+            ('two', {'phone': '555'}),
+            ('three', {'email': 'three@example.com', 'age': None}),
+        ])
+
+    def test_bulk_create_dynamic_batch_size(self):
+        # 3 columns a row, SQLite takes 333 rows per INSERT to stay within
+        # its 999 variables
+        rows = [{'type': 'contact', 'about': str(i), 'phone': str(i)}
+            for i in range(500)]
+        expected = 1
+        if connection.vendor == 'sqlite':
+            expected = 2
+        with self.assertNumQueries(expected):
+            self.assertEqual(TestModel.objects.bulk_create_dynamic(rows), 500)
+        self.assertEqual(TestModel.objects.count(), 500)
+
+    def test_bulk_create_dynamic_validation(self):
+        for row, field in [
+            ({'type': 'email', 'email': 'one@example.com', 'age': 'x'},
+                'age'),
+            ({'type': 'email', 'email': 'invalid'}, 'email'),
+            ({'type': 'email', 'age': 1}, 'email'),
+            ({'type': 'contact', 'age': 1}, 'age'),
+            ({'type': 'contact', 'about': 'x' * 101}, 'about'),
+            ({'type': 'contact', 'extra_fields': {}}, 'extra_fields'),
+        ]:
+            rows = [{'type': 'contact', 'phone': '1'}, row]
+            try:
+                TestModel.objects.bulk_create_dynamic(rows)
+            except ValidationError as e:
+                self.assertEqual(e.message_dict.keys(), [field])
+                self.assertTrue(e.messages[0].startswith('Row 1: '))
+            else:
+                self.fail("%r didn't raise ValidationError" % row)
+        self.assertEqual(TestModel.objects.count(), 0)
+
+    def test_converters(self):
+        self.assertEqual(compile_converter('IntegerField')(' 7 '), 7)
+        self.assertEqual(compile_converter('BooleanField')('false'), False)
+        self.assertEqual(compile_converter('NullBooleanField')('x'), None)
+        self.assertEqual(compile_converter('CharField')(''), None)
+        dropdown = compile_converter('Dropdown',
+            extra={'choices': [['a', 'A'], ['b', 'B']]})
+        self.assertEqual(dropdown('b'), 'b')
+        self.assertRaises(ValidationError, dropdown, 'c')
+
+
+class DynamicLookupTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        schema = DynamicSchema.get_for_model(TestModel)
+        schema.add_field('age', 'IntegerField')
+        schema.add_field('min_age', 'IntegerField')
+        schema.add_field('nickname', 'CharField')
+        schema.add_field('active', 'BooleanField')
+        DynamicSchema.get_for_model(TestModel, 'contact').add_field(
+            'nickname', 'CharField')
+
+        for about, age, nickname, active in [('one', 18, 'Johnny', True),
+            ('two', 21, 'Jane', False), ('three', 40, None, True)]:
+            model = TestModel(about=about)
+            model.age = age
+            model.min_age = 21
+            model.nickname = nickname
+            model.active = active
+            model.save()
+
+    def assert_matches(self, qs, expected):
+        self.assertEqual(sorted(el.about for el in qs), sorted(expected))
+
+    def test_comparisons(self):
+        self.assert_matches(TestModel.objects.filter(dyn__age__gt=20),
+            ['two', 'three'])
+        self.assert_matches(TestModel.objects.filter(dyn__age__lte='21'),
+            ['one', 'two'])
+        self.assert_matches(TestModel.objects.filter(dyn__age=40), ['three'])
+        self.assert_matches(TestModel.objects.filter(dyn__age__in=[18, 40]),
+            ['one', 'three'])
+        self.assert_matches(TestModel.objects.filter(
+            dyn__age__range=(20, 50)), ['two', 'three'])
+        self.assert_matches(TestModel.objects.filter(dyn__active=True),
+            ['one', 'three'])
+
+    def test_text_lookups(self):
+        self.assert_matches(TestModel.objects.filter(dyn__nickname='Jane'),
+            ['two'])
+        self.assert_matches(TestModel.objects.filter(
+            dyn__nickname__startswith='J'), ['one', 'two'])
+        self.assert_matches(TestModel.objects.filter(
+            dyn__nickname__icontains='OHN'), ['one'])
+        self.assert_matches(TestModel.objects.filter(
+            dyn__nickname__isnull=True), ['three'])
+        self.assert_matches(TestModel.objects.filter(
+            dyn__nickname=None), ['three'])
+
+    def test_combined_with_concrete_lookups(self):
+        self.assert_matches(TestModel.objects.filter(about='three',
+            dyn__age__gt=20), ['three'])
+        self.assert_matches(TestModel.objects.exclude(about='three',
+            dyn__age__gt=20), ['one', 'two'])
+        self.assertEqual(TestModel.objects.get(dyn__nickname='Jane').about,
+            'two')
+
+    def test_field_references(self):
+        self.assert_matches(TestModel.objects.filter(
+            dyn__age__gte=DynamicF('min_age')), ['two', 'three'])
+        self.assert_matches(TestModel.objects.filter(
+            dyn__nickname=models.F('about')), [])
+        self.assertRaises(FieldError, TestModel.objects.filter,
+            dyn__nickname__contains=DynamicF('about'))
+
+    def test_unknown_field(self):
+        self.assertRaises(FieldError, TestModel.objects.filter,
+            dyn__missing=1)
+        self.assertRaises(FieldError, TestModel.objects.filter,
+            dyn__age__gt=DynamicF('missing'))
+
+    def test_field_types_from_cached_schemas(self):
+        TestModel.objects.filter(dyn__age__gt=1)
+        with self.assertNumQueries(0):
+            TestModel.objects.filter(dyn__age__gt=1).filter(
+                dyn__age__lt=50).exclude(dyn__nickname='Jane')
+        # a changed schema is picked up
+        DynamicSchema.get_for_model(TestModel, 'contact').add_field('age',
+            'CharField')
+        self.assertIsNone(
+            DynamicSchema.objects.get_field_types(TestModel)['age'])
+
+    def test_field_types_once_per_queryset(self):
+        TestModel.objects.filter(dyn__age__gt=1)
+        with CountCacheCalls() as calls:
+            TestModel.objects.filter(dyn__age__gt=1).filter(
+                dyn__age__lt=50).exclude(dyn__nickname='Jane')
+        # the type values and the schema versions
+        self.assertEqual(calls, ['get_many', 'get_many'])
+
+    def test_lookups_dont_create_schemas(self):
+        self.assertRaises(FieldError, TypelessModel.objects.filter,
+            dyn__age=1)
+        self.assertEqual(DynamicSchema.objects.filter(
+            type_value='', model__model='typelessmodel').count(), 0)
+
+    def test_invalid_stored_name(self):
+        # names saved before they were validated are never put into SQL
+        DynamicSchemaField.objects.filter(name='age').update(
+            name="age') OR 1=1 --")
+        DynamicSchema.renew_cache_static(TestModel, '')
+        self.assertRaises(ValueError, TestModel.objects.filter,
+            **{"dyn__age') OR 1=1 --": 1})
+
+    def test_ambiguous_field_type(self):
+        DynamicSchema.get_for_model(TestModel, 'email').add_field('age',
+            'CharField')
+        self.assertRaises(FieldError, TestModel.objects.filter,
+            dyn__age__gt=20)
+        self.assert_matches(TestModel.objects.filter(dyn__nickname='Jane'),
+            ['two'])
+
+    def test_update_dynamic(self):
+        TestModel.objects.filter(dyn__age__lt=30)
+        with self.assertNumQueries(1):
+            # field types and specs come from the cached schemas
+            self.assertEqual(TestModel.objects.filter(
+                dyn__age__lt=30).update_dynamic(age='30', nickname='X'), 2)
+        self.assert_matches(TestModel.objects.filter(dyn__age=30),
+            ['one', 'two'])
+        model = TestModel.objects.get(about='one')
+        self.assertEqual((model.age, model.nickname, model.min_age,
+            model.active), (30, 'X', 21, True))
+
+    def test_update_dynamic_with_references(self):
+        self.assertEqual(TestModel.objects.filter(about='three')
+            .update_dynamic(age=DynamicF('min_age'),
+                nickname=models.F('about')), 1)
+        model = TestModel.objects.get(about='three')
+        self.assertEqual((model.age, model.nickname), (21, 'three'))
+
+    def test_update_dynamic_with_null_references(self):
+        # a missing key or a NULL column sets the key to null, the rest of
+        # the document stays
+        DynamicSchema.get_for_model(TestModel).add_field('missing_key',
+            'CharField')
+        self.assertEqual(TestModel.objects.filter(about='one')
+            .update_dynamic(nickname=DynamicF('missing_key')), 1)
+        model = TestModel.objects.get(about='one')
+        self.assertEqual((model.age, model.nickname), (18, None))
+
+        DynamicSchema.get_for_model(NullableModel).add_field('label',
+            'CharField')
+        model = NullableModel()
+        model.label = 'label'
+        model.save()
+        self.assertEqual(NullableModel.objects.update_dynamic(
+            label=models.F('note')), 1)
+        self.assertEqual(NullableModel.objects.get().extra_fields,
+            {'label': None})
+
+    def test_postgresql_null_references(self):
+        backend = PostgreSQLJSONBackend(connection)
+        self.assertEqual(backend.to_json_sql('"note"'),
+            'COALESCE(to_jsonb("note"), \'null\'::jsonb)')
+
+    def test_update_dynamic_only_rows_with_the_field(self):
+        contact = TestModel(about='contact', type='contact')
+        contact.nickname = 'Joe'
+        contact.save()
+        self.assertEqual(TestModel.objects.update_dynamic(age=50), 3)
+        self.assertEqual(TestModel.objects.get(about='contact').extra_fields,
+            {'nickname': 'Joe'})
+        self.assertEqual(TestModel.objects.update_dynamic(nickname='X'), 4)
+        self.assertEqual(TestModel.objects.get(about='contact').nickname, 'X')
+
+    def test_update_dynamic_invalid_value(self):
+        try:
+            TestModel.objects.update_dynamic(age='abc', nickname='X')
+        except ValidationError as e:
+            self.assertEqual(e.message_dict.keys(), ['age'])
+        else:
+            self.fail("update_dynamic() didn't raise ValidationError")
+        self.assertFalse(TestModel.objects.filter(dyn__nickname='X').exists())
+
+        DynamicSchema.get_for_model(TestModel, 'email').add_field('age',
+            'CharField')
+        self.assertRaises(FieldError, TestModel.objects.update_dynamic,
+            age=1)
+
+    def test_update_dynamic_unknown_field(self):
+        self.assertRaises(FieldError, TestModel.objects.update_dynamic,
+            missing=1)
+        self.assertRaises(FieldError, TestModel.objects.update_dynamic,
+            age=DynamicF('missing'))
+
+    def test_order_by(self):
+        model = TestModel(about='four')
+        model.age = 5
+        model.active = False
+        model.save()
+        self.assertEqual([el.about for el in
+            TestModel.objects.order_by(DynamicF('age').desc())],
+            ['three', 'two', 'one', 'four'])
+        self.assertEqual([el.about for el in
+            TestModel.objects.order_by(DynamicF('age'))],
+            ['four', 'one', 'two', 'three'])
+        self.assertEqual([el.about for el in TestModel.objects.filter(
+            dyn__age__gt=10).order_by('-about', DynamicF('age').asc())],
+            ['two', 'three', 'one'])
+        self.assertEqual([el.about for el in TestModel.objects.order_by(
+            DynamicF('active').desc(), 'about')],
+            ['one', 'three', 'four', 'two'])
+        # a later order_by() replaces the dynamic ordering
+        self.assertEqual([el.about for el in TestModel.objects.order_by(
+            DynamicF('age')).order_by('about')],
+            ['four', 'one', 'three', 'two'])
+        self.assertRaises(FieldError, TestModel.objects.order_by,
+            DynamicF('missing'))
+
+    def test_order_by_and_aggregate_queries(self):
+        TestModel.objects.filter(dyn__age__gt=1)
+        with self.assertNumQueries(0):
+            qs = TestModel.objects.filter(dyn__age__gt=1).order_by(
+                DynamicF('age'))
+        with self.assertNumQueries(1):
+            self.assertEqual([el.about for el in qs.order_by(
+                DynamicF('age').desc())], ['three', 'two', 'one'])
+        with self.assertNumQueries(1):
+            self.assertEqual(qs.aggregate(DynamicSum('age')),
+                {'age__sum': 79})
+
+    def test_order_by_values(self):
+        qs = TestModel.objects.order_by(DynamicF('age').desc())
+        self.assertEqual(list(qs.values('about')), [{'about': 'three'},
+            {'about': 'two'}, {'about': 'one'}])
+        self.assertEqual(list(qs.values_list('about', flat=True)),
+            ['three', 'two', 'one'])
+        self.assertEqual([row[3] for row in qs.values_list()],
+            ['three', 'two', 'one'])
+        self.assertEqual(list(TestModel.objects.values_list('about')
+            .order_by(DynamicF('age'))), [('one',), ('two',), ('three',)])
+        self.assertEqual(TestModel.objects.filter(
+            pk__in=qs.values('pk')).count(), 3)
+
+    def test_order_by_hides_values(self):
+        qs = TestModel.objects.order_by(DynamicF('age'))
+        self.assertEqual(sorted(qs.values()[0]), ['about', 'extra_fields',
+            'id', 'type'])
+        for model in list(qs) + list(qs.iterator_dynamic()):
+            self.assertFalse(hasattr(model, 'dyn_order_age'))
+
+    def test_aggregate(self):
+        self.assertEqual(TestModel.objects.aggregate(DynamicSum('age'),
+            DynamicAvg('age'), DynamicMin('age'), DynamicMax('nickname'),
+            DynamicCount('nickname'), total=models.Count('id')),
+            {'age__sum': 79, 'age__avg': 79 / 3.0, 'age__min': 18,
+                'nickname__max': 'Johnny', 'nickname__count': 2,
+                'total': 3})
+        self.assertEqual(TestModel.objects.filter(dyn__age__gt=20)
+            .aggregate(oldest=DynamicMax('age'),
+                nicknames=DynamicCount('min_age', distinct=True)),
+            {'oldest': 40, 'nicknames': 1})
+        self.assertEqual(TestModel.objects.filter(about='missing')
+            .aggregate(DynamicSum('age'), DynamicCount('age')),
+            {'age__sum': None, 'age__count': 0})
+
+    def test_aggregate_annotated(self):
+        qs = TestModel.objects.annotate(count=models.Count('id'))
+        self.assertEqual(qs.aggregate(DynamicSum('age'),
+            models.Sum('count')), {'age__sum': 79, 'count__sum': 3})
+        self.assertEqual(qs.filter(dyn__age__gt=20).aggregate(
+            DynamicMax('nickname')), {'nickname__max': 'Jane'})
+        self.assertRaises(FieldError, TestModel.objects.values('type')
+            .annotate(count=models.Count('id')).aggregate, DynamicSum('age'))
+
+    def test_aggregate_field_types(self):
+        self.assertRaises(FieldError, TestModel.objects.aggregate,
+            DynamicSum('nickname'))
+        self.assertRaises(FieldError, TestModel.objects.aggregate,
+            DynamicMax('active'))
+        self.assertRaises(FieldError, TestModel.objects.aggregate,
+            DynamicSum('missing'))
+        self.assertEqual(TestModel.objects.aggregate(
+            DynamicCount('active'))['active__count'], 3)
+
+
+class DynamicIndexTest(TransactionTestCase):
+    # sqlite commits before DDL statements, so this can't run in a
+    # transaction that is rolled back
+
+    def tearDown(self):
+        call_command('flush', interactive=False, verbosity=0)
+        cache.clear()
+
+    def setUp(self):
+        cache.clear()
+        self.age = DynamicSchemaField.objects.create(
+            schema=DynamicSchema.get_for_model(TestModel), name='age',
+            field_type='IntegerField', extra={'indexed': True})
+        DynamicSchemaField.objects.create(
+            schema=DynamicSchema.get_for_model(TestModel, 'contact'),
+            name='phone', field_type='CharField', extra={'indexed': True})
+        DynamicSchemaField.objects.create(
+            schema=DynamicSchema.get_for_model(TestModel, 'contact'),
+            name='note', field_type='CharField')
+
+    def get_index_names(self):
+        return [name for name in
+            get_backend(connection).index_names(TestModel._meta.db_table)
+            if name.startswith(INDEX_PREFIX)]
+
+    def get_query_plan(self, qs):
+        sql, params = qs.query.get_compiler(qs.db).as_sql()
+        cursor = connection.cursor()
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+        return " ".join(unicode(row[-1]) for row in cursor.fetchall())
+
+    def test_create_indexes(self):
+        run_command('dynamicmodel_indexes', 'testapp.TestModel')
+        self.assertEqual(len(self.get_index_names()), 2)
+        self.assertIn(get_index_name(TestModel._meta.db_table, self.age),
+            self.get_index_names())
+        self.assertIn('USING INDEX dynidx_', self.get_query_plan(
+            TestModel.objects.filter(type='', dyn__age__gt=20)))
+
+        # running it again doesn't change anything
+        created, dropped = sync_dynamic_indexes(TestModel, 'default')
+        self.assertEqual((created, dropped), ([], []))
+
+    def test_postgresql_partial_index_sql(self):
+        backend = PostgreSQLJSONBackend(connection)
+        self.assertEqual(backend.create_index_sql('idx', 'tbl',
+            [backend.extract_sql('"col"', 'age', 'IntegerField', True)],
+            '"type" = %s' % backend.quote_value("it's")),
+            'CREATE INDEX IF NOT EXISTS "idx" ON "tbl" '
+            '(((("col" ->> \'age\'))::integer)) WHERE "type" = E\'it\'\'s\'')
+        self.assertEqual(backend.quote_value("a\\' OR 1=1 --"),
+            "E'a\\\\'' OR 1=1 --'")
+
+    def test_invalid_stored_name(self):
+        DynamicSchemaField.objects.filter(pk=self.age.pk).update(
+            name="age')); DROP TABLE testapp_testmodel; --")
+        self.assertRaises(CommandError, run_command, 'dynamicmodel_indexes',
+            'testapp.TestModel')
+        self.assertEqual(self.get_index_names(), [])
+        self.assertEqual(TestModel.objects.count(), 0)
+
+    def test_drop_unflagged_indexes(self):
+        run_command('dynamicmodel_indexes', 'testapp.TestModel')
+        self.age.extra = {}
+        self.age.save()
+        run_command('dynamicmodel_indexes', 'testapp.TestModel')
+        self.assertEqual(len(self.get_index_names()), 1)
+        run_command('dynamicmodel_indexes', 'testapp.TestModel', drop=True)
+        self.assertEqual(self.get_index_names(), [])
+
+
+class ExportTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        DynamicSchema.get_for_model(TestModel, 'email').add_fields(
+            [('age', 'IntegerField'), ('nickname', 'CharField')])
+        DynamicSchema.get_for_model(TestModel, 'contact').add_fields(
+            [('phone', 'CharField'), ('tags', 'CharField')])
+        TestModel.objects.bulk_create_dynamic([
+            {'type': 'email', 'about': 'one', 'age': 18,
+                'nickname': u'J\xf6rg'},
+            {'type': 'contact', 'about': 'two', 'phone': '555',
+                'tags': None},
+            {'type': 'email', 'about': 'three, four', 'age': 40}])
+        self.pks = list(TestModel.objects.order_by('pk')
+            .values_list('pk', flat=True))
+
+    def test_csv(self):
+        lines = list(export_csv(TestModel.objects.all(), chunk_size=2))
+        self.assertEqual(lines, [
+            'id,type,about,age,nickname,phone,tags\r\n',
+            '%d,email,one,18,J\xc3\xb6rg,,\r\n' % self.pks[0],
+            '%d,contact,two,,,555,\r\n' % self.pks[1],
+            '%d,email,"three, four",40,,,\r\n' % self.pks[2]])
+
+    def test_jsonl(self):
+        # one query per chunk and one finding no more rows, the schemas
+        # come from the cache
+        with self.assertNumQueries(3):
+            lines = list(export_jsonl(TestModel.objects.exclude(
+                about='one'), chunk_size=1))
+        self.assertEqual([json.loads(line) for line in lines], [
+            {'id': self.pks[1], 'type': 'contact', 'about': 'two',
+                'phone': '555', 'tags': None},
+            {'id': self.pks[2], 'type': 'email', 'about': 'three, four',
+                'age': 40, 'nickname': None}])
+        self.assertTrue(all(line.endswith('\n') for line in lines))
+
+    def test_command(self):
+        output = os.path.join(tempfile.mkdtemp(), 'export.jsonl')
+        try:
+            run_command('dynamicmodel_export', 'testapp.TestModel',
+                format='jsonl', output=output, type_value='email')
+            with open(output) as f:
+                self.assertEqual([json.loads(line)['about'] for line in f],
+                    ['one', 'three, four'])
+        finally:
+            shutil.rmtree(os.path.dirname(output))
+        self.assertRaises(CommandError, run_command, 'dynamicmodel_export',
+            'testapp.TestModel', format='xml')
+
+
+class ImportTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        DynamicSchema.get_for_model(TestModel, 'email').add_fields(
+            [('age', 'IntegerField'),
+                {'name': 'email', 'type': 'EmailField', 'required': True}])
+        DynamicSchema.get_for_model(TestModel, 'contact').add_field(
+            'phone', 'CharField')
+
+    def test_csv(self):
+        errors = StringIO()
+        data = StringIO("type,about,age,email,phone\r\n"
+            "email,one,21,one@example.com,\r\n"
+            "email,two,x,two@example.com,\r\n"
+            "contact,three,,,555\r\n"
+            "email,four,,,\r\n"
+            "email,five\r\n"
+            "other,six,,,\r\n")
+        # the empty phone of email rows isn't part of their schema
+        result = Importer(TestModel, errors=errors, batch_size=2,
+            mapping={'type': 'type', 'about': 'about', 'age': 'age',
+                'email': 'email'}).run(data)
+        self.assertEqual(result, (1, 5))
+        model = TestModel.objects.get()
+        self.assertEqual((model.about, model.age, model.email),
+            ('one', 21, 'one@example.com'))
+
+        rejects = [json.loads(line) for line in
+            errors.getvalue().splitlines()]
+        self.assertEqual([el['record'] for el in rejects], [2, 3, 4, 5, 6])
+        self.assertEqual(rejects[0]['data'],
+            ['email', 'two', 'x', 'two@example.com', ''])
+        self.assertEqual(rejects[0]['errors'],
+            {'age': ['Enter a whole number.']})
+        self.assertEqual(rejects[2]['errors'],
+            {'email': ['This field is required.']})
+        self.assertEqual(rejects[3]['errors'],
+            {'__all__': ['Expected 5 columns, got 2.']})
+        self.assertEqual(rejects[4]['errors'],
+            {'type': ["No schema for type 'other'."]})
+
+    def test_concrete_fields_cleaned(self):
+        errors = StringIO()
+        data = StringIO("type,about,phone\r\n"
+            "contact,%s,555\r\n"
+            "contact,ok,556\r\n" % ('x' * 101))
+        self.assertEqual(Importer(TestModel, errors=errors).run(data), (1, 1))
+        self.assertEqual(json.loads(errors.getvalue())['errors'],
+            {'about': ['Ensure this value has at most 100 characters '
+                '(it has 101).']})
+
+    def test_failed_batch_inserted_row_by_row(self):
+        existing = TestModel.objects.create(type='contact')
+        errors = StringIO()
+        data = StringIO("id,type,phone\r\n"
+            "%d,contact,1\r\n"
+            "%d,contact,2\r\n"
+            "%d,contact,3\r\n" % (existing.pk + 1, existing.pk,
+                existing.pk + 2))
+        self.assertEqual(Importer(TestModel, errors=errors).run(data), (2, 1))
+        self.assertEqual(sorted(model.phone for model in
+            TestModel.objects.exclude(pk=existing.pk)), ['1', '3'])
+        reject = json.loads(errors.getvalue())
+        self.assertEqual(reject['record'], 2)
+        self.assertEqual(reject['errors'].keys(), ['__all__'])
+
+    def test_jsonl(self):
+        data = StringIO('{"type": "email", "age": "30", '
+            '"email": "a@example.com"}\n'
+            '{"type": "contact", "phone": "555", "about": "contact"}\n'
+            '\n'
+            '{"type": "contact", "nickname": "x"}\n'
+            'not json\n')
+        errors = StringIO()
+        with self.assertNumQueries(3):
+            result = Importer(TestModel, format='jsonl', errors=errors)\
+                .run(data)
+        self.assertEqual(result, (2, 2))
+        self.assertEqual(TestModel.objects.get(type='email').age, 30)
+        self.assertEqual(TestModel.objects.get(type='contact').about,
+            'contact')
+        rejects = [json.loads(line) for line in
+            errors.getvalue().splitlines()]
+        self.assertEqual(rejects[0]['errors'],
+            {'nickname': ['Unknown field.']})
+        self.assertEqual(rejects[1], {'record': 4, 'data': 'not json',
+            'errors': {'__all__': ['Invalid JSON.']}})
+
+    def test_process_pool(self):
+        data = StringIO("type,age,email\r\n" + "".join(
+            "email,%d,user%d@example.com\r\n" % (i, i) for i in range(20)) +
+            "email,x,broken\r\n")
+        result = Importer(TestModel, batch_size=3, processes=2).run(data)
+        self.assertEqual(result, (20, 1))
+        self.assertEqual(sorted(TestModel.objects.values_list('about',
+            flat=True).distinct()), ['about value'])
+        self.assertEqual(sorted(model.age for model in
+            TestModel.objects.all()), range(20))
+
+    def test_command(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tempdir, 'data.jsonl')
+            with open(path, 'w') as f:
+                f.write('{"kind": "contact", "tel": "555"}\n'
+                    '{"kind": "contact", "tel": "556", "extra": 1}\n')
+            run_command('dynamicmodel_import', 'testapp.TestModel', path,
+                format='jsonl', mapping=['kind:type', 'tel:phone'],
+                errors=os.path.join(tempdir, 'errors.jsonl'))
+            self.assertEqual(sorted(model.phone for model in
+                TestModel.objects.all()), ['555', '556'])
+            with open(os.path.join(tempdir, 'errors.jsonl')) as f:
+                self.assertEqual(f.read(), '')
+        finally:
+            shutil.rmtree(tempdir)
+        self.assertRaises(CommandError, run_command, 'dynamicmodel_import',
+            'testapp.TestModel', 'data.csv', mapping=['broken'])
+
+
+class BackfillTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        schema = DynamicSchema.get_for_model(TestModel, 'email')
+        schema.add_fields([('age', 'CharField'), ('nickname', 'CharField'),
+            ('active', 'BooleanField')])
+        DynamicSchema.get_for_model(TestModel, 'contact').add_field(
+            'nickname', 'CharField')
+        TestModel.objects.bulk_create_dynamic(
+            [{'type': 'email', 'age': str(i), 'nickname': 'nick %d' % i,
+                'active': True} for i in range(10)] +
+            [{'type': 'contact', 'nickname': 'contact'}])
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def get_documents(self, type_value='email'):
+        cursor = connection.cursor()
+        cursor.execute("SELECT extra_fields FROM testapp_testmodel WHERE "
+            "type = %s ORDER BY id", [type_value])
+        return [json.loads(row[0]) for row in cursor.fetchall()]
+
+    def test_remove_and_rename(self):
+        schema = DynamicSchema.get_for_model(TestModel, 'email')
+        schema.remove_field('nickname')
+        schema.remove_field('active')
+        schema.add_field('enabled', 'BooleanField')
+        # the contact schema still has the field
+        changed = Backfill(TestModel, [RemoveField('nickname'),
+            RenameField('active', 'enabled')], chunk_size=3).run()
+        self.assertEqual(changed, 10)
+        for i, document in enumerate(self.get_documents()):
+            self.assertEqual(document, {'age': str(i), 'enabled': True})
+        self.assertEqual(self.get_documents('contact'),
+            [{'nickname': 'contact'}])
+
+    def test_prepare_uses_cached_schemas(self):
+        DynamicSchema.objects.get_type_values(TestModel)
+        backfill = Backfill(TestModel, [RemoveField('active')])
+        with self.assertNumQueries(0):
+            backfill.prepare()
+
+    def test_operations_must_match_a_schema(self):
+        for operations, type_value in [([RemoveField('nickname')], None),
+            ([RemoveField('nickname')], 'email'),
+            ([RenameField('age', 'years')], None),
+            ([ConvertField('age', 'IntegerField')], 'email')]:
+            self.assertRaises(ValueError, Backfill(TestModel, operations,
+                type_value=type_value).run)
+        self.assertEqual(len([document for document in self.get_documents()
+            if 'nickname' in document]), 10)
+
+    def test_convert(self):
+        TestModel.objects.filter(pk=TestModel.objects.all()[0].pk)\
+            .update_dynamic(age='old')
+        schema = DynamicSchema.get_for_model(TestModel, 'email')
+        schema.remove_field('age')
+        schema.add_field('age', 'IntegerField')
+        changed = Backfill(TestModel, [ConvertField('age', 'IntegerField')],
+            type_value='email').run()
+        self.assertEqual(changed, 9)
+        ages = [document['age'] for document in self.get_documents()]
+        self.assertEqual(ages, ['old'] + range(1, 10))
+        self.assertEqual(Backfill(TestModel,
+            [ConvertField('age', 'IntegerField')]).run(), 0)
+        self.assertRaises(ValidationError, Backfill(TestModel,
+            [ConvertField('age', 'IntegerField', strict=True)]).run)
+
+    def test_progress_and_checkpoint(self):
+        DynamicSchema.get_for_model(TestModel, 'email').remove_field(
+            'nickname')
+        DynamicSchema.get_for_model(TestModel, 'contact').remove_field(
+            'nickname')
+        checkpoint = os.path.join(self.tempdir, 'checkpoint')
+        pks = list(TestModel.objects.order_by('pk')
+            .values_list('pk', flat=True))
+        calls = []
+
+        def progress(position, max_pk, changed):
+            calls.append((position, max_pk, changed))
+            if len(calls) == 2:
+                raise KeyboardInterrupt
+
+        backfill = Backfill(TestModel, [RemoveField('nickname')],
+            chunk_size=4, checkpoint=checkpoint, progress=progress)
+        self.assertRaises(KeyboardInterrupt, backfill.run)
+        self.assertEqual(calls, [(pks[3], pks[-1], 4), (pks[7], pks[-1], 4)])
+        self.assertEqual(len([document for document in self.get_documents()
+            if 'nickname' in document]), 2)
+
+        del calls[:]
+        self.assertEqual(backfill.run(), 3)
+        self.assertEqual(calls, [(pks[-1], pks[-1], 3)])
+        self.assertEqual(backfill.run(), 0)
+        # a checkpoint of a different backfill
+        self.assertRaises(ValueError, Backfill(TestModel,
+            [RemoveField('nickname')], type_value='email',
+            checkpoint=checkpoint).run)
+
+    def test_command(self):
+        self.assertRaises(CommandError, run_command,
+            'dynamicmodel_backfill', 'testapp.TestModel',
+            remove=['nickname'], type_value='email')
+        schema = DynamicSchema.get_for_model(TestModel, 'email')
+        schema.remove_field('nickname')
+        schema.remove_field('age')
+        schema.add_field('age', 'IntegerField')
+        run_command('dynamicmodel_backfill', 'testapp.TestModel',
+            remove=['nickname'], convert=['age:IntegerField'],
+            type_value='email')
+        self.assertEqual(self.get_documents()[1], {'age': 1,
+            'active': True})
+        self.assertEqual(self.get_documents('contact'),
+            [{'nickname': 'contact'}])
+        self.assertRaises(CommandError, run_command,
+            'dynamicmodel_backfill', 'testapp.TestModel')
+        self.assertRaises(CommandError, run_command,
+            'dynamicmodel_backfill', 'testapp.TestModel',
+            convert=['age:Unknown'])
+        self.assertRaises(CommandError, run_command,
+            'dynamicmodel_backfill', 'testapp.TypelessModel',
+            remove=['age'], type_value='email')
+
+
+class LazyExtraFieldsTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.field = TestModel._meta.get_field('extra_fields')
+        self.field.lazy = True
+        DynamicSchema.get_for_model(TestModel).add_field('nickname',
+            'CharField')
+        self.model = TestModel.objects.create(about='one')
+        TestModel.objects.filter(pk=self.model.pk).update(
+            extra_fields='{"nickname":   "JD", "stale": 1}')
+
+    def tearDown(self):
+        self.field.lazy = False
+
+    def get_raw_extra_fields(self):
+        cursor = connection.cursor()
+        cursor.execute("SELECT extra_fields FROM %s WHERE id = %%s" %
+            TestModel._meta.db_table, [self.model.pk])
+        return cursor.fetchone()[0]
+
+    def test_lazy_to_python(self):
+        field = JSONField(lazy=True)
+        value = field.to_python('{"a": 1}')
+        self.assertIsInstance(value, LazyJSON)
+        self.assertFalse(value.loaded)
+        self.assertEqual(value, {'a': 1})
+        self.assertEqual(field.get_db_prep_value(field.to_python('[}'),
+            connection), '[}')
+        self.assertRaises(ValueError, dict, field.to_python('[}'))
+
+    def test_concrete_access_does_not_decode(self):
+        model = TestModel.objects.get(pk=self.model.pk)
+        self.assertEqual(model.about, 'one')
+        self.assertFalse(model.__dict__['extra_fields'].loaded)
+        self.assertRaises(AttributeError, getattr, model, 'missing')
+        self.assertFalse(model.__dict__['extra_fields'].loaded)
+
+    def test_dynamic_access_decodes_and_syncs(self):
+        model = TestModel.objects.get(pk=self.model.pk)
+        self.assertEqual(model.nickname, 'JD')
+        # decoding replaces the lazy value with the plain dict
+        self.assertIs(type(model.__dict__['extra_fields']), dict)
+        self.assertEqual(model.extra_fields, {'nickname': 'JD'})
+
+    def test_attribute_is_plain_dict(self):
+        model = TestModel.objects.get(pk=self.model.pk)
+        self.assertIs(type(model.extra_fields), dict)
+        self.assertEqual(json.loads(json.dumps(model.extra_fields)),
+            {'nickname': 'JD'})
+        self.assertEqual(dict(TestModel.objects.get(
+            pk=self.model.pk).extra_fields), {'nickname': 'JD'})
+
+    def test_untouched_payload_saved_verbatim(self):
+        model = TestModel.objects.get(pk=self.model.pk)
+        model.about = 'two'
+        model.save()
+        self.assertEqual(self.get_raw_extra_fields(),
+            '{"nickname":   "JD", "stale": 1}')
+
+    def test_touched_payload_saved_encoded(self):
+        model = TestModel.objects.get(pk=self.model.pk)
+        model.nickname = 'Johnny'
+        model.save()
+        self.assertEqual(
+            TestModel.objects.get(pk=self.model.pk).extra_fields,
+            {'nickname': 'Johnny'})
+
+
+class JSONCodecTest(TestCase):
+
+    payload = {
+        'date': datetime.date(2012, 1, 2),
+        'datetime': datetime.datetime(2012, 1, 2, 3, 4, 5, 678000),
+        'amount': decimal.Decimal('1.50'),
+        'name': u'\u0161ime',
+        'tags': [1, None, True],
+    }
+
+    expected = {
+        'date': '2012-01-02',
+        'datetime': '2012-01-02T03:04:05.678',
+        'amount': '1.50',
+        'name': u'\u0161ime',
+        'tags': [1, None, True],
+    }
+
+    def test_dates_and_decimals_encoded_like_django(self):
+        field = JSONField()
+        self.assertEqual(json.loads(
+            field.get_db_prep_value(self.payload, connection)), self.expected)
+
+    def test_codec_setting(self):
+        RecordingCodec.calls = []
+        with override_settings(
+            DYNAMICMODEL_JSON_CODEC='testapp.tests.RecordingCodec'):
+            field = JSONField()
+            self.assertEqual(field.to_python('{"a": 1}'), {'a': 1})
+            field.get_db_prep_value({'a': 1}, connection)
+        self.assertEqual(RecordingCodec.calls, ['loads', 'dumps'])
+        self.assertIsInstance(get_codec(), JSONCodec)
+
+    def test_explicit_kwargs_use_stdlib_codec(self):
+        field = JSONField(dump_kwargs={'sort_keys': True})
+        with override_settings(
+            DYNAMICMODEL_JSON_CODEC='testapp.tests.RecordingCodec'):
+            self.assertEqual(field.get_db_prep_value({'b': 1, 'a': 2},
+                connection), '{"a": 2, "b": 1}')
+
+    def test_unavailable_codec_falls_back_to_stdlib(self):
+        with override_settings(
+            DYNAMICMODEL_JSON_CODEC='testapp.tests.UnavailableCodec'):
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                codec = get_codec()
+        self.assertEqual(type(codec), JSONCodec)
+        self.assertEqual(len(caught), 1)
+
+    def test_unknown_codec(self):
+        with override_settings(
+            DYNAMICMODEL_JSON_CODEC='testapp.tests.MissingCodec'):
+            self.assertRaises(ImproperlyConfigured, get_codec)
+
+    @skipUnless(UJSONCodec.available, "ujson is not installed")
+    def test_ujson_codec(self):
+        codec = UJSONCodec()
+        self.assertEqual(json.loads(codec.dumps(self.payload)), self.expected)
+        self.assertEqual(codec.loads(JSONCodec().dumps(self.payload)),
+            self.expected)
+
+    @skipUnless(UJSONCodec.available, "ujson is not installed")
+    def test_ujson_codec_falls_back(self):
+        # values ujson would round, reorder or reject
+        codec = UJSONCodec()
+        for value in [{'ratio': 1 / 3.0}, {'big': 2 ** 70},
+            OrderedDict([('b', 1), ('a', 2)])]:
+            self.assertEqual(codec.dumps(value), JSONCodec().dumps(value))
+        self.assertEqual(codec.loads('{"big": %d}' % 2 ** 70),
+            {'big': 2 ** 70})
+        self.assertRaises(ValueError, codec.loads, '{')
+
+
+class NativeJSONTest(TestCase):
+
+    def test_native_column_type(self):
+        self.assertEqual(JSONField(native=True).db_type(connection),
+            get_backend(connection).native_column_type)
+
+    def test_get_backend(self):
+        class FakeConnection(object):
+            vendor = 'oracle'
+
+        self.assertIsInstance(get_backend(connection), SQLiteJSONBackend)
+        self.assertRaises(DatabaseError, get_backend, FakeConnection())
+
+    def test_postgresql_conversion_sql(self):
+        backend = PostgreSQLJSONBackend(connection)
+        self.assertEqual(backend.convert_column_sql('tbl', 'col'),
+            ['ALTER TABLE "tbl" ALTER COLUMN "col" TYPE jsonb '
+                'USING "col"::jsonb'])
+        self.assertEqual(backend.convert_column_sql('tbl', 'col', False),
+            ['ALTER TABLE "tbl" ALTER COLUMN "col" TYPE text '
+                'USING "col"::text'])
+
+    def test_postgresql_update_keys_sql(self):
+        backend = PostgreSQLJSONBackend(connection)
+        self.assertEqual(backend.update_keys_sql('col',
+            [('a', backend.json_param_sql)], ['b']),
+            "(jsonb_set((COALESCE(col, '{}')::jsonb - 'b'), '{a}', "
+                "%s::jsonb))::text")
+        self.assertEqual(backend.update_keys_sql('col',
+            [('a', backend.extract_json_sql('col', 'b', True))], native=True),
+            "jsonb_set(COALESCE(col, '{}'), '{a}', "
+                "COALESCE(col -> 'b', 'null'::jsonb))")
+
+    def test_convert_command(self):
+        model = TestModel.objects.create(about='one')
+        TestModel.objects.filter(pk=model.pk).update(
+            extra_fields='{"a":   1}')
+        call_command('dynamicmodel_native_json', 'testapp.TestModel',
+            verbosity=0)
+        self.assertEqual(TestModel.objects.filter(pk=model.pk)
+            .values_list('extra_fields', flat=True)[0], '{"a":1}')
+
+    def test_convert_command_rejects_invalid_json(self):
+        model = TestModel.objects.create(about='one')
+        TestModel.objects.filter(pk=model.pk).update(extra_fields='{a')
+        self.assertRaises(CommandError, run_command,
+            'dynamicmodel_native_json', 'testapp.TestModel')
+        self.assertRaises(CommandError, run_command,
+            'dynamicmodel_native_json', 'testapp.FalseModel')
+
 
 # testing DynamicModel and DynamicForm
 class DynamicFormTest(TestCase):
@@ -409,6 +2078,28 @@ class DynamicFormTest(TestCase):
         self.assertFalse(form['about'].errors)
         self.assertFalse(form['email'].errors)
 
+    def test_form_fields_compiled_once_per_schema_version(self):
+        schema = DynamicSchema.get_for_model(TestModel)
+        DynamicSchemaField.objects.create(schema=schema, name='size',
+            field_type='Dropdown', extra={'choices': [['s', 'S']]})
+        one = TestModel()
+        one.size = 's'
+        two = TestModel()
+
+        with self.assertNumQueries(0):
+            forms = [TestForm(instance=one), TestForm(instance=two)]
+        compiled = TestForm.get_dynamic_form_fields(one.get_schema())
+        self.assertIs(TestForm.get_dynamic_form_fields(two.get_schema()),
+            compiled)
+        self.assertIsNot(forms[0].fields['size'], forms[1].fields['size'])
+        self.assertEqual([form.fields['size'].initial for form in forms],
+            ['s', None])
+        self.assertEqual(forms[0].fields['size'].widget.choices, [['s', 'S']])
+
+        schema.add_field('age', 'IntegerField')
+        self.assertEqual(list(TestForm(instance=TestModel()).fields)[-2:],
+            ['size', 'age'])
+
     def test_validate_schema_fields_typeless(self):
         """Test form validation on dynamicmodel that has no
         get_schema_type_descriptor method declared